@@ -16,3 +16,6 @@ def get_version(short=False):
     return ''.join(vers)
 
 __version__ = get_version()
+
+# used by Django 1.7+ to warm the field plans once all models are loaded
+default_app_config = 'forkit.apps.ForkitConfig'
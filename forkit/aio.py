@@ -0,0 +1,86 @@
+"""Coroutine versions of the tools for use with ``asyncio``. Requires Python
+3.4, the Django versions forkit supports limit this to Django 1.5 to 1.7.
+The module is written without syntax new to Python 3, so the package still
+byte-compiles on Python 2, where it cannot be imported.
+
+Each call runs as a whole in a worker thread: the traversal reads the
+reference tree and the commit runs within a transaction on the worker's own
+database connection, so the event loop is never blocked. The number of calls
+running at once is bounded by the number of workers, ``FORKIT_ASYNC_WORKERS``
+(4 by default). Calls do not share any state and can be awaited concurrently.
+
+    fork = yield from afork(reference, deep=True)
+"""
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from django import db
+from django.conf import settings
+from forkit import tools
+
+_executor = None
+_lock = threading.Lock()
+
+def get_executor():
+    "Returns the executor shared by all calls, creating it on first use."
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings,
+                    'FORKIT_ASYNC_WORKERS', 4))
+    return _executor
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # connections of worker threads are not cleaned up by the request
+        # cycle, close them if they are broken or past their lifetime
+        if hasattr(db, 'close_old_connections'):
+            db.close_old_connections()
+
+# ``get_running_loop`` is new in Python 3.7. within a coroutine
+# ``get_event_loop`` returns the running loop as of Python 3.5.3, on earlier
+# versions the loop running the call must be the current event loop
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+def _run(func, args, kwargs):
+    """Runs ``func`` on ``executor``, or the shared executor, and returns a
+    future of it's result. Called by the coroutines once they are awaited, so
+    the call is scheduled on the loop running the coroutine.
+    """
+    executor = kwargs.pop('executor', None) or get_executor()
+    return _running_loop().run_in_executor(executor,
+        partial(_call, func, args, kwargs))
+
+# the coroutines return the future of the call, which ``asyncio.coroutine``
+# waits for
+
+@asyncio.coroutine
+def afork(reference, **kwargs):
+    "Awaitable ``forkit.tools.fork``."
+    return _run(tools.fork, (reference,), kwargs)
+
+@asyncio.coroutine
+def afork_many(references, **kwargs):
+    """Awaitable ``forkit.tools.fork_many``. A ``QuerySet`` is evaluated in
+    the worker as well.
+    """
+    return _run(tools.fork_many, (references,), kwargs)
+
+@asyncio.coroutine
+def areset(reference, instance, **kwargs):
+    "Awaitable ``forkit.tools.reset``."
+    return _run(tools.reset, (reference, instance), kwargs)
+
+@asyncio.coroutine
+def adiff(reference, instance, **kwargs):
+    "Awaitable ``forkit.tools.diff``."
+    return _run(tools.diff, (reference, instance), kwargs)
+
+@asyncio.coroutine
+def acommit(instance, **kwargs):
+    "Awaitable ``forkit.tools.commit``."
+    return _run(tools.commit, (instance,), kwargs)
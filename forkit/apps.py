@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+from forkit import plans
+
+class ForkitConfig(AppConfig):
+    name = 'forkit'
+    verbose_name = 'Forkit'
+
+    def ready(self):
+        # compile the field plans for all models up front
+        plans.warm()
@@ -0,0 +1,6 @@
+"""Benchmarks for the tool functions over generated object graphs. Run using:
+
+    python -m forkit.benchmarks [--output results.json]
+
+See ``forkit.benchmarks.runner`` for the available options.
+"""
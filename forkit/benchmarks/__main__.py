@@ -0,0 +1,12 @@
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'forkit.benchmarks.settings')
+
+import django
+# the application registry must be populated before the models are imported
+if hasattr(django, 'setup'):
+    django.setup()
+
+from forkit.benchmarks.runner import main
+
+main()
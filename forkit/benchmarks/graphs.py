@@ -0,0 +1,56 @@
+import random
+from forkit.benchmarks.models import Node, Label
+
+# name: (fanout, depth, cycles, width)
+SCENARIOS = {
+    'wide': (50, 2, 0, 0),
+    'deep': (1, 500, 0, 0),
+    'cyclic': (3, 4, 0.5, 0),
+    'many2many': (4, 3, 0, 10),
+}
+
+def build(fanout, depth, cycles=0, width=0, seed=0):
+    """Creates a tree of ``Node``s ``depth`` levels deep, each node having
+    ``fanout`` children. ``cycles`` is the fraction of nodes which link back
+    to a random ancestor and ``width`` is the number of labels each node is
+    related to, chosen from a pool twice that size. Returns the root node.
+    """
+    rand = random.Random(seed)
+
+    labels = [Label.objects.create(name='label {0}'.format(i))
+        for i in range(width * 2)]
+
+    count = [0]
+    def create(parent, ancestors):
+        count[0] += 1
+        node = Node(title='node {0}'.format(count[0]), value=count[0],
+            parent=parent)
+        if ancestors and rand.random() < cycles:
+            node.link = rand.choice(ancestors)
+        node.save()
+        if width:
+            node.labels = rand.sample(labels, width)
+        return node
+
+    root = create(None, [])
+    level = [(root, [root])]
+
+    for i in range(depth):
+        next_level = []
+        for parent, ancestors in level:
+            for j in range(fanout):
+                node = create(parent, ancestors)
+                next_level.append((node, ancestors + [node]))
+        level = next_level
+
+    return root
+
+def nodes(root):
+    "Returns all nodes of the tree rooted at ``root`` keyed by title."
+    tree = {}
+    level = [root]
+    while level:
+        for node in level:
+            tree[node.title] = node
+        level = list(Node.objects.filter(parent__in=level))
+    return tree
@@ -0,0 +1,21 @@
+from django.db import models
+from forkit.models import ForkableModel
+
+class Label(ForkableModel):
+    name = models.CharField(max_length=30)
+
+    def __unicode__(self):
+        return u'{0}'.format(self.name)
+
+
+class Node(ForkableModel):
+    title = models.CharField(max_length=50)
+    value = models.IntegerField(default=0)
+    # the tree itself, traversed by deep forks in both directions
+    parent = models.ForeignKey('self', null=True, related_name='children')
+    # points back up the tree, creating cycles
+    link = models.ForeignKey('self', null=True, related_name='linked')
+    labels = models.ManyToManyField(Label, related_name='nodes')
+
+    def __unicode__(self):
+        return u'{0}'.format(self.title)
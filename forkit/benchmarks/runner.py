@@ -0,0 +1,161 @@
+"""Runs the benchmark scenarios and reports the wall time, number of queries,
+objects per second and peak memory (Python 3 only, using ``tracemalloc``) for
+each phase.
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import django
+from django.db import connection, reset_queries
+import forkit
+from forkit import tools
+from forkit.benchmarks import graphs
+from forkit.benchmarks.models import Node, Label
+
+def _rows():
+    return Node.objects.count() + Label.objects.count()
+
+def measure(func, objects=None):
+    """Calls ``func`` and returns the metrics for the call. ``objects`` is the
+    number of objects processed, or a function returning it which is called
+    after ``func``.
+    """
+    reset_queries()
+    if tracemalloc:
+        tracemalloc.start()
+
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+
+    peak = None
+    if tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    queries = len(connection.queries)
+
+    if callable(objects):
+        objects = objects()
+
+    return {
+        'time': elapsed,
+        'queries': queries,
+        'objects': objects,
+        'objects_per_sec': elapsed and objects / elapsed or None,
+        'peak_memory': peak,
+    }
+
+def _created():
+    "Returns a function which counts the rows created since it was called."
+    rows = _rows()
+    return lambda: _rows() - rows
+
+def run_scenario(fanout, depth, cycles=0, width=0, seed=0):
+    "Builds the graph and runs each phase against it."
+    root = graphs.build(fanout, depth, cycles, width, seed)
+    references = graphs.nodes(root)
+    results = {}
+
+    results['fork'] = measure(lambda: tools.fork(root, deep=True), _created())
+    results['fork_bulk'] = measure(lambda: tools.fork(root, deep=True,
+        bulk=True, prefetch=True), _created())
+    results['fork_sql'] = measure(lambda: tools.fork(root, deep=True,
+        engine='sql'), _created())
+
+    # the traversal and commit of a single fork, measured separately
+    forks = []
+    results['traverse'] = measure(lambda: forks.append(tools.fork(root,
+        deep=True, commit=False)), len(references))
+    results['commit'] = measure(lambda: tools.commit(forks[0]), _created())
+
+    instances = graphs.nodes(Node.objects.get(pk=forks[0].pk))
+    pairs = [(references[title], instances[title]) for title in references]
+
+    def diff():
+        for reference, instance in pairs:
+            tools.diff(reference, instance)
+    results['diff'] = measure(diff, len(pairs))
+
+    results['diff_queryset'] = measure(lambda: tools.diff_queryset(pairs),
+        len(pairs))
+
+    def reset():
+        for reference, instance in pairs:
+            tools.reset(reference, instance)
+    results['reset'] = measure(reset, len(pairs))
+
+    return {
+        'params': {
+            'fanout': fanout,
+            'depth': depth,
+            'cycles': cycles,
+            'width': width,
+            'seed': seed,
+        },
+        'nodes': len(references),
+        'results': results,
+    }
+
+def report(name, scenario, stream=sys.stdout):
+    stream.write('{0} ({1} nodes)\n'.format(name, scenario['nodes']))
+    for phase, metrics in sorted(scenario['results'].items()):
+        stream.write('  {0:<15}{1:>10.3f}s{2:>8} queries{3:>12} obj/s{4}\n'.format(
+            phase, metrics['time'], metrics['queries'],
+            '{0:.0f}'.format(metrics['objects_per_sec'] or 0),
+            metrics['peak_memory'] is not None and
+                '{0:>12} bytes peak'.format(metrics['peak_memory']) or ''))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m forkit.benchmarks',
+        description='Benchmarks the forkit tools over generated object graphs.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+        help='one or more of: {0} (default: all)'.format(
+            ', '.join(sorted(graphs.SCENARIOS))))
+    parser.add_argument('--fanout', type=int,
+        help='run a custom scenario with this many children per node')
+    parser.add_argument('--depth', type=int, default=3,
+        help='the depth of the custom scenario')
+    parser.add_argument('--cycles', type=float, default=0,
+        help='the fraction of nodes linking back to an ancestor')
+    parser.add_argument('--width', type=int, default=0,
+        help='the number of many-to-many labels per node')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    scenarios = {}
+    if args.fanout is not None:
+        scenarios['custom'] = (args.fanout, args.depth, args.cycles, args.width)
+    for name in args.scenarios or (not scenarios and graphs.SCENARIOS) or ():
+        if name not in graphs.SCENARIOS:
+            parser.error('unknown scenario: {0}'.format(name))
+        scenarios[name] = graphs.SCENARIOS[name]
+
+    connection.creation.create_test_db(verbosity=0)
+
+    results = {
+        'forkit': forkit.get_version(),
+        'django': django.get_version(),
+        'python': platform.python_version(),
+        'scenarios': {},
+    }
+
+    for name, params in sorted(scenarios.items()):
+        scenario = run_scenario(*params, seed=args.seed)
+        results['scenarios'][name] = scenario
+        report(name, scenario)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=4, sort_keys=True)
+
+    return results
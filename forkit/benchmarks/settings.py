@@ -0,0 +1,15 @@
+DEBUG = True
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = (
+    'forkit',
+    'forkit.benchmarks',
+)
+
+SECRET_KEY = 'forkit-benchmarks'
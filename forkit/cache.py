@@ -0,0 +1,201 @@
+"""Caches the reference trees loaded by the prefetch planner, so repeated
+forks of the same reference skip reading it. A tree is cached per reference
+and configuration, and the number of objects held by all trees is bounded by
+``FORKIT_CACHE_OBJECTS`` (10000 by default), the least recently used trees
+are discarded first.
+
+Trees are discarded when ``post_save``, ``post_delete`` or ``m2m_changed`` is
+sent for one of their objects, for an object whose foreign key points to an
+object of the tree through a reverse relation the tree was loaded through, or
+for many-to-many links of the tree. Objects which are unrelated to the tree,
+e.g. the forks created from it, leave it intact. Changes which do not send
+signals, e.g. ``QuerySet.update``, are not noticed and require ``clear``.
+"""
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Q, signals
+from forkit import plans
+from forkit.prefetch import prefetch_model_objects
+
+
+def _tree_keys(objs):
+    """Returns the keys of the changes which invalidate the tree of ``objs``:
+    changes of the objects themselves, foreign keys pointing to the objects
+    through the reverse relations that were loaded, and many-to-many links
+    of the objects.
+    """
+    keys = set()
+    for obj in objs:
+        keys.add(('obj', obj.__class__, obj.pk))
+
+        for accessor in getattr(obj, '_prefetched', ()):
+            plan_field = plans.get_plan(obj.__class__).field(accessor)
+            field = plan_field.field
+
+            if plan_field.m2m:
+                keys.add(('m2m', field.rel.through, obj.__class__, obj.pk))
+                keys.add(('through', field.rel.through))
+            elif not plan_field.direct:
+                value = getattr(obj, field.rel.get_related_field().attname)
+                keys.add(('fk', field.model, field.attname, value))
+    return keys
+
+
+class GraphCache(object):
+    "A least recently used cache of prefetched reference trees."
+    def __init__(self, max_objects):
+        self.max_objects = max_objects
+        self._lock = threading.Lock()
+        # cache key -> (root, invalidation keys, number of objects)
+        self._trees = OrderedDict()
+        # invalidation key -> cache keys of the trees it invalidates
+        self._index = {}
+        self._objects = 0
+        self._connected = False
+
+    def __len__(self):
+        return len(self._trees)
+
+    def get(self, key):
+        "Returns the root of the tree cached for ``key``, or ``None``."
+        with self._lock:
+            tree = self._trees.pop(key, None)
+            if tree is None:
+                return None
+            self._trees[key] = tree
+            return tree[0]
+
+    def set(self, key, root, objs):
+        "Caches the tree of ``root``, consisting of ``objs``."
+        tree_keys = _tree_keys(objs)
+
+        with self._lock:
+            self._connect()
+            self._discard(key)
+
+            self._trees[key] = (root, tree_keys, len(objs))
+            self._objects += len(objs)
+            for tree_key in tree_keys:
+                self._index.setdefault(tree_key, set()).add(key)
+
+            # the tree just added is kept even if it exceeds the budget
+            while self._objects > self.max_objects and len(self._trees) > 1:
+                self._discard(next(iter(self._trees)))
+
+    def _discard(self, key):
+        tree = self._trees.pop(key, None)
+        if tree is None:
+            return
+        root, tree_keys, size = tree
+        self._objects -= size
+        for tree_key in tree_keys:
+            keys = self._index[tree_key]
+            keys.discard(key)
+            if not keys:
+                del self._index[tree_key]
+
+    def invalidate(self, tree_keys):
+        "Discards the trees invalidated by any of ``tree_keys``."
+        with self._lock:
+            for tree_key in tree_keys:
+                for key in list(self._index.get(tree_key, ())):
+                    self._discard(key)
+
+    def clear(self):
+        "Discards all trees."
+        with self._lock:
+            self._trees.clear()
+            self._index.clear()
+            self._objects = 0
+
+    def _connect(self):
+        if self._connected:
+            return
+        uid = 'forkit.cache.{0}'.format(id(self))
+        signals.post_save.connect(self._changed, weak=False, dispatch_uid=uid)
+        signals.post_delete.connect(self._changed, weak=False, dispatch_uid=uid)
+        signals.m2m_changed.connect(self._links_changed, weak=False,
+            dispatch_uid=uid)
+        self._connected = True
+
+    def _changed(self, sender, instance, **kwargs):
+        if not self._trees:
+            return
+        tree_keys = [('obj', sender, instance.pk)]
+        # the object may have joined a tree
+        for field in instance._meta.fields:
+            if field.rel is not None:
+                tree_keys.append(('fk', field.model, field.attname,
+                    getattr(instance, field.attname)))
+        self.invalidate(tree_keys)
+
+    def _links_changed(self, sender, instance, model, pk_set, **kwargs):
+        if not self._trees or not kwargs.get('action', '').startswith('post_'):
+            return
+        # all links of the other side may have been cleared
+        if pk_set is None:
+            tree_keys = [('through', sender)]
+        else:
+            tree_keys = [('m2m', sender, model, pk) for pk in pk_set]
+        tree_keys.append(('m2m', sender, instance.__class__, instance.pk))
+        self.invalidate(tree_keys)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    "Returns the cache shared by all forks, creating it on first use."
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = GraphCache(getattr(settings, 'FORKIT_CACHE_OBJECTS', 10000))
+    return _cache
+
+def clear():
+    "Discards all cached trees."
+    get_cache().clear()
+
+def _freeze_rule(value):
+    """Returns ``value`` as part of a cache key. ``Q`` objects are keyed by
+    their lookups. Predicates are keyed by identity: the key holds on to
+    them, so a later function cannot take their place at the same address.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted([(str(key), _freeze_rule(rule))
+            for key, rule in value.items()], key=lambda item: item[0]))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple([_freeze_rule(rule) for rule in value])
+    if isinstance(value, Q):
+        return (Q, str(value))
+    return value
+
+def _freeze(rules):
+    "Returns ``model_exclude`` or ``follow`` as part of a cache key."
+    if not rules:
+        return None
+    return _freeze_rule(rules)
+
+def load(reference, fields=None, exclude=('pk',), deep=False, workers=None,
+        max_depth=None, model_exclude=None, follow=None):
+    """Returns a copy of ``reference`` with it's tree loaded by the prefetch
+    planner, from the cache if possible. The copy is shared by all forks
+    using the cache and must not be changed. Trees loaded with ``follow``
+    are only shared by forks using the same filters and the same predicate
+    functions, not merely equal ones.
+    """
+    model = reference.__class__
+    key = (plans._model_label(model), reference.pk, deep,
+        fields and tuple(fields), exclude and tuple(exclude), max_depth,
+        _freeze(model_exclude), _freeze(follow))
+
+    cache = get_cache()
+    root = cache.get(key)
+    if root is None:
+        root = model._default_manager.get(pk=reference.pk)
+        objs = prefetch_model_objects([root], fields, exclude, deep, workers,
+            max_depth, model_exclude, follow)
+        cache.set(key, root, objs)
+    return root
@@ -0,0 +1,158 @@
+"""Commits a fork in bounded transactions rather than a single one. Objects
+are committed level by level, in the order of dependency, ``chunk_size`` at a
+time. Each chunk records the primary keys of it's forks in a checkpoint
+within the same transaction, so a fork which is interrupted can be resumed by
+forking the reference again with the same checkpoint key. Only the objects
+which have not been committed are inserted.
+
+The checkpoint is marked complete once the many-to-many links have been
+written by the final transaction.
+"""
+from django.db import router, transaction
+from forkit import utils, signals, plans
+from forkit.commit import _collect_commits, _commit_levels, _batches, \
+    _send_batches, _defer_links
+
+def _key(obj):
+    return plans._model_label(obj.__class__), u'{0}'.format(obj.pk)
+
+@transaction.commit_on_success
+def get_checkpoint(key, reference):
+    """Returns the checkpoint ``key`` for forking ``reference``, creating it
+    if it does not exist.
+    """
+    # imported here since ``forkit.models`` depends on the tools
+    from forkit.models import ForkCheckpoint
+
+    model, pk = _key(reference)
+    checkpoint, created = ForkCheckpoint.objects.get_or_create(key=key,
+        defaults={'model': model, 'reference': pk})
+
+    if checkpoint.model != model or checkpoint.reference != pk:
+        raise ValueError('The checkpoint {0} belongs to the fork of another '
+            'object'.format(key))
+    return checkpoint
+
+def get_fork(checkpoint, model):
+    "Returns the root fork of a complete ``checkpoint``."
+    return model._default_manager.get(pk=checkpoint.fork)
+
+def _restore(obj, pk):
+    "Marks ``obj`` as committed by a previous attempt."
+    model = obj.__class__
+    obj.pk = model._meta.pk.to_python(pk)
+    obj._state.adding = False
+    obj._state.db = router.db_for_write(model)
+
+def _commit_chunk(context, checkpoint, model, objs):
+    """Commits ``objs`` of type ``model`` within a single transaction, along
+    with their checkpoint entries.
+    """
+    for obj in objs:
+        # all direct dependencies are on a lower level and have been saved
+        for accessor, value in obj._commits.direct.items():
+            setattr(obj, accessor, value)
+        obj._commits.direct = {}
+
+    # objects committed by a previous attempt
+    inserts = [obj for obj in objs if obj._state.adding]
+    if not inserts:
+        return
+
+    for obj in inserts:
+        reference = obj._commits.reference
+        if context.listening(signals.pre_commit, reference.__class__):
+            with context.timer(reference.__class__, 'signals'):
+                signals.pre_commit.send(sender=reference.__class__,
+                    reference=reference, instance=obj, **context.kwargs)
+
+    with context.timer(model, 'commit'):
+        with transaction.commit_on_success():
+            utils._bulk_insert(model, inserts)
+
+            entries = []
+            for obj in inserts:
+                label, old = _key(obj._commits.reference)
+                entries.append(checkpoint.entries.model(checkpoint=checkpoint,
+                    model=label, old=old, new=u'{0}'.format(obj.pk)))
+                if obj is context.root:
+                    checkpoint.fork = entries[-1].new
+                    checkpoint.save()
+            utils._bulk_insert(checkpoint.entries.model, entries, pks=False)
+
+    context.count(model, 'inserted', len(inserts))
+
+    for obj in inserts:
+        reference = obj._commits.reference
+        if context.listening(signals.post_commit, reference.__class__):
+            with context.timer(reference.__class__, 'signals'):
+                signals.post_commit.send(sender=reference.__class__,
+                    reference=reference, instance=obj, **context.kwargs)
+
+def commit_model_object(instance, checkpoint, chunk_size=500, memo=None,
+        stats=None, **kwargs):
+    """Commits the fork ``instance`` and all pending objects reachable from
+    it in chunks, recording the progress in ``checkpoint``. Objects found in
+    the checkpoint are not inserted again. ``pre_commit`` and ``post_commit``
+    are sent around each chunk. Many-to-many links are written last.
+    """
+    if memo is None:
+        memo = utils.Memo()
+
+    batches = _batches(signals.pre_commit_batch, signals.post_commit_batch,
+        [instance], memo)
+    _send_batches(signals.pre_commit_batch, batches, **kwargs)
+
+    context = utils.Context(memo=memo, stats=stats, **kwargs)
+    context.root = instance
+
+    pending = _collect_commits([instance], memo)
+    levels = _commit_levels(pending)
+
+    done = dict([((entry.model, entry.old), entry.new)
+        for entry in checkpoint.entries.all()])
+
+    groups = {}
+    for obj in pending:
+        memo.add(obj._commits.reference, obj)
+
+        key = _key(obj._commits.reference)
+        if key in done:
+            _restore(obj, done[key])
+
+        groups.setdefault((levels[id(obj)], obj.__class__), []).append(obj)
+
+    for key in sorted(groups.keys(), key=lambda key: key[0]):
+        for chunk in utils._chunks(groups[key], chunk_size):
+            _commit_chunk(context, checkpoint, key[1], chunk)
+
+    with transaction.commit_on_success():
+        links = utils.Links()
+
+        for obj in pending:
+            relations = list(obj._commits.related.items())
+            obj._commits.related = {}
+
+            # deferred related objects were committed as part of a chunk,
+            # only non-deferred relations (e.g. many-to-many) need to be set.
+            # links are only written by the final transaction, so none exist
+            # for objects committed by a previous attempt
+            for accessor, value in relations:
+                if not isinstance(value, utils.DeferredCommit):
+                    if not _defer_links(links, obj, accessor, value, True):
+                        setattr(obj, accessor, value)
+
+        with context.timer(instance.__class__, 'commit'):
+            links.write(memo)
+
+        checkpoint.fork = u'{0}'.format(instance.pk)
+        checkpoint.complete = True
+        checkpoint.save()
+        checkpoint.entries.all().delete()
+
+    for obj in pending:
+        del obj._commits
+
+    _send_batches(signals.post_commit_batch, batches, **kwargs)
+    memo.release()
+    return instance
@@ -1,82 +1,385 @@
+import django
 from django.db import models, transaction
-from forkit import utils, signals
+from forkit import utils, signals, plans
+from forkit.stats import collect_stats
 
-def _commit_direct(instance, memo, **kwargs):
-    """Recursively set all direct related object references to the
-    instance object. Each downstream related object is saved before
-    being set.
+# ``save(update_fields=...)`` is not available in all versions of Django
+_update_fields = django.VERSION >= (1, 5)
+
+def _set_direct(instance, relations):
+    """Sets the direct related objects on ``instance``. Changes are tracked
+    for objects which have been reset.
     """
-    # get and clear to prevent infinite recursion
-    relations = instance._commits.direct.items()
-    instance._commits.direct = {}
+    changed = instance._commits.changed
+    if changed is None or instance._state.adding:
+        for accessor, value in relations:
+            setattr(instance, accessor, value)
+        return
 
+    plan = plans.get_plan(instance.__class__)
     for accessor, value in relations:
-        _memoize_commit(value, memo=memo, **kwargs)
-        # save the object to get a primary key
+        attname = plan.field(accessor).field.attname
+        previous = getattr(instance, attname)
         setattr(instance, accessor, value)
+        if getattr(instance, attname) != previous:
+            changed.add(plan.field(accessor).field.name)
+
+def _save(instance):
+    """Saves ``instance`` and returns true if it was written. Objects which
+    have been reset are only saved if any of their fields changed, and then
+    only those fields where supported.
+    """
+    changed = instance._commits.changed
+    if changed is None or instance._state.adding:
+        instance.save()
+    elif not changed:
+        return False
+    elif _update_fields:
+        instance.save(update_fields=sorted(changed))
+    else:
+        instance.save()
+    return True
+
+def _commit_direct(context, instance, relations):
+    """Sets all direct related object references on the instance object and
+    saves it. Each downstream related object has been committed beforehand.
+    """
+    _set_direct(instance, relations)
 
-def _commit_related(instance, memo, stack, **kwargs):
-    relations = instance._commits.related.items()
+    created = instance._state.adding
+    with context.timer(instance.__class__, 'commit'):
+        saved = _save(instance)
+    if saved:
+        context.count(instance.__class__, created and 'inserted' or 'updated')
+
+    # get and clear to prevent infinite recursion
+    related = list(instance._commits.related.items())
     instance._commits.related = {}
 
-    for accessor, value in relations:
-        # execute the commit direct cycle for these related objects,
-        if isinstance(value, utils.DeferredCommit):
-            value = value.value
-            if type(value) is list:
-                stack.extend(value)
-            else:
-                stack.append(value)
+    # the post-signal is sent once all related objects have been committed
+    context.push(_post_commit, instance)
+
+    for accessor, value in reversed(related):
+        _commit_related(context, instance, accessor, value, created)
+
+def _reconcile(links, deletes, instance, accessor, value):
+    """Queues the changes to the related objects of a reset ``instance``.
+    Returns the related objects to be committed.
+    """
+    plan_field = plans.get_plan(instance.__class__).field(accessor)
+    if plan_field.kind == plans.MANY2MANY:
+        links.reconcile(instance, plan_field, value.added, value.removed)
+        return value.matched
+
+    deletes.extend(value.removed)
+    return value.added + value.matched
+
+def _commit_related(context, instance, accessor, value, created):
+    # new related objects of a reset object are committed along with the
+    # deferred related objects
+    if isinstance(value, utils.Reconcile):
+        context.deferred.extend(_reconcile(context.links, context.deletes,
+            instance, accessor, value))
+        return
+
+    # deferred related objects are committed once the rest of the tree has
+    # been committed
+    if isinstance(value, utils.DeferredCommit):
+        value = value.value
+        if type(value) is list:
+            context.deferred.extend(value)
         else:
-            if type(value) is list:
-                map(lambda rel: _memoize_commit(rel, memo=memo, **kwargs), value)
-            elif isinstance(value, models.Model):
-                _memoize_commit(value, memo=memo, **kwargs)
+            context.deferred.append(value)
+        return
 
-            setattr(instance, accessor, value)
+    # many-to-many links are written together once all objects have been
+    # committed, otherwise commit each related object before setting them
+    # on the instance
+    if not _defer_links(context.links, instance, accessor, value, created):
+        context.push(_set_related, instance, accessor, value)
+
+    if type(value) is list:
+        for rel in reversed(value):
+            context.push(_memoize_commit, rel)
+    elif isinstance(value, models.Model):
+        context.push(_memoize_commit, value)
+
+def _set_related(context, instance, accessor, value):
+    setattr(instance, accessor, value)
 
-def _memoize_commit(instance, **kwargs):
+def _defer_links(links, instance, accessor, value, created):
+    """Adds the many-to-many links for ``accessor`` to ``links``. Returns
+    ``False`` if ``accessor`` is not a many-to-many with an auto-created
+    through table.
+    """
+    plan_field = plans.get_plan(instance.__class__).field(accessor)
+    if plan_field.kind != plans.MANY2MANY or \
+            not plan_field.field.rel.through._meta.auto_created:
+        return False
+
+    links.defer(instance, plan_field, value, created=created)
+    return True
+
+def _post_commit(context, instance):
+    # the root object is the last to be done. commit all deferred objects
+    # before it is considered to be committed
+    if instance is context.root and context.deferred:
+        context.push(_post_commit, instance)
+        for value in reversed(context.deferred):
+            context.push(_memoize_commit, value)
+        context.deferred = []
+        return
+
+    if instance is context.root:
+        with context.timer(instance.__class__, 'commit'):
+            context.links.write(context.memo)
+            utils._bulk_delete(context.deletes)
+        context.deletes = []
+
+    reference = instance._commits.reference
+    if context.listening(signals.post_commit, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.post_commit.send(sender=reference.__class__,
+                reference=reference, instance=instance, **context.kwargs)
+
+    # releases the reference and the compiled fields
+    del instance._commits
+
+    # the objects depending on the instance have been committed as well, or
+    # hold on to it themselves, so the memo only needs it's primary key
+    context.memo.release([reference])
+
+def _memoize_commit(context, instance):
+    "Queues ``instance`` to be committed after it's direct related objects."
     if not hasattr(instance, '_commits'):
-        return instance
+        return
 
     reference = instance._commits.reference
 
-    root = False
-    memo = kwargs.pop('memo', None)
-    stack = kwargs.pop('stack', [])
+    # for every object, keep track of the reference and the instance being
+    # acted on. this ensures relationships that follow back up the tree are
+    # caught and are merely referenced rather than traversed again.
+    if context.memo.has(reference):
+        return
+
+    context.memo.add(reference, instance)
 
-    # for every call, keep track of the reference and the instance being
-    # acted on. this is used for recursive calls to related objects. this
-    # ensures relationships that follow back up the tree are caught and are
-    # merely referenced rather than traversed again.
+    # pre-signal
+    if context.listening(signals.pre_commit, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.pre_commit.send(sender=reference.__class__,
+                reference=reference, instance=instance, **context.kwargs)
+
+    # get and clear to prevent infinite recursion
+    relations = list(instance._commits.direct.items())
+    instance._commits.direct = {}
+
+    # commit all dependencies first, save it, then travese dependents
+    context.push(_commit_direct, instance, relations)
+    for accessor, value in reversed(relations):
+        context.push(_memoize_commit, value)
+
+def _pending_objects(value):
+    "Returns the uncommitted objects contained in a deferred value."
+    if isinstance(value, utils.DeferredCommit):
+        value = value.value
+    elif isinstance(value, utils.Reconcile):
+        value = value.added + value.matched
+    if type(value) is not list:
+        value = [value]
+    return [obj for obj in value if hasattr(obj, '_commits')]
+
+def _collect_commits(instances, memo):
+    """Walks the deferred commit queues starting at each of ``instances`` and
+    returns every object which has not yet been committed. Objects whose
+    reference is in ``memo`` have already been committed.
+    """
+    seen = set()
+    pending = []
+    stack = _pending_objects(list(reversed(instances)))
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or memo.has(obj._commits.reference):
+            continue
+        seen.add(id(obj))
+        pending.append(obj)
+
+        for value in list(obj._commits.direct.values()) + \
+                list(obj._commits.related.values()):
+            stack.extend(_pending_objects(value))
+
+    return pending
+
+def _commit_levels(pending):
+    """Assigns each pending object a level one greater than the deepest
+    direct dependency it has. All objects on a level can be inserted together
+    once the levels below it have been. Direct relations which loop back to an
+    object already being leveled are ignored, as with ``_commit_direct``.
+    """
+    levels = {}
+
+    for obj in pending:
+        stack = [(obj, False)]
+
+        while stack:
+            current, expanded = stack.pop()
+            key = id(current)
+            deps = []
+            for value in current._commits.direct.values():
+                deps.extend(_pending_objects(value))
+
+            if not expanded:
+                if key in levels:
+                    continue
+                # mark as in progress
+                levels[key] = None
+                stack.append((current, True))
+                stack.extend([(dep, False) for dep in deps])
+                continue
+
+            level = 0
+            for dep in deps:
+                if levels.get(id(dep)) is not None:
+                    level = max(level, levels[id(dep)] + 1)
+            levels[key] = level
+
+    return levels
+
+def _batches(pre, post, instances, memo=None):
+    """Groups the pending objects reachable from ``instances`` by model as
+    (reference, instance) pairs, for sending the ``pre`` and ``post`` batch
+    signals. Returns ``None`` if neither signal has any receivers.
+    """
+    if not pre.receivers and not post.receivers:
+        return None
+
+    batches = {}
+    for obj in _collect_commits(instances, memo or utils.Memo()):
+        batches.setdefault(obj.__class__, []).append((obj._commits.reference, obj))
+    return batches
+
+def _send_batches(signal, batches, **kwargs):
+    "Sends ``signal`` once per model in ``batches``."
+    if batches:
+        for model, pairs in batches.items():
+            signal.send(sender=model, pairs=pairs, **kwargs)
+
+def _bulk_commit(context, instances):
+    """Commits all pending objects reachable from ``instances``. Objects are
+    grouped by level and model so each group is inserted using a single
+    multi-row insert rather than one ``save()`` per object.
+    """
+    memo = context.memo
+    pending = _collect_commits(instances, memo)
+    levels = _commit_levels(pending)
+
+    for obj in pending:
+        memo.add(obj._commits.reference, obj)
+
+    for obj in pending:
+        reference = obj._commits.reference
+        if context.listening(signals.pre_commit, reference.__class__):
+            with context.timer(reference.__class__, 'signals'):
+                signals.pre_commit.send(sender=reference.__class__,
+                    reference=reference, instance=obj, **context.kwargs)
+
+    groups = {}
+    for obj in pending:
+        groups.setdefault((levels[id(obj)], obj.__class__), []).append(obj)
+
+    created = set()
+
+    for key in sorted(groups.keys(), key=lambda key: key[0]):
+        model = key[1]
+        inserts = []
+        updated = 0
+
+        with context.timer(model, 'commit'):
+            for obj in groups[key]:
+                # all direct dependencies are on a lower level and have been
+                # saved
+                _set_direct(obj, obj._commits.direct.items())
+                obj._commits.direct = {}
+
+                if obj._state.adding:
+                    created.add(id(obj))
+                    inserts.append(obj)
+                elif _save(obj):
+                    updated += 1
+
+            utils._bulk_insert(model, inserts)
+
+        context.count(model, 'inserted', len(inserts))
+        context.count(model, 'updated', updated)
+
+    links = utils.Links()
+    deletes = []
+
+    for obj in pending:
+        relations = list(obj._commits.related.items())
+        obj._commits.related = {}
+
+        # deferred related objects were committed as part of a group, only
+        # non-deferred relations (e.g. many-to-many) need to be set
+        for accessor, value in relations:
+            if isinstance(value, utils.Reconcile):
+                _reconcile(links, deletes, obj, accessor, value)
+            elif not isinstance(value, utils.DeferredCommit):
+                if not _defer_links(links, obj, accessor, value, id(obj) in created):
+                    setattr(obj, accessor, value)
+
+    if instances:
+        with context.timer(instances[0].__class__, 'commit'):
+            links.write(memo)
+            utils._bulk_delete(deletes)
+
+    for obj in pending:
+        reference = obj._commits.reference
+        if context.listening(signals.post_commit, reference.__class__):
+            with context.timer(reference.__class__, 'signals'):
+                signals.post_commit.send(sender=reference.__class__,
+                    reference=reference, instance=obj, **context.kwargs)
+        del obj._commits
+
+def _commit(instances, bulk=False, memo=None, stats=None, **kwargs):
     if memo is None:
-        root = True
         memo = utils.Memo()
-    elif memo.has(reference):
-        return memo.get(reference)
 
-    memo.add(reference, instance)
+    batches = _batches(signals.pre_commit_batch, signals.post_commit_batch,
+        instances, memo)
+    _send_batches(signals.pre_commit_batch, batches, **kwargs)
 
-    # pre-signal
-    signals.pre_commit.send(sender=reference.__class__, reference=reference,
-        instance=instance, **kwargs)
+    context = utils.Context(memo=memo, stats=stats, **kwargs)
 
-    # commit all dependencies first, save it, then travese dependents
-    _commit_direct(instance, memo=memo, **kwargs)
-    instance.save()
-    _commit_related(instance, memo=memo, stack=stack, **kwargs)
+    if bulk:
+        _bulk_commit(context, instances)
+    else:
+        for instance in instances:
+            context.root = instance
+            _memoize_commit(context, instance)
+            context.run()
 
-    if root:
-        for value in iter(stack):
-            _memoize_commit(value, memo=memo, stack=[], **kwargs)
+    _send_batches(signals.post_commit_batch, batches, **kwargs)
 
-    # post-signal
-    signals.post_commit.send(sender=reference.__class__, reference=reference,
-        instance=instance, **kwargs)
+    # committed objects are only needed for their primary keys from here on
+    memo.release()
 
+@collect_stats('commit')
+@transaction.commit_on_success
+def commit_model_object(instance, **kwargs):
+    """Recursively commits direct and related objects. If ``bulk`` is true,
+    objects are inserted in batches per model rather than one at a time.
+    """
+    _commit([instance], **kwargs)
     return instance
 
+@collect_stats('commit_many')
 @transaction.commit_on_success
-def commit_model_object(instance, **kwargs):
-    "Recursively commits direct and related objects."
-    return _memoize_commit(instance, **kwargs)
+def commit_model_objects(instances, **kwargs):
+    """Commits each object in ``instances`` within a single transaction.
+    Related objects shared between them are only committed once. If a
+    ``memo`` is supplied, objects committed by previous calls are skipped.
+    """
+    _commit(instances, **kwargs)
+    return instances
@@ -1,60 +1,189 @@
-from django.db import models
-from forkit import utils, signals
+from collections import namedtuple
+from django.db import connections, router
+from forkit import utils, signals, plans
+from forkit.stats import collect_stats, timer
+from forkit.explain import explain_model_object
 
-def _diff_field(reference, instance, accessor, deep, **kwargs):
+class Delta(namedtuple('Delta', ('added', 'removed'))):
+    """The difference between two sets of related objects, as the sorted
+    primary keys ``added`` to and ``removed`` from the reference's set.
+    """
+    __slots__ = ()
+
+
+def _diff_field(reference, instance, plan_field, deep, stats=None, **kwargs):
     "Returns the field's value of ``instance`` if different form ``reference``."
-    val1, field, direct, m2m = utils._get_field_value(reference, accessor)
-    val2 = utils._get_field_value(instance, accessor)[0]
+    accessor, field, direct, m2m, kind = plan_field[:5]
+    val1 = utils._get_plan_value(reference, plan_field)
+    val2 = utils._get_plan_value(instance, plan_field)
 
     # get the diff for m2m or reverse foreign keys
-    if m2m or not direct and not isinstance(field, models.OneToOneField):
-        if _diff_queryset(reference, val1, val2) is not None:
-            return {accessor: list(val2)}
+    if m2m or not direct and kind != plans.ONE2ONE:
+        delta = _diff_queryset(reference, val1, val2)
+        if delta is not None:
+            return {accessor: delta}
     # direct foreign keys and one-to-one
-    elif deep and (isinstance(field, models.ForeignKey) or isinstance(field, models.OneToOneField)):
+    elif deep and kind in (plans.FOREIGNKEY, plans.ONE2ONE):
         if val1 and val2:
-            diff = diff_model_object(val1, val2, **kwargs)
+            diff = diff_model_object(val1, val2, stats=stats, **kwargs)
             if diff:
                 return {accessor: diff}
     elif val1 != val2:
         return {accessor: val2}
     return {}
 
+def _pks(value):
+    "Returns the primary keys of ``value``, read with a single query."
+    if value is None:
+        return []
+    if type(value) is list:
+        return [obj.pk for obj in value]
+    return list(value.values_list('pk', flat=True))
+
+def _pk_order(pk):
+    "Sort key placing the primary keys of unsaved objects first."
+    return pk is not None, pk
+
 def _diff_queryset(reference, qs1, qs2):
-    "Compares two QuerySets by their primary keys."
-    # if they point to a related manager, perform the lookup and compare
-    # the primary keys
-    if qs1 and qs2:
-        pks1 = qs1.values_list('pk', flat=True)
-        pks2 = qs2.values_list('pk', flat=True)
-        if set(pks1) != set(pks2):
-            return qs2
-    # if they are different, check to see if either one is empty
-    elif qs1:
-        if qs1.count(): return qs2
-    elif qs2:
-        if qs2.count(): return qs2
-
-def _diff(reference, instance, fields=None, exclude=('pk',), deep=False, **kwargs):
-    if not fields:
-        fields = utils._default_model_fields(reference, exclude, deep=deep)
+    """Compares two QuerySets (or lists of objects) by their primary keys.
+    The keys are compared as sets, since the database may not order them
+    the way Python does (e.g. strings under a collation). Unsaved objects
+    never match. Returns a ``Delta`` or ``None`` if they contain the same
+    objects.
+    """
+    pks1, pks2 = _pks(qs1), _pks(qs2)
+    set1, set2 = set(pks1), set(pks2)
+
+    removed = [pk for pk in pks1 if pk is None or pk not in set2]
+    added = [pk for pk in pks2 if pk is None or pk not in set1]
+
+    if added or removed:
+        return Delta(sorted(added, key=_pk_order), sorted(removed, key=_pk_order))
 
+def _diff(reference, instance, fields=None, exclude=('pk',), deep=False,
+        stats=None, **kwargs):
     diff = {}
-    for accessor in fields:
-        diff.update(_diff_field(reference, instance, accessor, deep=deep, **kwargs))
+    for plan_field in utils._model_fields(reference, fields, exclude, deep):
+        diff.update(_diff_field(reference, instance, plan_field, deep=deep,
+            stats=stats, **kwargs))
 
     return diff
 
-def diff_model_object(reference, instance, **kwargs):
+@collect_stats('diff')
+def diff_model_object(reference, instance, stats=None, **kwargs):
     """Creates a diff between two model objects of the same type relative to
     ``reference``. If ``fields`` is not supplied, all local fields and many-to-many
     fields will be included. The ``pk`` field is excluded by default.
+
+    If ``explain`` is true, an estimate of the size of the diff is returned
+    instead, see ``forkit.explain``. ``'exact'`` counts each object once.
     """
+    explain = kwargs.pop('explain', False)
+    if explain:
+        return explain_model_object('diff', reference, kwargs.get('fields'),
+            kwargs.get('exclude', ('pk',)), kwargs.get('deep', False),
+            exact=explain == 'exact')
+
+    sender = reference.__class__
+
+    if stats is not None:
+        stats.count(sender, 'visited')
+
     # pre-signal
-    signals.pre_diff.send(sender=reference.__class__, reference=reference,
-        instance=instance, config=kwargs, **kwargs)
-    diff = _diff(reference, instance, **kwargs)
+    if signals.has_receivers(signals.pre_diff, sender):
+        with timer(stats, sender, 'signals'):
+            signals.pre_diff.send(sender=sender, reference=reference,
+                instance=instance, config=kwargs, **kwargs)
+
+    with timer(stats, sender, 'traversal'):
+        diff = _diff(reference, instance, stats=stats, **kwargs)
+
     # post-signal
-    signals.post_diff.send(sender=reference.__class__, reference=reference,
-        instance=instance, diff=diff, **kwargs)
+    if signals.has_receivers(signals.post_diff, sender):
+        with timer(stats, sender, 'signals'):
+            signals.post_diff.send(sender=sender, reference=reference,
+                instance=instance, diff=diff, **kwargs)
     return diff
+
+def _pair_pks(pair):
+    "Primary keys of a (reference, instance) pair of objects or primary keys."
+    return tuple([getattr(obj, 'pk', obj) for obj in pair])
+
+def diff_queryset(pairs, model=None, fields=None, exclude=('pk',), chunk_size=400):
+    """Creates diffs for many (reference, instance) pairs of ``model`` using
+    a single SQL statement per ``chunk_size`` pairs. The rows are joined on
+    the pairs of primary keys and the local columns are compared by the
+    database, so no model objects are created. Each pair may consist of
+    objects or primary keys. ``model`` is only required for the latter.
+
+    Only columns of the model's table can be compared, many-to-many and
+    reverse relationships are not supported. Returns a ``dict`` of differing
+    values of the instance keyed by the (reference, instance) primary keys.
+    Pairs which do not differ are not included, pairs whose reference or
+    instance row does not exist map to ``None``. Foreign key values are keyed
+    by the ``attname`` (e.g. ``blog_id``). No signals are sent.
+    """
+    diffs = {}
+
+    for chunk in utils._chunks(pairs, chunk_size):
+        if model is None:
+            model = chunk[0][0].__class__
+
+        plan_fields = [f for f in utils._model_fields(model, fields, exclude)
+            if f.direct and not f.m2m]
+        if not plan_fields:
+            break
+
+        connection = connections[router.db_for_read(model)]
+        qn = connection.ops.quote_name
+        columns = [qn(f.field.column) for f in plan_fields]
+
+        same = ['(r.{0} = i.{0} OR (r.{0} IS NULL AND i.{0} IS NULL))'.format(column)
+            for column in columns]
+
+        # the pairs of primary keys as a derived table
+        pks = ' UNION ALL '.join(['SELECT %s AS ref, %s AS inst'] +
+            ['SELECT %s, %s'] * (len(chunk) - 1))
+
+        # rows missing on either side are joined as nulls and reported
+        missing = 'r.{0} IS NULL OR i.{0} IS NULL'.format(
+            qn(model._meta.pk.column))
+
+        sql = ('SELECT m.ref, m.inst, CASE WHEN {missing} THEN 1 ELSE 0 END, '
+            '{select} FROM ({pks}) m '
+            'LEFT JOIN {table} r ON r.{pk} = m.ref '
+            'LEFT JOIN {table} i ON i.{pk} = m.inst '
+            'WHERE {missing} OR {where}').format(
+                missing=missing,
+                select=', '.join(['CASE WHEN {0} THEN 0 ELSE 1 END'.format(cond)
+                    for cond in same] + ['i.{0}'.format(c) for c in columns]),
+                pks=pks,
+                table=qn(model._meta.db_table),
+                pk=qn(model._meta.pk.column),
+                where=' OR '.join(['NOT {0}'.format(cond) for cond in same]))
+
+        params = []
+        for pair in chunk:
+            params.extend(_pair_pks(pair))
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+        count = len(plan_fields)
+        for row in cursor.fetchall():
+            if row[2]:
+                diffs[(row[0], row[1])] = None
+                continue
+
+            flags, values = row[3:3 + count], row[3 + count:]
+            diff = {}
+            for plan_field, flag, value in zip(plan_fields, flags, values):
+                if flag:
+                    field = plan_field.field
+                    if plan_field.kind == plans.LOCAL:
+                        diff[field.name] = field.to_python(value)
+                    else:
+                        diff[field.attname] = value
+            diffs[(row[0], row[1])] = diff
+
+    return diffs
@@ -0,0 +1,318 @@
+"""Estimates the size of a ``fork``, ``reset`` or ``diff`` without loading or
+changing any objects. The relations the operation would follow are walked one
+level at a time, using a ``COUNT`` query per relation on each level. The
+objects of each level are selected by a subquery on the level before, so no
+primary keys are read.
+
+Counting does not know which objects have been reached before. Relations
+leading to a model the objects were reached through are counted, excluding
+those objects, but not followed, and objects reached through several
+relations are counted for each, so ``rows`` is an upper bound.
+
+With ``exact``, the primary keys of the related objects are read instead and,
+like the memo of a fork, each object is planned once, keyed by it's model and
+primary key. Objects reached again through another relation are counted but
+not followed, so chains of the same relationship (e.g. a self-referencing
+foreign key) are followed to their end and objects reached through several
+relations are counted once.
+
+In both cases, relations leading back to the objects a model was reached from
+are skipped.
+
+The tree is pruned by ``max_depth``, ``model_exclude`` and ``follow`` as the
+fork would be. Only ``follow`` predicates need the objects to be loaded.
+"""
+from forkit import utils, plans
+from forkit.sql import _dependency_order
+
+
+class ExplainNode(object):
+    """The objects of a model reached by the operation through a relation.
+    ``accessor`` and ``kind`` describe the relation (``None`` for the
+    reference). ``rows`` is the number of objects reached. ``memoized`` is
+    true if all of them were already planned or, when counting, if they are
+    of a model the node was reached through, in which case the relation is
+    not followed.
+    """
+    __slots__ = ('model', 'accessor', 'kind', 'rows', 'children', 'memoized',
+        '_objects', '_via', '_parent')
+
+    def __init__(self, model, plan_field, rows, objects, memoized=False,
+            parent=None):
+        self.model = model
+        self.accessor = plan_field and plan_field.accessor
+        self.kind = plan_field and plan_field.kind
+        self.rows = rows
+        self.children = []
+        self.memoized = memoized
+        # the primary keys of the objects planned through this node, or a
+        # queryset of them when counting
+        self._objects = objects
+        self._via = plan_field
+        self._parent = parent
+
+    def __repr__(self):
+        return '<ExplainNode: {0} ({1})>'.format(plans._model_label(self.model),
+            self.rows)
+
+    def as_dict(self):
+        return {
+            'model': plans._model_label(self.model),
+            'accessor': self.accessor,
+            'kind': self.kind,
+            'rows': self.rows,
+            'memoized': self.memoized,
+            'children': [child.as_dict() for child in self.children],
+        }
+
+
+class Explanation(object):
+    """The plan of an operation. ``root`` is the tree of ``ExplainNode``s,
+    ``rows`` the estimated number of objects per model label (exact if
+    ``exact`` was passed, an upper bound otherwise), ``queries`` the
+    expected number of queries and ``order`` the model labels in the order
+    they would be committed.
+    """
+    __slots__ = ('operation', 'root', 'rows', 'queries', 'order')
+
+    def __init__(self, operation, root, rows, queries, order):
+        self.operation = operation
+        self.root = root
+        self.rows = rows
+        self.queries = queries
+        self.order = order
+
+    def __repr__(self):
+        return '<Explanation: {0} of {1} objects, {2} queries>'.format(
+            self.operation, sum(self.rows.values()), self.queries)
+
+    def as_dict(self):
+        return {
+            'operation': self.operation,
+            'root': self.root.as_dict(),
+            'rows': dict(self.rows),
+            'queries': self.queries,
+            'order': list(self.order),
+        }
+
+
+def _follows(operation, plan_field, related):
+    """Returns true if ``operation`` traverses the objects of ``plan_field``
+    for deep operations. Resets and diffs only follow direct relations,
+    unless related objects are reset as well.
+    """
+    if plan_field.kind == plans.LOCAL:
+        return False
+    if operation == 'fork' or operation == 'reset' and related:
+        return True
+    return plan_field.direct and not plan_field.m2m
+
+def _backwards(node, plan_field):
+    """Returns true if ``plan_field`` leads back to exactly the objects
+    ``node`` was reached from, i.e. the direct side of the foreign key or
+    one-to-one it was reached through.
+    """
+    via = node._via
+    if via is None or plan_field.field is not via.field or \
+            plan_field.direct == via.direct or plan_field.m2m:
+        return False
+    return plan_field.direct or plan_field.kind == plans.ONE2ONE
+
+def _related(queryset, plan_field):
+    """Returns the model and a queryset of the objects related to the objects
+    of ``queryset`` through ``plan_field``.
+    """
+    accessor, field, direct, m2m, kind = plan_field[:5]
+
+    if m2m and direct:
+        model = field.rel.to
+        lookup = field.related_query_name()
+    elif m2m or not direct:
+        model = field.model
+        lookup = field.name
+    else:
+        model = field.rel.to
+        target = field.rel.get_related_field()
+        lookup = target.name
+        queryset = queryset.values(field.attname)
+
+    related = model._default_manager.filter(**{'{0}__in'.format(lookup): queryset})
+    if m2m or not direct:
+        related = related.distinct()
+    return model, related
+
+def _related_pks(node, plan_field, rule=None):
+    """Returns the model and the primary keys of the objects related to the
+    objects of ``node`` through ``plan_field``, limited by it's ``follow``
+    ``rule``, see ``utils._follow_rule``. Predicates are called with each
+    object of ``node``, which are loaded for it.
+    """
+    related_model, pks = None, set()
+    manager = node.model._default_manager
+
+    for chunk in utils._chunks(list(node._objects)):
+        if callable(rule):
+            chunk = [obj.pk for obj in manager.filter(pk__in=chunk) if rule(obj)]
+            if not chunk:
+                continue
+
+        related_model, queryset = _related(manager.filter(pk__in=chunk),
+            plan_field)
+        if rule is not None and not callable(rule):
+            queryset = utils._filter_related(queryset, rule)
+        pks.update(queryset.values_list('pk', flat=True))
+
+    return related_model, pks
+
+def _related_count(node, plan_field, rule=None):
+    """Returns the model, a queryset and the number of the objects related to
+    the objects of ``node`` through ``plan_field``, limited by it's ``follow``
+    ``rule``. The objects ``node`` was reached through are excluded, along
+    with itself. Predicates are called with each object of ``node``, which
+    are loaded for it.
+    """
+    queryset = node._objects
+    if callable(rule):
+        pks = [obj.pk for obj in queryset if rule(obj)]
+        if not pks:
+            return None, None, 0
+        queryset = node.model._default_manager.filter(pk__in=pks)
+
+    related_model, related = _related(queryset, plan_field)
+    if rule is not None and not callable(rule):
+        related = utils._filter_related(related, rule)
+
+    parent = node
+    while parent is not None:
+        if parent.model is related_model:
+            related = related.exclude(pk__in=parent._objects)
+        parent = parent._parent
+    return related_model, related, related.count()
+
+def _reached_through(node, model):
+    "Returns true if ``node`` was reached through objects of ``model``."
+    while node is not None:
+        if node.model is model:
+            return True
+        node = node._parent
+    return False
+
+def _queries(operation, plan_field, rows, prefetch, related):
+    "Estimates the queries needed to read ``plan_field`` for ``rows`` objects."
+    if plan_field.kind == plans.LOCAL:
+        return 0
+    if operation == 'fork':
+        if prefetch:
+            return plan_field.m2m and 2 or 1
+        return rows
+    # resets and diffs read both the reference and the instance side
+    if operation == 'reset' and not related and \
+            (plan_field.m2m or not plan_field.direct):
+        return 0
+    return rows * 2
+
+def explain_model_object(operation, reference, fields=None, exclude=('pk',),
+        deep=False, prefetch=False, bulk=False, commit=True, related=False,
+        max_depth=None, model_exclude=None, follow=None, exact=False):
+    """Returns the ``Explanation`` of performing ``operation`` (``'fork'``,
+    ``'reset'`` or ``'diff'``) on ``reference`` with the given configuration.
+    ``max_depth``, ``model_exclude`` and ``follow`` prune the tree the same
+    way as for ``fork``. If ``exact`` is true, the primary keys of the related
+    objects are read so each object is counted once.
+    """
+    model = reference.__class__
+    if exact:
+        root = ExplainNode(model, None, 1, set([reference.pk]))
+    else:
+        root = ExplainNode(model, None, 1,
+            model._default_manager.filter(pk=reference.pk))
+
+    # the primary keys of the objects planned so far, per model, or their
+    # number when counting
+    planned = {model: exact and set([reference.pk]) or 1}
+    throughs = set()
+    queries = 0
+    depth = 0
+    frontier = [root]
+
+    while frontier:
+        level = []
+        # objects at ``max_depth`` are forked shallow
+        level_deep = deep and (max_depth is None or depth < max_depth)
+
+        for node in frontier:
+            # ``fields`` and ``exclude`` only apply to the reference
+            if node is root:
+                plan_fields = utils._tree_fields(model, fields, exclude,
+                    level_deep, model_exclude)
+            else:
+                plan_fields = utils._tree_fields(node.model, deep=level_deep,
+                    model_exclude=model_exclude)
+
+            rows = exact and len(node._objects) or node.rows
+            for plan_field in plan_fields:
+                queries += _queries(operation, plan_field, rows, prefetch,
+                    related)
+
+                if plan_field.m2m and operation == 'fork':
+                    throughs.add(plan_field.field.rel.through)
+
+                # the objects back up the tree have already been planned
+                if not level_deep or not _follows(operation, plan_field, related) \
+                        or _backwards(node, plan_field):
+                    continue
+
+                rule = utils._follow_rule(follow, node.model, plan_field)
+                if not exact:
+                    related_model, queryset, count = _related_count(node,
+                        plan_field, rule)
+                    if not count:
+                        continue
+
+                    planned[related_model] = planned.get(related_model, 0) + count
+                    memoized = _reached_through(node, related_model)
+                    child = ExplainNode(related_model, plan_field, count,
+                        queryset, memoized, node)
+                    node.children.append(child)
+                    if not memoized:
+                        level.append(child)
+                    continue
+
+                related_model, pks = _related_pks(node, plan_field, rule)
+                if not pks:
+                    continue
+
+                seen = planned.setdefault(related_model, set())
+                new = pks - seen
+                seen.update(new)
+
+                child = ExplainNode(related_model, plan_field, len(pks), new,
+                    not new, node)
+                node.children.append(child)
+                if new:
+                    level.append(child)
+
+        frontier = level
+        depth += 1
+
+    if exact:
+        rows = dict([(related_model, len(pks))
+            for related_model, pks in planned.items()])
+    else:
+        rows = planned
+
+    if operation == 'diff' or not commit:
+        order = []
+    else:
+        order = _dependency_order(list(rows.keys()))
+        # one statement per model for bulk commits, otherwise one per object,
+        # and one insert of the many-to-many links per through table
+        if bulk:
+            queries += len(order)
+        else:
+            queries += sum(rows.values())
+        queries += len(throughs)
+
+    return Explanation(operation, root,
+        dict([(plans._model_label(m), count) for m, count in rows.items()]),
+        queries, [plans._model_label(m) for m in order])
@@ -1,33 +1,69 @@
-from copy import deepcopy
 from django.db import models
-from forkit import utils, signals
-from forkit.commit import commit_model_object
+from forkit import utils, signals, plans, sql, checkpoints, cache
+from forkit.explain import explain_model_object
+from forkit.stats import collect_stats
+from forkit.prefetch import prefetch_model_object, prefetch_model_objects, \
+    clear_prefetched
+from forkit.commit import commit_model_objects, _collect_commits, _batches, \
+    _send_batches
 
-def _fork_one2one(instance, value, field, direct, accessor, deep, **kwargs):
+def _default_config(deep=False):
+    return {
+        'fields': None,
+        'exclude': ['pk'],
+        'deep': deep,
+        'commit': False,
+        'bulk': False,
+        'prefetch': False,
+        'prefetch_workers': None,
+        'cache': False,
+        'lazy': False,
+        'max_depth': None,
+        'model_exclude': None,
+        'follow': None,
+        'depth': 0,
+    }
+
+def _nested_config(config):
+    """The configuration of the objects related to an object forked with
+    ``config``, one level further down the tree.
+    """
+    nested = _default_config(deep=config['deep'])
+    for key in ('max_depth', 'model_exclude', 'follow', 'lazy'):
+        nested[key] = config[key]
+    nested['depth'] = config['depth'] + 1
+    return nested
+
+def _fork_one2one(context, instance, value, field, direct, accessor, deep,
+        config=None):
     "Due to the unique constraint, only deep forks can be performed."
     if deep:
-        fork = _memoize_fork(value, deep=deep, **kwargs)
+        fork = _memoize_fork(context, value, deep=deep, parent=config)
 
         if not direct:
             fork = utils.DeferredCommit(fork)
 
         instance._commits.defer(accessor, fork, direct=direct)
 
-def _fork_foreignkey(instance, value, field, direct, accessor, deep, **kwargs):
+def _fork_foreignkey(context, instance, value, field, direct, accessor, deep,
+        config=None):
     if deep:
         if direct:
-            fork = _memoize_fork(value, deep=deep, **kwargs)
+            fork = _memoize_fork(context, value, deep=deep, parent=config)
         else:
-            fork = [_memoize_fork(rel, deep=deep, **kwargs) for rel in value]
+            fork = [_memoize_fork(context, rel, deep=deep, parent=config)
+                for rel in value]
             fork = utils.DeferredCommit(fork)
     else:
         fork = value
 
     instance._commits.defer(accessor, fork, direct=direct)
 
-def _fork_many2many(instance, value, field, direct, accessor, deep, **kwargs):
+def _fork_many2many(context, instance, value, field, direct, accessor, deep,
+        config=None):
     if deep:
-        fork = [_memoize_fork(rel, deep=deep, **kwargs) for rel in value]
+        fork = [_memoize_fork(context, rel, deep=deep, parent=config)
+            for rel in value]
         if not direct:
             fork = utils.DeferredCommit(fork)
     else:
@@ -35,99 +71,400 @@ def _fork_many2many(instance, value, field, direct, accessor, deep, **kwargs):
 
     instance._commits.defer(accessor, fork)
 
-def _fork_field(reference, instance, accessor, **kwargs):
+def _fork_boundary(context, instance, value, plan_field):
+    """Relates an object at ``max_depth`` to the forks of it's related
+    objects if they have already been forked, otherwise to the related
+    objects themselves as for shallow forks. Nothing below it is traversed.
+    """
+    accessor, field, direct = plan_field[:3]
+    memo = context.memo
+
+    if isinstance(value, models.Model):
+        if memo.has(value):
+            value = memo.get(value)
+        # one-to-ones cannot be shared with the reference
+        elif plan_field.kind == plans.ONE2ONE:
+            return
+        instance._commits.defer(accessor, value, direct=direct)
+    else:
+        instance._commits.defer(accessor, [memo.has(rel) and memo.get(rel) or rel
+            for rel in value])
+
+def _fork_field(context, reference, instance, plan_field, deep, config=None):
     """Creates a copy of the reference value for the defined ``accessor``
     (field). For deep forks, each related object is related objects must
-    be created first prior to being recursed.
+    be created first prior to being recursed. ``config`` is the configuration
+    of ``reference``.
     """
-    value, field, direct, m2m = utils._get_field_value(reference, accessor)
+    rule = config and utils._follow_rule(config['follow'], reference.__class__,
+        plan_field)
+
+    # relations which are not followed are never queried
+    if rule is not None and callable(rule) and not rule(reference):
+        return
+
+    value = utils._get_plan_value(reference, plan_field)
 
     if value is None:
         return
 
-    # recursive calls cannot be saved until everything has been traversed..
-    kwargs['commit'] = False
+    # prefetched values have been filtered when they were loaded
+    if rule is not None and not callable(rule) and hasattr(value, 'filter'):
+        value = utils._filter_related(value, rule)
+
+    accessor, field, direct, m2m, kind = plan_field[:5]
+
+    if kind != plans.LOCAL and not deep and config is not None and config['deep']:
+        return _fork_boundary(context, instance, value, plan_field)
+
+    if kind == plans.ONE2ONE:
+        return _fork_one2one(context, instance, value, field, direct,
+            accessor, deep, config)
+
+    if kind == plans.FOREIGNKEY:
+        return _fork_foreignkey(context, instance, value, field, direct,
+            accessor, deep, config)
+
+    if kind == plans.MANY2MANY:
+        return _fork_many2many(context, instance, value, field, direct,
+            accessor, deep, config)
+
+    if context.stats is not None:
+        with context.stats.timer(reference.__class__, 'copy'):
+            value = plan_field.copy(value)
+    else:
+        value = plan_field.copy(value)
+
+    setattr(instance, accessor, value)
+
+def _fork_object(context, reference, instance, config):
+    "Forks each field of ``reference`` onto ``instance``."
+    with context.timer(reference.__class__, 'traversal'):
+        _fork_fields(context, reference, instance, config)
+
+def _fork_fields(context, reference, instance, config):
+    # pre-signal
+    if context.listening(signals.pre_fork, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.pre_fork.send(sender=reference.__class__,
+                reference=reference, instance=instance, config=config,
+                **context.kwargs)
+
+    # objects at ``max_depth`` are forked shallow, so nothing below them is
+    # traversed
+    max_depth = config['max_depth']
+    deep = config['deep'] and (max_depth is None or config['depth'] < max_depth)
 
-    if isinstance(field, models.OneToOneField):
-        return _fork_one2one(instance, value, field, direct,
-            accessor, **kwargs)
+    # no fields are defined, so get the default ones for shallow or deep
+    fields = utils._tree_fields(reference, config['fields'], config['exclude'],
+        deep, config['model_exclude'])
+
+    # lazy forks only fork direct relationships, the others are forked the
+    # first time they are accessed, see ``forkit.lazy``
+    if config['lazy'] and deep:
+        pending = [plan_field for plan_field in fields
+            if not plan_field.direct or plan_field.m2m]
+        if pending:
+            config['lazy'].add(reference, instance, config, pending)
+            fields = tuple([plan_field for plan_field in fields
+                if plan_field.direct and not plan_field.m2m])
+
+    instance._commits.fields = fields
 
-    if isinstance(field, models.ForeignKey):
-        return _fork_foreignkey(instance, value, field, direct,
-            accessor, **kwargs)
+    # load the whole tree ahead of time, so the traversal reads the related
+    # objects from memory. this only applies to the top-level object
+    if config['prefetch']:
+        context.prefetched.extend(prefetch_model_object(reference,
+            config['fields'], config['exclude'], config['deep'],
+            config['prefetch_workers'], **_pruning(config)))
 
-    if isinstance(field, models.ManyToManyField):
-        return _fork_many2many(instance, value, field, direct,
-            accessor, **kwargs)
+    # the post-signal is sent once all related objects have been forked
+    context.push(_post_fork, reference, instance, deep)
 
-    # non-relational field, perform a deepcopy to ensure no mutable nonsense
-    setattr(instance, accessor, deepcopy(value))
+    # iterate over each field and fork it!. related objects are queued
+    # and forked in the order they are encountered
+    mark = context.mark()
+    for plan_field in fields:
+        _fork_field(context, reference, instance, plan_field, deep, config)
+    context.reorder(mark)
 
-def _memoize_fork(reference, **kwargs):
-    "Resets the specified instance relative to ``reference``"
-    # popped so it does not get included in the config for the signal
-    memo = kwargs.pop('memo', None)
+def _post_fork(context, reference, instance, deep):
+    if context.listening(signals.post_fork, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.post_fork.send(sender=reference.__class__,
+                reference=reference, instance=instance, deep=deep,
+                **context.kwargs)
 
-    # for every call, keep track of the reference and the instance being
-    # acted on. this is used for recursive calls to related objects. this
+def _memoize_fork(context, reference, deep=False, config=None, parent=None):
+    """Returns the fork of ``reference``. New forks are queued to have their
+    fields forked once the current object is done. ``parent`` is the
+    configuration of the object ``reference`` was reached from.
+    """
+    # keep track of the reference and the instance being acted on. this
     # ensures relationships that follow back up the tree are caught and are
     # merely referenced rather than traversed again.
-    if memo is None:
-        memo = utils.Memo()
-    elif memo.has(reference):
-        return memo.get(reference)
+    if context.memo.has(reference):
+        context.count(reference.__class__, 'memo_hits')
+        return context.memo.get(reference)
+
+    context.count(reference.__class__, 'visited')
 
     # initialize and memoize new instance
     instance = reference.__class__()
-    instance._commits = utils.Commits(reference)    
-    memo.add(reference, instance)
+    instance._commits = utils.Commits(reference)
+    context.memo.add(reference, instance)
 
-    # default configuration
-    config = {
-        'fields': None,
-        'exclude': ['pk'],
-        'deep': False,
-        'commit': True,
+    # nested forks use the default configuration, limited the same way as
+    # the objects above them, and are never committed until the whole tree
+    # has been traversed
+    if config is None and parent is not None:
+        config = _nested_config(parent)
+    elif config is None:
+        config = _default_config(deep=deep)
+
+    context.push(_fork_object, reference, instance, config)
+    return instance
+
+def _pruning(config):
+    "Returns the parameters of ``config`` limiting the traversal."
+    return {
+        'max_depth': config['max_depth'],
+        'model_exclude': config['model_exclude'],
+        'follow': config['follow'],
     }
 
-    # pop off and set any config params for signals
-    for key in config.iterkeys():
-        if kwargs.has_key(key):
+def _pop_config(kwargs):
+    "Pops the config params off ``kwargs``, the rest are for signals."
+    config = _default_config()
+    config['commit'] = True
+
+    # the depth is tracked internally, the reference is always at the top
+    for key in config:
+        if key != 'depth' and key in kwargs:
             config[key] = kwargs.pop(key)
 
-    # pre-signal
-    signals.pre_fork.send(sender=reference.__class__, reference=reference,
-        instance=instance, config=config, **kwargs)
+    return config
 
-    fields = config['fields']
-    exclude = config['exclude']
-    deep = config['deep']
-    commit = config['commit']
+def _replace_pending(value, clones):
+    "Returns ``value`` with each pending object replaced by it's clone."
+    if isinstance(value, utils.DeferredCommit):
+        return utils.DeferredCommit(_replace_pending(value.value, clones))
+    if type(value) is list:
+        return [clones.get(id(obj), obj) for obj in value]
+    if isinstance(value, models.Model):
+        return clones.get(id(value), value)
+    return value
 
-    # no fields are defined, so get the default ones for shallow or deep
-    if not fields:
-        fields = utils._default_model_fields(reference, exclude=exclude, deep=deep)
+def _replicate(instance, copies):
+    """Creates ``copies`` independent copies of the uncommitted fork tree
+    rooted at ``instance``. Only the in-memory forks are copied, nothing is
+    read from the database.
+    """
+    template = _collect_commits([instance], utils.Memo())
+    roots = []
 
-    # add arguments for downstream use
-    kwargs.update({'deep': deep})
+    for i in range(copies):
+        clones = {}
 
-    # iterate over each field and fork it!. nested calls will not commit,
-    # until the recursion has finished
-    for accessor in fields:
-        _fork_field(reference, instance, accessor, memo=memo, **kwargs)
+        for obj in template:
+            clone = obj.__class__()
+            clone._commits = utils.Commits(obj._commits.reference)
+            clone._commits.fields = obj._commits.fields
 
-    # post-signal
-    signals.post_fork.send(sender=reference.__class__, reference=reference,
-        instance=instance, **kwargs)
+            for plan_field in obj._commits.fields:
+                if plan_field.kind == plans.LOCAL and not plan_field.field.primary_key:
+                    setattr(clone, plan_field.accessor,
+                        plan_field.copy(getattr(obj, plan_field.accessor)))
 
-    # as of now, this will only every be from a top-level call
-    if commit:
-        commit_model_object(instance, **kwargs)
+            clones[id(obj)] = clone
 
-    return instance
+        for obj in template:
+            commits = clones[id(obj)]._commits
+            for accessor, value in obj._commits.direct.items():
+                commits.direct[accessor] = _replace_pending(value, clones)
+            for accessor, value in obj._commits.related.items():
+                commits.related[accessor] = _replace_pending(value, clones)
 
-def fork_model_object(reference, **kwargs):
+        roots.append(clones[id(instance)])
+
+    return roots
+
+def _reload(instances, indexes):
+    "Replaces the objects at ``indexes`` by a freshly loaded copy."
+    pks = {}
+    for i in indexes:
+        pks.setdefault(instances[i].__class__, []).append(instances[i].pk)
+
+    loaded = {}
+    for model, values in pks.items():
+        for pk, obj in model._default_manager.in_bulk(values).items():
+            loaded[(model, pk)] = obj
+
+    for i in indexes:
+        instances[i] = loaded[(instances[i].__class__, instances[i].pk)]
+
+def _commit_forks(instances, config, bulk, memo=None, stats=None,
+        checkpoint=None, chunk_size=500, **kwargs):
+    """Sends the fork batch signals for the forks reachable from
+    ``instances``, before and after committing them. If a ``checkpoint``
+    is supplied, the fork is committed in chunks.
+    """
+    batches = _batches(signals.pre_fork_batch, signals.post_fork_batch, instances)
+    _send_batches(signals.pre_fork_batch, batches, **kwargs)
+
+    if config['commit'] and checkpoint is not None:
+        checkpoints.commit_model_object(instances[0], checkpoint,
+            chunk_size=chunk_size, deep=config['deep'], memo=memo,
+            stats=stats, **kwargs)
+    elif config['commit']:
+        commit_model_objects(instances, bulk=bulk, deep=config['deep'],
+            memo=memo, stats=stats, **kwargs)
+
+    _send_batches(signals.post_fork_batch, batches, **kwargs)
+
+@collect_stats('fork')
+def fork_model_object(reference, copies=None, checkpoint=None, chunk_size=500,
+        **kwargs):
     """Creates a fork of the reference object. If an object is supplied, it
     effectively gets reset relative to the reference object.
+
+    If ``copies`` is supplied, the reference tree is traversed once and a list
+    of ``copies`` independent forks is returned. They are committed together,
+    one multi-row insert per model and level.
+
+    If ``checkpoint`` is supplied, the fork is committed ``chunk_size``
+    objects per transaction and can be resumed using the same checkpoint
+    key if it is interrupted, see ``forkit.checkpoints``. Once complete, the
+    same key returns the existing fork.
+
+    If ``engine`` is ``'sql'``, the fork is performed by the database, see
+    ``forkit.sql``.
+
+    If ``explain`` is true, nothing is forked and an estimate of the size of
+    the fork is returned instead, see ``forkit.explain``. ``'exact'`` counts
+    each object once.
+
+    If ``cache`` is true, the reference tree is loaded by the prefetch planner
+    once and kept in memory for later forks with the same configuration, see
+    ``forkit.cache``.
+
+    If ``lazy`` is true, only the reference and the objects it's foreign keys
+    and one-to-ones lead to are forked. Each many-to-many and reverse
+    relationship is forked the first time it's accessed, see ``forkit.lazy``.
+    """
+    config = _pop_config(kwargs)
+    stats = kwargs.pop('stats', None)
+
+    explain = kwargs.pop('explain', False)
+    if explain:
+        return explain_model_object('fork', reference, config['fields'],
+            config['exclude'], config['deep'], prefetch=config['prefetch'],
+            bulk=config['bulk'] or copies is not None, commit=config['commit'],
+            exact=explain == 'exact', **_pruning(config))
+
+    if kwargs.pop('engine', 'python') == 'sql':
+        if config['fields'] or config['exclude'] != ['pk'] or \
+                not config['commit'] or copies is not None or \
+                config['max_depth'] is not None or config['model_exclude'] or \
+                config['follow'] or config['lazy']:
+            raise ValueError('The SQL engine only supports committed forks '
+                'of all fields')
+        return sql.fork_model_object(reference, deep=config['deep'], **kwargs)
+
+    if config['lazy']:
+        if not config['deep'] or not config['commit'] or copies is not None \
+                or checkpoint is not None or config['cache']:
+            raise ValueError('Lazy forks must be deep and committed, and cannot '
+                'be copied, checkpointed or cached')
+        from forkit import lazy
+        return lazy.fork_model_object(reference, config, stats=stats, **kwargs)
+
+    if checkpoint is not None:
+        if not config['commit'] or copies is not None:
+            raise ValueError('Checkpointed forks must be committed and cannot '
+                'be copied')
+
+        checkpoint = checkpoints.get_checkpoint(checkpoint, reference)
+        if checkpoint.complete:
+            return checkpoints.get_fork(checkpoint, reference.__class__)
+
+    # the cached tree is already loaded and must be left intact
+    if config['cache']:
+        reference = cache.load(reference, config['fields'], config['exclude'],
+            config['deep'], config['prefetch_workers'], config['max_depth'],
+            config['model_exclude'], config['follow'])
+        config['prefetch'] = False
+
+    context = utils.Context(memo=kwargs.pop('memo', None), stats=stats, **kwargs)
+    instance = _memoize_fork(context, reference, config=config)
+    context.run()
+
+    clear_prefetched(context.prefetched)
+    # the forks are only held by the tree from here on, so the commit can let
+    # go of them as it goes, unless a ``memo`` was supplied
+    context = None
+
+    if copies is not None:
+        instances = _replicate(instance, copies)
+        _commit_forks(instances, config, bulk=True, stats=stats, **kwargs)
+        return instances
+
+    _commit_forks([instance], config, bulk=config['bulk'], stats=stats,
+        checkpoint=checkpoint, chunk_size=chunk_size, **kwargs)
+    return instance
+
+@collect_stats('fork_many')
+def fork_model_objects(references, chunk_size=100, **kwargs):
+    """Creates a fork of each object in ``references``, which may be a
+    ``QuerySet`` or any iterable. All references share a single memo, so
+    related objects common to several of them (e.g. tags) are forked once.
+    References are traversed and committed ``chunk_size`` at a time, each
+    chunk in it's own transaction. The forks are returned in the order of
+    ``references``.
     """
-    return _memoize_fork(reference, **kwargs)
+    config = _pop_config(kwargs)
+
+    # the prefetch planner is run for each chunk as a whole
+    prefetch = config.pop('prefetch')
+    config['prefetch'] = False
+
+    stats = kwargs.pop('stats', None)
+
+    context = utils.Context(memo=kwargs.pop('memo', None), stats=stats, **kwargs)
+    # keeps track of the objects committed by previous chunks
+    commit_memo = utils.Memo()
+    forks = []
+
+    for chunk in utils._chunks(references, chunk_size):
+        if prefetch:
+            context.prefetched = prefetch_model_objects(chunk,
+                config['fields'], config['exclude'], config['deep'],
+                config['prefetch_workers'], **_pruning(config))
+
+        # forks committed by a previous chunk have been released from the
+        # memo, they are loaded again rather than returned as placeholders
+        released = [i for i, reference in enumerate(chunk)
+            if context.memo.released(reference)]
+
+        # each reference gets it's own copy since signal receivers are
+        # free to change it
+        instances = [_memoize_fork(context, reference, config=dict(config))
+            for reference in chunk]
+        context.run()
+
+        if released:
+            _reload(instances, released)
+
+        clear_prefetched(context.prefetched)
+
+        _commit_forks(instances, config, bulk=config['bulk'], memo=commit_memo,
+            stats=stats, **kwargs)
+
+        if config['commit']:
+            # only the primary keys of committed forks are needed by
+            # later chunks
+            context.memo.release()
+
+        forks.extend(instances)
+
+    return forks
@@ -0,0 +1,466 @@
+"""Lazy forks only fork the objects a fork cannot do without: the reference
+and, recursively, the objects it's foreign keys and one-to-ones point to,
+since sharing those with the reference would make the forks part of the
+reference's tree. Many-to-many and reverse relationships are forked one at a
+time, the first time they are accessed on a fork: ``fork.posts.all()`` forks
+the reference's posts, lazily in turn, commits them and then returns them.
+
+Assigning a relationship replaces it without forking it. ``materialize``
+forks the pending relationships of an object at once, and ``materialize_all``
+those of the whole tree.
+
+The state of a lazy fork is stored in the database along with the forks: the
+``bulk``, ``max_depth``, ``model_exclude`` and ``follow`` options in
+``forkit_lazytree``, the reference and the pending relationships of each
+fork in ``forkit_lazypending`` and the fork of each object of the reference
+tree in ``forkit_lazyentry``. Any process can fork the pending relationships,
+the state is rebuilt from the tables when a fork is accessed in a process
+which does not hold it, e.g. after a restart. The options must therefore be
+picklable. Signals sent by a process which rebuilt a fork do not receive the
+keyword arguments the fork was created with.
+
+Relationships are intercepted by wrapping the descriptors of the model's
+relationships, see ``install``, which is done automatically the first time a
+model is forked lazily. Each object of a model whose relationships are
+intercepted reads the pending table the first time one of them is accessed,
+objects which are not lazy forks are not affected otherwise. The in-process
+state is only held as long as the forks are, and a lazy fork must not be
+shared between threads until it has been materialized.
+"""
+import base64
+import threading
+import weakref
+from django.db import transaction
+from forkit import utils, plans
+from forkit.fork import _default_config, _memoize_fork, _fork_field, \
+    _commit_forks
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# the options of the fork used by the objects forked later on
+OPTIONS = ('bulk', 'max_depth', 'model_exclude', 'follow')
+
+
+class LazyTree(object):
+    """The state shared by the objects of a lazy fork, passed along in the
+    fork configuration as ``lazy``.
+    """
+    def __init__(self, memo, config, kwargs, record=None):
+        # the forks committed so far, so objects reached through several
+        # relationships are forked once
+        self.memo = memo
+        # the configuration of the root fork, which the commits use
+        self.config = dict(config, lazy=self, prefetch=False)
+        # passed along to signal receivers
+        self.kwargs = kwargs
+        # the ``ForkLazyTree`` of the fork, once it has been committed
+        self.record = record
+        # the forks created since the last commit with pending relationships
+        self.created = []
+
+    def add(self, reference, instance, config, pending):
+        "Records the ``pending`` relationships of a new fork."
+        accessors = [plan_field.accessor for plan_field in pending]
+        _install(reference.__class__, accessors)
+        self.created.append(LazyFork(reference, instance, config, accessors))
+
+    def activate(self):
+        """Records the forks committed since the memo was last released and
+        the pending relationships of the new forks, and starts intercepting
+        them.
+        """
+        from forkit.models import ForkLazyTree, ForkLazyEntry, ForkLazyPending
+
+        # nothing is recorded for forks without any pending relationships
+        if self.record is None and not self.created:
+            return
+        if self.record is None:
+            self.record = ForkLazyTree.objects.create(
+                options=_dump_options(self.config))
+            _trees[self.record.pk] = self
+
+        entries = []
+        seen = set()
+        for key, instance in self.memo.recent():
+            # references which have not been saved are keyed by identity
+            if type(key) is not tuple or key in seen:
+                continue
+            seen.add(key)
+            pk = type(instance) is tuple and instance[1] or instance.pk
+            entries.append(ForkLazyEntry(tree=self.record, model=key[0],
+                old=u'{0}'.format(key[1]), new=u'{0}'.format(pk)))
+        utils._bulk_insert(ForkLazyEntry, entries, pks=False)
+
+        rows = []
+        with _lock:
+            for lazy in self.created:
+                lazy.instance._lazy = lazy
+                label, pk = _key(lazy.instance)
+                _registry[(label, pk)] = lazy
+                rows.append(ForkLazyPending(tree=self.record, model=label,
+                    fork=u'{0}'.format(pk),
+                    reference=u'{0}'.format(lazy.reference.pk),
+                    depth=lazy.config['depth'], accessors=','.join(lazy.pending)))
+        self.created = []
+
+        utils._bulk_insert(ForkLazyPending, rows, pks=False)
+
+
+class LazyFork(object):
+    "The state of a lazy fork, stored on it as ``_lazy``."
+    __slots__ = ('reference', 'instance', 'config', 'pending', '__weakref__')
+
+    def __init__(self, reference, instance, config, pending):
+        self.reference = reference
+        self.instance = instance
+        self.config = config
+        # the accessors of the relationships which have not been forked
+        self.pending = pending
+
+    def __repr__(self):
+        return '<LazyFork: {0} pending>'.format(', '.join(self.pending))
+
+
+class LazyDescriptor(object):
+    """Wraps the descriptor of a relationship, forking the relationship the
+    first time it's accessed on a lazy fork.
+    """
+    def __init__(self, accessor, descriptor):
+        self.accessor = accessor
+        self.descriptor = descriptor
+
+    def __get__(self, instance, owner=None):
+        if instance is not None and _get_lazy(instance) is not None:
+            materialize(instance, [self.accessor])
+        return self.descriptor.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        lazy = _get_lazy(instance)
+        if lazy is not None:
+            _discard(lazy, [self.accessor])
+            if not lazy.pending:
+                _complete(lazy.config['lazy'])
+        self.descriptor.__set__(instance, value)
+
+    def __getattr__(self, name):
+        return getattr(self.descriptor, name)
+
+
+_installed = set()
+# (model label, primary key) -> the ``LazyFork`` of each fork with pending
+# relationships, as long as the fork is held
+_registry = weakref.WeakValueDictionary()
+# ``ForkLazyTree`` primary key -> ``LazyTree``
+_trees = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+def _key(instance):
+    return plans._model_label(instance.__class__), instance.pk
+
+def _dump_options(config):
+    "Returns the ``OPTIONS`` of ``config`` as text."
+    options = dict([(key, config[key]) for key in OPTIONS])
+    try:
+        return base64.b64encode(pickle.dumps(options, 2)).decode('ascii')
+    except (pickle.PicklingError, TypeError, AttributeError):
+        raise ValueError('The model_exclude and follow rules of lazy forks '
+            'must be picklable, e.g. functions defined at module level')
+
+def _load_options(text):
+    return pickle.loads(base64.b64decode(text.encode('ascii')))
+
+def _pending_rows(instance):
+    from forkit.models import ForkLazyPending
+
+    label, pk = _key(instance)
+    return ForkLazyPending.objects.filter(model=label, fork=u'{0}'.format(pk))
+
+def _get_tree(record):
+    """Returns the ``LazyTree`` of the ``ForkLazyTree`` ``record``, rebuilding
+    it's memo from the recorded forks if it's not held by this process.
+    """
+    tree = _trees.get(record.pk)
+    if tree is not None:
+        return tree
+
+    memo = utils.Memo()
+    for entry in record.entries.iterator():
+        model = plans._label_model(entry.model)
+        to_python = model._meta.pk.to_python
+        instance = model(pk=to_python(entry.new))
+        instance._state.adding = False
+        memo.add(model(pk=to_python(entry.old)), instance)
+    memo.release()
+
+    config = dict(_default_config(deep=True), commit=True,
+        **_load_options(record.options))
+    tree = LazyTree(memo, config, {}, record)
+    with _lock:
+        return _trees.setdefault(record.pk, tree)
+
+def _rebuild(instance, row):
+    """Returns a ``LazyFork`` for ``instance`` from it's ``ForkLazyPending``
+    ``row``.
+    """
+    tree = _get_tree(row.tree)
+    model = instance.__class__
+    reference = model._base_manager.get(pk=model._meta.pk.to_python(row.reference))
+    lazy = LazyFork(reference, instance, dict(tree.config, depth=row.depth),
+        row.accessors.split(','))
+    with _lock:
+        _registry[_key(instance)] = lazy
+    return lazy
+
+def _get_lazy(instance):
+    """Returns the ``LazyFork`` of ``instance``, which may be a copy of the
+    fork loaded from the database, or ``None``. The result is kept on
+    ``instance``.
+    """
+    if '_lazy' in instance.__dict__:
+        return instance.__dict__['_lazy']
+    if instance.pk is None:
+        return None
+
+    key = _key(instance)
+    rows = list(_pending_rows(instance).select_related('tree')[:1])
+    lazy = _registry.get(key)
+
+    # the fork may have been rolled back and it's primary key reused
+    if not rows:
+        with _lock:
+            _registry.pop(key, None)
+        lazy = None
+    elif lazy is None or lazy.config['lazy'].record.pk != rows[0].tree_id:
+        lazy = _rebuild(instance, rows[0])
+
+    instance.__dict__['_lazy'] = lazy
+    return lazy
+
+def _descriptor(model, accessor):
+    "Returns the descriptor of ``accessor`` as defined by ``model`` or a parent."
+    for klass in model.__mro__:
+        if accessor in klass.__dict__:
+            return klass.__dict__[accessor]
+    return None
+
+def _install(model, accessors):
+    "Wraps the descriptors of ``accessors`` of ``model``, once per model."
+    with _lock:
+        for accessor in accessors:
+            if (model, accessor) in _installed:
+                continue
+            descriptor = _descriptor(model, accessor)
+            # parent models which were forked lazily are already wrapped
+            if not isinstance(descriptor, LazyDescriptor):
+                setattr(model, accessor, LazyDescriptor(accessor, descriptor))
+            _installed.add((model, accessor))
+
+def install(*models):
+    """Intercepts the many-to-many and reverse relationships of ``models``,
+    so lazy forks created by other processes are forked when they are
+    accessed. Call it once the models have been loaded, in each process
+    which does not fork them lazily itself.
+    """
+    for model in models:
+        _install(model, [plan_field.accessor
+            for plan_field in plans.get_plan(model).fields(deep=True)
+            if not plan_field.direct or plan_field.m2m])
+
+def uninstall():
+    "Restores the descriptors of all intercepted relationships."
+    with _lock:
+        for model, accessor in _installed:
+            descriptor = model.__dict__.get(accessor)
+            if isinstance(descriptor, LazyDescriptor):
+                setattr(model, accessor, descriptor.descriptor)
+        _installed.clear()
+
+def _discard(lazy, accessors):
+    "Removes ``accessors`` from the relationships pending for ``lazy``."
+    lazy.pending = [accessor for accessor in lazy.pending
+        if accessor not in accessors]
+    if lazy.pending:
+        _pending_rows(lazy.instance).update(accessors=','.join(lazy.pending))
+    else:
+        lazy.instance.__dict__['_lazy'] = None
+        with _lock:
+            _registry.pop(_key(lazy.instance), None)
+        _pending_rows(lazy.instance).delete()
+
+def _complete(tree):
+    """Removes the records of ``tree`` once none of it's forks have pending
+    relationships.
+    """
+    from forkit.models import ForkLazyEntry
+
+    if tree.record is None or tree.record.pending.exists():
+        return
+    with _lock:
+        _trees.pop(tree.record.pk, None)
+    ForkLazyEntry.objects.filter(tree=tree.record).delete()
+    tree.record.delete()
+
+def _tree_record(instance):
+    """Returns the ``ForkLazyTree`` of the lazy fork ``instance`` belongs to,
+    or ``None``.
+    """
+    from forkit.models import ForkLazyEntry
+
+    label, pk = _key(instance)
+    entries = list(ForkLazyEntry.objects.filter(model=label,
+        new=u'{0}'.format(pk)).select_related('tree')[:1])
+    return entries and entries[0].tree or None
+
+def _linked(instance, plan_field):
+    """Returns the primary keys of the objects ``instance`` is linked to
+    through the many-to-many ``plan_field``.
+    """
+    field = plan_field.field
+    if plan_field.direct:
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    else:
+        source, target = field.m2m_reverse_field_name(), field.m2m_field_name()
+    through = field.rel.through._base_manager
+    return set(through.filter(**{source: instance.pk}).values_list(target,
+        flat=True))
+
+@transaction.commit_on_success
+def _link(instance, links):
+    """Links ``instance`` to the objects of each many-to-many ``(plan_field,
+    objs)`` in ``links`` it's not already linked to, e.g. because the
+    relationship was forked from the other side. Existing links are kept.
+    """
+    pending = utils.Links()
+    for plan_field, objs in links:
+        linked = _linked(instance, plan_field)
+        pending.defer(instance, plan_field, [obj for obj in objs
+            if obj.pk not in linked])
+    pending.write()
+
+@transaction.commit_on_success
+def fork_model_object(reference, config, stats=None, **kwargs):
+    """Creates a lazy fork of ``reference`` using the fork configuration
+    ``config`` and commits it.
+    """
+    # fail before anything is forked
+    _dump_options(config)
+
+    tree = LazyTree(kwargs.pop('memo', None) or utils.Memo(), config, kwargs)
+    config = tree.config
+
+    context = utils.Context(memo=tree.memo, stats=stats, **kwargs)
+    instance = _memoize_fork(context, reference, config=config)
+    context.run()
+
+    _commit_forks([instance], config, bulk=config['bulk'], stats=stats, **kwargs)
+    tree.activate()
+    tree.memo.release()
+    return instance
+
+@transaction.commit_on_success
+def materialize(instance, accessors=None):
+    """Forks the relationships ``accessors`` of the lazy fork ``instance``, or
+    all of it's pending relationships if none are supplied, and commits them.
+    Returns ``instance``.
+    """
+    lazy = _get_lazy(instance)
+    if lazy is None:
+        return instance
+
+    if accessors is None:
+        accessors = list(lazy.pending)
+    else:
+        accessors = [accessor for accessor in lazy.pending if accessor in accessors]
+    if not accessors:
+        return instance
+
+    # the relationships may have been forked through another copy of the
+    # fork since, possibly by another process
+    rows = list(_pending_rows(instance).select_for_update()[:1])
+    recorded = rows and rows[0].accessors.split(',') or []
+    lazy.pending = [accessor for accessor in lazy.pending if accessor in recorded]
+    accessors = [accessor for accessor in accessors if accessor in recorded]
+
+    # no longer pending while they are forked, so accessing them along the
+    # way does not fork them again
+    tree = lazy.config['lazy']
+    _discard(lazy, accessors)
+    if not accessors:
+        _complete(tree)
+        return instance
+
+    reference = lazy.reference
+    plan = plans.get_plan(reference.__class__)
+
+    context = utils.Context(memo=tree.memo, **tree.kwargs)
+    instance._commits = utils.Commits(reference)
+    # the fork itself is not written again
+    instance._commits.changed = set()
+
+    for accessor in accessors:
+        _fork_field(context, reference, instance, plan.field(accessor), True,
+            lazy.config)
+    context.run()
+
+    # the links are written from this side once the related objects have
+    # been committed, the other side of the relationship may still be pending
+    related = instance._commits.related
+    links = []
+    for accessor in accessors:
+        plan_field = plan.field(accessor)
+        if plan_field.m2m and accessor in related:
+            value = related[accessor]
+            if isinstance(value, utils.DeferredCommit):
+                value = value.value
+            links.append((plan_field, value))
+            related[accessor] = utils.DeferredCommit(value)
+
+    _commit_forks([instance], tree.config, bulk=tree.config['bulk'],
+        **tree.kwargs)
+    _link(instance, links)
+    tree.activate()
+    tree.memo.release()
+    _complete(tree)
+    return instance
+
+def _pending_fork(row):
+    """Returns the fork whose pending relationships ``row`` records, the one
+    held by this process if any, or ``None`` if it has been deleted.
+    """
+    model = plans._label_model(row.model)
+    pk = model._meta.pk.to_python(row.fork)
+    lazy = _registry.get((row.model, pk))
+    if lazy is not None:
+        return lazy.instance
+    forks = list(model._base_manager.filter(pk=pk))
+    return forks and forks[0] or None
+
+def materialize_all(instance):
+    """Forks all pending relationships of the lazy fork tree ``instance``
+    belongs to, including those of the objects forked along the way.
+    """
+    lazy = _get_lazy(instance)
+    if lazy is not None:
+        record = lazy.config['lazy'].record
+        materialize(instance)
+    else:
+        # the relationships of the fork itself may have been forked
+        record = _tree_record(instance)
+        if record is None:
+            return instance
+
+    while True:
+        rows = list(record.pending.order_by('pk')[:100])
+        if not rows:
+            break
+        for row in rows:
+            fork = _pending_fork(row)
+            if fork is None:
+                row.delete()
+            else:
+                materialize(fork)
+
+    return instance
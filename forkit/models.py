@@ -1,8 +1,28 @@
 from django.db import models
+from django.db.models.query import QuerySet
 from forkit import tools
 
+class ForkableQuerySet(QuerySet):
+    "QuerySet which builds in the public Forkit utilities."
+    def fork_many(self, *args, **kwargs):
+        return tools.fork_many(self, *args, **kwargs)
+
+
+class ForkableManager(models.Manager):
+    "Manager which builds in the public Forkit utilities."
+    def get_query_set(self):
+        return ForkableQuerySet(self.model, using=self._db)
+
+    get_queryset = get_query_set
+
+    def fork_many(self, *args, **kwargs):
+        return self.get_query_set().fork_many(*args, **kwargs)
+
+
 class ForkableModel(models.Model):
     "Convenience subclass which builds in the public Forkit utilities."
+    objects = ForkableManager()
+
     def diff(self, *args, **kwargs):
         return tools.diff(self, *args, **kwargs)
 
@@ -12,9 +32,111 @@ class ForkableModel(models.Model):
     def reset(self, *args, **kwargs):
         return tools.reset(self, *args, **kwargs)
 
-    def commit(self):
-        tools.commit(self)
+    def commit(self, **kwargs):
+        tools.commit(self, **kwargs)
 
     class Meta(object):
         abstract = True
 
+
+
+class PkMapOperation(models.Model):
+    """Allocates the ``operation`` of the ``PkMap`` rows of a fork by the SQL
+    engine from it's auto-incrementing primary key, so concurrent forks never
+    share mapping rows. Removed once the fork is done.
+    """
+    class Meta(object):
+        db_table = 'forkit_pkmapoperation'
+
+
+class PkMap(models.Model):
+    """Maps the primary keys of the objects copied by the SQL engine to the
+    primary keys of their forks, for the duration of a fork. See
+    ``forkit.sql``.
+    """
+    operation = models.IntegerField()
+    model = models.IntegerField()
+    old = models.BigIntegerField()
+    new = models.BigIntegerField()
+
+    class Meta(object):
+        db_table = 'forkit_pkmap'
+        unique_together = ('operation', 'model', 'old')
+
+
+class ForkCheckpoint(models.Model):
+    """Tracks a fork committed in chunks, so it can be resumed if it is
+    interrupted. The fork is incomplete until ``complete`` is set. See
+    ``forkit.checkpoints``.
+    """
+    key = models.CharField(max_length=100, unique=True)
+    # the model label and primary key of the reference
+    model = models.CharField(max_length=100)
+    reference = models.CharField(max_length=100)
+    # the primary key of the root fork, once it has been committed
+    fork = models.CharField(max_length=100, null=True)
+    complete = models.BooleanField(default=False)
+
+    class Meta(object):
+        db_table = 'forkit_checkpoint'
+
+
+class ForkCheckpointEntry(models.Model):
+    """Maps the primary key of a reference to the primary key of it's
+    committed fork. Entries are removed once the fork is complete.
+    """
+    checkpoint = models.ForeignKey(ForkCheckpoint, related_name='entries')
+    model = models.CharField(max_length=100)
+    old = models.CharField(max_length=100)
+    new = models.CharField(max_length=100)
+
+    class Meta(object):
+        db_table = 'forkit_checkpointentry'
+        unique_together = ('checkpoint', 'model', 'old')
+
+
+class ForkLazyTree(models.Model):
+    """A lazy fork, holding the options the pending relationships of it's
+    objects are forked with. See ``forkit.lazy``.
+    """
+    # the pickled ``bulk``, ``max_depth``, ``model_exclude`` and ``follow``
+    # options
+    options = models.TextField()
+
+    class Meta(object):
+        db_table = 'forkit_lazytree'
+
+
+class ForkLazyEntry(models.Model):
+    """Maps the primary key of an object of the reference tree to the primary
+    key of it's fork, so objects reached through several relationships are
+    forked once.
+    """
+    tree = models.ForeignKey(ForkLazyTree, related_name='entries')
+    model = models.CharField(max_length=100)
+    old = models.CharField(max_length=100)
+    new = models.CharField(max_length=100, db_index=True)
+
+    class Meta(object):
+        db_table = 'forkit_lazyentry'
+        unique_together = ('tree', 'model', 'old')
+
+
+class ForkLazyPending(models.Model):
+    """Records the relationships of a lazy fork which have not been forked
+    yet, along with the reference they are forked from, so any process can
+    fork them.
+    """
+    tree = models.ForeignKey(ForkLazyTree, related_name='pending')
+    # the model label of the fork and the reference, and their primary keys
+    model = models.CharField(max_length=100)
+    fork = models.CharField(max_length=100)
+    reference = models.CharField(max_length=100)
+    # the depth of the fork in the tree, for ``max_depth``
+    depth = models.IntegerField(default=0)
+    # the comma-separated accessors of the pending relationships
+    accessors = models.TextField()
+
+    class Meta(object):
+        db_table = 'forkit_lazypending'
+        unique_together = ('model', 'fork')
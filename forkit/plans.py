@@ -0,0 +1,160 @@
+import threading
+from collections import namedtuple
+from django.db import models
+from django.db.models import related
+from forkit import strategies
+
+try:
+    from django.apps import apps
+    _get_model = apps.get_model
+except ImportError:
+    _get_model = models.get_model
+
+LOCAL = 'local'
+FOREIGNKEY = 'foreignkey'
+ONE2ONE = 'one2one'
+MANY2MANY = 'many2many'
+
+class PlanField(namedtuple('PlanField', ('accessor', 'field', 'direct', 'm2m', 'kind', 'copy'))):
+    """A single accessor of a model. ``field`` is the model field (for reverse
+    relationships, the field on the related model), ``kind`` is the type of
+    relationship and ``copy`` is used to copy local (non-relational) values.
+    """
+    __slots__ = ()
+
+
+def _compile_field(accessor, field, direct, m2m):
+    if m2m:
+        kind = MANY2MANY
+    elif isinstance(field, models.OneToOneField):
+        kind = ONE2ONE
+    elif isinstance(field, models.ForeignKey):
+        kind = FOREIGNKEY
+    else:
+        kind = LOCAL
+
+    # non-relational field, copied using the strategy registered for it's
+    # class to ensure no mutable nonsense
+    copy = kind == LOCAL and strategies.get_strategy(field) or None
+
+    return PlanField(accessor, field, direct, m2m, kind, copy)
+
+
+class ModelPlan(object):
+    """Compiled field information for a model. The set of fields to traverse
+    for each combination of ``fields``, ``exclude`` and ``deep`` is computed
+    once and reused for every object of the model.
+    """
+    def __init__(self, model):
+        self.model = model
+        self._lock = threading.Lock()
+        self._plans = {}
+        self._aliases = {}
+
+        opts = model._meta
+
+        local = (
+            [_compile_field(f.name, f, True, False) for f in opts.fields] +
+            [_compile_field(f.name, f, True, True) for f in opts.many_to_many] +
+            [_compile_field(r.get_accessor_name(), r.field, False, True)
+                for r in opts.get_all_related_many_to_many_objects()]
+        )
+        # reverse foreign key and one-to-one rels are only used for deep forks
+        reverse = [_compile_field(r.get_accessor_name(), r.field, False, False)
+            for r in opts.get_all_related_objects()]
+
+        self._fields = {}
+        for field in local + reverse:
+            self._fields.setdefault(field.accessor, field)
+
+        self._shallow = tuple([f.accessor for f in local])
+        self._deep = self._shallow + tuple([f.accessor for f in reverse])
+
+    def __repr__(self):
+        return '<ModelPlan: "{0}">'.format(self.model._meta.object_name)
+
+    def field(self, accessor):
+        """Returns the ``PlanField`` for ``accessor``. Besides accessor names,
+        anything ``Options.get_field_by_name`` understands can be used.
+        """
+        field = self._fields.get(accessor) or self._aliases.get(accessor)
+        if field is not None:
+            return field
+
+        # raises ``FieldDoesNotExist`` for unknown names
+        field, model, direct, m2m = self.model._meta.get_field_by_name(accessor)
+        if isinstance(field, related.RelatedObject):
+            field = field.field
+
+        with self._lock:
+            return self._aliases.setdefault(accessor,
+                _compile_field(accessor, field, direct, m2m))
+
+    def fields(self, fields=None, exclude=('pk',), deep=False):
+        """Returns the ordered ``PlanField``s for the given configuration. If
+        ``fields`` is supplied, ``exclude`` is not applicable.
+        """
+        key = (deep, fields and tuple(fields), exclude and tuple(exclude))
+
+        plan = self._plans.get(key)
+        if plan is not None:
+            return plan
+
+        if fields:
+            plan = tuple([self.field(accessor) for accessor in fields])
+        else:
+            exclude = set(exclude or ())
+            # handle this special case..
+            if 'pk' in exclude:
+                exclude.remove('pk')
+                exclude.add(self.model._meta.pk.name)
+
+            accessors = deep and self._deep or self._shallow
+            plan = tuple([self._fields[accessor] for accessor in accessors
+                if accessor not in exclude])
+
+        with self._lock:
+            return self._plans.setdefault(key, plan)
+
+
+_plans = {}
+_lock = threading.Lock()
+_labels = {}
+
+def _model_label(model):
+    "Returns the ``app_label.modelname`` label of ``model``."
+    label = _labels.get(model)
+    if label is None:
+        opts = model._meta
+        label = _labels[model] = '{0}.{1}'.format(opts.app_label,
+            opts.object_name.lower())
+    return label
+
+def _label_model(label):
+    "Returns the model of the ``app_label.modelname`` ``label``."
+    app_label, name = label.split('.')
+    return _get_model(app_label, name)
+
+def get_plan(model):
+    "Returns the ``ModelPlan`` for ``model``, compiling it on first use."
+    plan = _plans.get(model)
+    if plan is None:
+        with _lock:
+            plan = _plans.get(model)
+            if plan is None:
+                plan = _plans[model] = ModelPlan(model)
+    return plan
+
+def clear():
+    "Discards all compiled plans."
+    with _lock:
+        _plans.clear()
+
+def warm(model_list=None):
+    """Compiles the plans for ``model_list``, or all installed models, ahead
+    of time.
+    """
+    if model_list is None:
+        model_list = models.get_models()
+    for model in model_list:
+        get_plan(model)
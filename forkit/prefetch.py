@@ -0,0 +1,342 @@
+import sys
+import threading
+from django.db import models, connections
+from forkit import utils, plans
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+class Loader(object):
+    """Runs the queries of independent relations on ``workers`` threads. Each
+    thread uses it's own database connections, which are closed once the
+    loader is closed. Only committed data is visible to the threads, see
+    ``get_loader``.
+    """
+    def __init__(self, workers):
+        self._tasks = Queue()
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        try:
+            while True:
+                task = self._tasks.get()
+                if task is None:
+                    break
+                func, args, results, index, done = task
+                try:
+                    results[index] = (True, func(*args))
+                except Exception:
+                    results[index] = (False, sys.exc_info()[1])
+                done.release()
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def map(self, calls):
+        """Calls each ``(func, args)`` in ``calls`` concurrently and returns
+        the results in order. The first exception raised is re-raised.
+        """
+        results = [None] * len(calls)
+        done = threading.Semaphore(0)
+        for index, (func, args) in enumerate(calls):
+            self._tasks.put((func, args, results, index, done))
+        for call in calls:
+            done.acquire()
+
+        for ok, value in results:
+            if not ok:
+                raise value
+        return [value for ok, value in results]
+
+    def close(self):
+        for thread in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+class InlineLoader(object):
+    "Runs the queries one after another on the calling thread."
+    def map(self, calls):
+        return [func(*args) for func, args in calls]
+
+    def close(self):
+        pass
+
+
+def _shared(connection):
+    """Returns false if other threads cannot see the database, i.e. SQLite
+    in-memory databases.
+    """
+    name = connection.settings_dict['NAME'] or ''
+    return connection.vendor != 'sqlite' or \
+        not (name == ':memory:' or 'mode=memory' in name)
+
+def _in_transaction(connection):
+    """Returns true if ``connection`` is within a transaction, e.g. a managed
+    transaction, ``commit_on_success`` or an atomic block, whose uncommitted
+    changes other threads cannot see.
+    """
+    if getattr(connection, 'in_atomic_block', False):
+        return True
+    # Django 1.6 replaced transaction management by autocommit, the legacy
+    # decorators turn it off
+    get_autocommit = getattr(connection, 'get_autocommit', None)
+    if get_autocommit is not None:
+        return not get_autocommit()
+    return connection.is_managed()
+
+def get_loader(workers=None):
+    """Returns a ``Loader`` using ``workers`` threads, or an ``InlineLoader``
+    if ``workers`` is less than two, a database is not shared between threads
+    or the calling thread is within a transaction.
+    """
+    if not workers or workers < 2:
+        return InlineLoader()
+    for connection in connections.all():
+        if not _shared(connection) or _in_transaction(connection):
+            return InlineLoader()
+    return Loader(workers)
+
+
+def _fetch(queryset, lookup, values, rule=None):
+    """Evaluates ``queryset`` filtered by ``lookup`` in chunks of ``values``,
+    and by the ``follow`` filter ``rule``, if any.
+    """
+    if rule is not None:
+        queryset = utils._filter_related(queryset, rule)
+    objs = []
+    for chunk in utils._chunks(values):
+        objs.extend(queryset.filter(**{'{0}__in'.format(lookup): chunk}))
+    return objs
+
+def _merge(objs, loaded, frontier):
+    """Substitutes objects which have already been loaded so each row is
+    represented by a single instance. New objects are queued in ``frontier``
+    for the next level.
+    """
+    merged = []
+    for obj in objs:
+        key = (obj.__class__, obj.pk)
+        if key in loaded:
+            obj = loaded[key]
+        else:
+            loaded[key] = obj
+            frontier.append(obj)
+        merged.append(obj)
+    return merged
+
+# each relation is loaded by a fetch function, which only reads from the
+# database and may run on a loader thread, and an apply function which
+# stores the loaded objects on the calling thread
+
+def _fetch_direct(objs, field):
+    "Direct foreign keys and one-to-ones."
+    target = field.rel.get_related_field()
+    values = set([getattr(obj, field.attname) for obj in objs]) - set([None])
+    if not values:
+        return []
+    return _fetch(field.rel.to._default_manager.all(), target.name, values)
+
+def _apply_direct(objs, accessor, field, fetched, loaded, frontier):
+    target = field.rel.get_related_field()
+    related = {}
+    for rel in _merge(fetched, loaded, frontier):
+        related[getattr(rel, target.attname)] = rel
+
+    for obj in objs:
+        obj._prefetched[accessor] = related.get(getattr(obj, field.attname))
+
+def _fetch_reverse(objs, field, rule=None):
+    "Reverse foreign keys and one-to-ones."
+    target = field.rel.get_related_field()
+    values = [getattr(obj, target.attname) for obj in objs]
+    return _fetch(field.model._default_manager.all(), field.name, values, rule)
+
+def _apply_reverse(objs, accessor, field, fetched, loaded, frontier):
+    target = field.rel.get_related_field()
+    values = [getattr(obj, target.attname) for obj in objs]
+
+    grouped = dict([(value, []) for value in values])
+    for rel in _merge(fetched, loaded, frontier):
+        grouped[getattr(rel, field.attname)].append(rel)
+
+    one2one = isinstance(field, models.OneToOneField)
+    for obj, value in zip(objs, values):
+        related = grouped[value]
+        if one2one:
+            related = related and related[0] or None
+        obj._prefetched[accessor] = related
+
+def _fetch_many2many(objs, field, direct, rule=None):
+    """Direct and reverse many-to-many fields, read through the ``through``
+    table. Returns the links and the related objects.
+    """
+    if direct:
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        model = field.rel.to
+    else:
+        source, target = field.m2m_reverse_field_name(), field.m2m_field_name()
+        model = field.model
+
+    through = field.rel.through._default_manager.all()
+    links = []
+    for chunk in utils._chunks([obj.pk for obj in objs]):
+        links.extend(through.filter(**{'{0}__in'.format(source): chunk})
+            .values_list(source, target))
+
+    if not links:
+        return links, []
+
+    # iterate in the default order of the related model
+    targets = set([target_pk for source_pk, target_pk in links])
+    return links, _fetch(model._default_manager.all(), 'pk', targets, rule)
+
+def _apply_many2many(objs, accessor, field, fetched, loaded, frontier):
+    links, related = fetched
+
+    sources = {}
+    for source_pk, target_pk in links:
+        sources.setdefault(target_pk, []).append(source_pk)
+
+    # related objects excluded by a ``follow`` filter are not loaded
+
+    grouped = dict([(obj.pk, []) for obj in objs])
+    for rel in _merge(related, loaded, frontier):
+        for source_pk in sources[rel.pk]:
+            grouped[source_pk].append(rel)
+
+    for obj in objs:
+        obj._prefetched[accessor] = grouped[obj.pk]
+
+def _followed(objs, plan_field, rule):
+    """Returns the objects of ``objs`` the ``follow`` predicate ``rule``
+    follows ``plan_field`` for, the relation is empty for the others.
+    """
+    if rule is None or not callable(rule):
+        return objs
+
+    followed = []
+    for obj in objs:
+        if rule(obj):
+            followed.append(obj)
+        elif plan_field.kind == plans.ONE2ONE:
+            obj._prefetched[plan_field.accessor] = None
+        else:
+            obj._prefetched[plan_field.accessor] = []
+    return followed
+
+def _prefetch_level(groups, loader, loaded, frontier, follow=None):
+    """Loads the relations of each ``(objs, fields)`` in ``groups``. The
+    relations do not depend on each other, so they are fetched using
+    ``loader`` and then applied in order.
+    """
+    calls, applies = [], []
+
+    for objs, fields in groups:
+        for obj in objs:
+            obj._prefetched = {}
+
+        for plan_field in fields:
+            accessor, field, direct, m2m, kind = plan_field[:5]
+            if kind == plans.LOCAL:
+                continue
+
+            rule = utils._follow_rule(follow, objs[0].__class__, plan_field)
+            followed = _followed(objs, plan_field, rule)
+            if not followed:
+                continue
+            if callable(rule):
+                rule = None
+
+            if kind == plans.MANY2MANY:
+                calls.append((_fetch_many2many, (followed, field, direct, rule)))
+                applies.append((_apply_many2many, followed, accessor, field))
+            elif direct:
+                calls.append((_fetch_direct, (followed, field)))
+                applies.append((_apply_direct, followed, accessor, field))
+            else:
+                calls.append((_fetch_reverse, (followed, field, rule)))
+                applies.append((_apply_reverse, followed, accessor, field))
+
+    for (apply, objs, accessor, field), fetched in zip(applies, loader.map(calls)):
+        apply(objs, accessor, field, fetched, loaded, frontier)
+
+def prefetch_model_objects(references, fields=None, exclude=('pk',), deep=False,
+        workers=None, max_depth=None, model_exclude=None, follow=None):
+    """Loads the related objects that forks of ``references`` will traverse,
+    one level of the object tree at a time. Each relation on a level is
+    loaded for all objects of the same model at once, so the number of
+    queries grows with the depth of the model graph rather than the number of
+    objects. The loaded values are stored on each object and read by
+    ``utils._get_field_value``. All loaded objects are returned so the caches
+    can be cleared using ``clear_prefetched``.
+
+    If ``workers`` is supplied, the relations of each level are loaded
+    concurrently using that many threads, see ``Loader``. ``max_depth``,
+    ``model_exclude`` and ``follow`` prune the tree the same way as for
+    ``fork``, relations which are not traversed are not loaded.
+    """
+    loaded = {}
+    frontier = []
+    for reference in references:
+        key = (reference.__class__, reference.pk)
+        if key not in loaded:
+            loaded[key] = reference
+            frontier.append(reference)
+
+    depth = 0
+    loader = get_loader(workers)
+
+    try:
+        while frontier:
+            by_model = {}
+            for obj in frontier:
+                # unsaved objects cannot have any related objects to load
+                if obj.pk is not None:
+                    by_model.setdefault(obj.__class__, []).append(obj)
+
+            # objects at ``max_depth`` are forked shallow
+            level_deep = deep and (max_depth is None or depth < max_depth)
+
+            groups = []
+            for objs in by_model.values():
+                # ``fields`` and ``exclude`` only apply to the references
+                if depth == 0:
+                    level_fields = utils._tree_fields(objs[0], fields, exclude,
+                        level_deep, model_exclude)
+                else:
+                    level_fields = utils._tree_fields(objs[0], deep=level_deep,
+                        model_exclude=model_exclude)
+                groups.append((objs, level_fields))
+
+            frontier = []
+            _prefetch_level(groups, loader, loaded, frontier, follow)
+
+            # shallow forks do not traverse related objects
+            if not level_deep:
+                break
+            depth += 1
+    finally:
+        loader.close()
+
+    return list(loaded.values())
+
+def prefetch_model_object(reference, fields=None, exclude=('pk',), deep=False,
+        workers=None, max_depth=None, model_exclude=None, follow=None):
+    "Loads the related objects that a fork of ``reference`` will traverse."
+    return prefetch_model_objects([reference], fields, exclude, deep, workers,
+        max_depth, model_exclude, follow)
+
+def clear_prefetched(objs):
+    "Removes the prefetched values stored on ``objs``."
+    for obj in objs:
+        obj.__dict__.pop('_prefetched', None)
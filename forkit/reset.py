@@ -1,108 +1,263 @@
-from copy import deepcopy
 from django.db import models
-from forkit import utils, signals
-from forkit.commit import commit_model_object
+from forkit import utils, signals, plans
+from forkit.fork import fork_model_object
+from forkit.explain import explain_model_object
+from forkit.stats import collect_stats
+from forkit.commit import commit_model_object, _batches, _send_batches
 
-def _reset_one2one(instance, refvalue, field, direct, accessor, deep, **kwargs):
+def _default_config(deep=False, related=False, match=None):
+    return {
+        'fields': None,
+        'exclude': ['pk'],
+        'deep': deep,
+        'commit': False,
+        'bulk': False,
+        'related': related,
+        'match': match,
+    }
+
+def _nested_config(config):
+    "The configuration of related objects reset along with the reference."
+    return _default_config(deep=config['deep'], related=config['related'],
+        match=config['match'])
+
+def _reset_one2one(context, instance, refvalue, field, direct, accessor, config):
     value = utils._get_field_value(instance, accessor)[0]
-    if refvalue and value and deep:
-        _memoize_reset(refvalue, value, deep=deep, **kwargs)
+    if refvalue and value and config['deep']:
+        _memoize_reset(context, refvalue, value, config=_nested_config(config))
         instance._commits.defer(accessor, value, direct=direct)
 
-def _reset_foreignkey(instance, refvalue, field, direct, accessor, deep, **kwargs):
+def _reset_foreignkey(context, instance, refvalue, field, direct, accessor, config):
     value = utils._get_field_value(instance, accessor)[0]
-    if refvalue and value and deep:
-        _memoize_reset(refvalue, value, deep=deep, **kwargs)
+    if refvalue and value and config['deep']:
+        _memoize_reset(context, refvalue, value, config=_nested_config(config))
     # for shallow or when value is None, use the reference value
     elif not value:
         value = refvalue
 
     instance._commits.defer(accessor, value, direct=direct)
 
-def _reset_field(reference, instance, accessor, **kwargs):
+def _match_key(match, accessor):
+    """Returns the function computing the key related objects of
+    ``accessor`` are matched by. ``match`` maps accessors to a field name or
+    a function. Related objects are matched by primary key by default.
+    """
+    key = match and match.get(accessor)
+    if key is None:
+        return lambda obj: obj.pk
+    if callable(key):
+        return key
+    return lambda obj: getattr(obj, key)
+
+def _related_objects(obj, plan_field):
+    "Returns the related objects of ``obj`` as a list."
+    value = utils._get_plan_value(obj, plan_field)
+    if value is None:
+        return []
+    if isinstance(value, models.Model):
+        return [value]
+    return list(value)
+
+def _reset_related(context, reference, instance, plan_field, config):
+    """Reconciles the many-to-many or reverse foreign key objects of
+    ``instance`` with those of ``reference``. Objects are matched by their
+    key, matching objects are reset for deep resets. Missing many-to-many
+    objects are linked and missing reverse foreign key objects are forked.
+    Objects the reference does not have are unlinked or deleted.
+
+    The related objects of a deep fork are forks themselves, so matching them
+    by primary key would replace all of them. Deep resets raise a
+    ``ValueError`` unless ``match`` has a key for ``accessor``, or the objects
+    are matched through the memo.
+    """
+    accessor, field, direct, m2m, kind = plan_field[:5]
+
+    if m2m and not field.rel.through._meta.auto_created:
+        raise ValueError('Many-to-many relationships with custom through '
+            'models cannot be reset: {0}'.format(accessor))
+
+    key = _match_key(config['match'], accessor)
+    keyed = not config['deep'] or accessor in (config['match'] or ())
+    objs = dict([(key(obj), obj) for obj in _related_objects(instance, plan_field)])
+    keys = dict([(obj.pk, objkey) for objkey, obj in objs.items()])
+
+    added, matched, reset = [], set(), []
+    for refobj in _related_objects(reference, plan_field):
+        # objects already being reset within this reset are matched with
+        # their instance, e.g. relationships leading back up the tree
+        if context.memo.has(refobj):
+            refkey = keys.get(context.memo.get(refobj).pk)
+            if refkey is not None:
+                matched.add(refkey)
+                continue
+        elif not keyed:
+            raise ValueError('Related objects of deep resets must be matched '
+                'by a key in match, use "pk" to fork them again: '
+                '{0}'.format(accessor))
+
+        refkey = key(refobj)
+        obj = objs.get(refkey)
+        matched.add(refkey)
+
+        if obj is None:
+            added.append(refobj)
+        elif config['deep'] and obj.pk != refobj.pk:
+            reset.append(_memoize_reset(context, refobj, obj,
+                config=_nested_config(config)))
+
+    removed = [obj for objkey, obj in objs.items() if objkey not in matched]
+
+    if not m2m:
+        # the new objects are forks of the reference's, related to the
+        # instance. forks of objects that have been reset are the reset
+        # objects themselves
+        forks = []
+        for refobj in added:
+            # already being reset as part of another relationship
+            if context.memo.has(refobj):
+                continue
+            fork = fork_model_object(refobj, deep=config['deep'], commit=False,
+                memo=context.memo, **context.kwargs)
+            fork._commits.defer(field.name, instance, direct=True)
+            forks.append(fork)
+        added = forks
+
+    if added or removed or reset:
+        instance._commits.defer(accessor, utils.Reconcile(added, removed, reset))
+
+def _reset_field(context, reference, instance, plan_field, config):
     """Creates a copy of the reference value for the defined ``accessor``
     (field). For deep forks, each related object is related objects must
     be created first prior to being recursed.
     """
-    value, field, direct, m2m = utils._get_field_value(reference, accessor)
+    accessor, field, direct, m2m, kind = plan_field[:5]
 
-    # explicitly block reverse and m2m relationships..
+    # reverse and m2m relationships are only reset if requested, otherwise
+    # they are explicitly blocked
     if not direct or m2m:
+        if config['related']:
+            _reset_related(context, reference, instance, plan_field, config)
+        return
+
+    value = utils._get_plan_value(reference, plan_field)
+
+    if kind == plans.ONE2ONE:
+        return _reset_one2one(context, instance, value, field, direct,
+            accessor, config)
+
+    if kind == plans.FOREIGNKEY:
+        return _reset_foreignkey(context, instance, value, field, direct,
+            accessor, config)
+
+    # only changed fields are saved
+    if getattr(instance, accessor) == value:
         return
 
-    kwargs['commit'] = False
+    if context.stats is not None:
+        with context.stats.timer(reference.__class__, 'copy'):
+            value = plan_field.copy(value)
+    else:
+        value = plan_field.copy(value)
 
-    if isinstance(field, models.OneToOneField):
-        return _reset_one2one(instance, value, field, direct,
-            accessor, **kwargs)
+    setattr(instance, accessor, value)
+    instance._commits.changed.add(field.name)
 
-    if isinstance(field, models.ForeignKey):
-        return _reset_foreignkey(instance, value, field, direct,
-            accessor, **kwargs)
+def _reset_object(context, reference, instance, config):
+    "Resets each field of ``instance`` relative to ``reference``."
+    with context.timer(reference.__class__, 'traversal'):
+        _reset_fields(context, reference, instance, config)
 
-    # non-relational field, perform a deepcopy to ensure no mutable nonsense
-    setattr(instance, accessor, deepcopy(value))
+def _reset_fields(context, reference, instance, config):
+    # pre-signal
+    if context.listening(signals.pre_reset, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.pre_reset.send(sender=reference.__class__,
+                reference=reference, instance=instance, config=config,
+                **context.kwargs)
 
-def _memoize_reset(reference, instance, **kwargs):
-    "Resets the specified instance relative to ``reference``"
-    # popped so it does not get included in the config for the signal
-    memo = kwargs.pop('memo', None)
+    deep = config['deep']
 
-    # for every call, keep track of the reference and the object (fork).
-    # this is used for recursive calls to related objects. this ensures
+    # no fields are defined, so get the default ones for shallow or deep
+    fields = utils._model_fields(reference, config['fields'],
+        config['exclude'], deep)
+
+    # the post-signal is sent once all related objects have been reset
+    context.push(_post_reset, reference, instance, deep)
+
+    # iterate over each field and reset it. related objects are queued
+    # and reset in the order they are encountered
+    mark = context.mark()
+    for plan_field in fields:
+        _reset_field(context, reference, instance, plan_field, config)
+    context.reorder(mark)
+
+def _post_reset(context, reference, instance, deep):
+    if context.listening(signals.post_reset, reference.__class__):
+        with context.timer(reference.__class__, 'signals'):
+            signals.post_reset.send(sender=reference.__class__,
+                reference=reference, instance=instance, deep=deep,
+                **context.kwargs)
+
+def _memoize_reset(context, reference, instance, deep=False, config=None):
+    "Queues ``instance`` to be reset relative to ``reference``."
+    # keep track of the reference and the object (fork). this ensures
     # relationships that follow back up the tree are caught and are merely
     # referenced rather than traversed again.
-    if memo is None:
-        memo = utils.Memo()
-    elif memo.has(reference):
-        return memo.get(reference)
+    if context.memo.has(reference):
+        context.count(reference.__class__, 'memo_hits')
+        return context.memo.get(reference)
 
     if not isinstance(instance, reference.__class__):
         raise TypeError('The instance supplied must be of the same type as the reference')
 
     instance._commits = utils.Commits(reference)
-    memo.add(reference, instance)
+    instance._commits.changed = set()
+    context.memo.add(reference, instance)
+    context.count(reference.__class__, 'visited')
 
-    # default configuration
-    config = {
-        'fields': None,
-        'exclude': ['pk'],
-        'deep': False,
-        'commit': True,
-    }
+    # nested resets use the default configuration and are never committed
+    # until the whole tree has been traversed
+    if config is None:
+        config = _default_config(deep=deep)
 
-    # update with user-defined
-    config.update(kwargs)
+    context.push(_reset_object, reference, instance, config)
+    return instance
 
-    # pre-signal
-    signals.pre_reset.send(sender=reference.__class__, reference=reference,
-        instance=instance, config=config, **kwargs)
+@collect_stats('reset')
+def reset_model_object(reference, instance, **kwargs):
+    """Resets the ``instance`` object relative to ``reference``'s state. If
+    ``related`` is true, many-to-many and reverse foreign key relationships
+    are reconciled as well, see ``_reset_related``. If ``explain`` is true,
+    nothing is reset and an estimate of the size of the reset is returned
+    instead, see ``forkit.explain``. ``'exact'`` counts each object once.
+    """
+    config = _default_config()
+    config['commit'] = True
 
-    fields = config['fields']
-    exclude = config['exclude']
-    deep = config['deep']
-    commit = config['commit']
+    # pop off and set any config params for signals
+    for key in config:
+        if key in kwargs:
+            config[key] = kwargs.pop(key)
 
-    # no fields are defined, so get the default ones for shallow or deep
-    if not fields:
-        fields = utils._default_model_fields(reference, exclude=exclude, deep=deep)
+    stats = kwargs.pop('stats', None)
 
-    kwargs.update({'deep': deep})
+    explain = kwargs.pop('explain', False)
+    if explain:
+        return explain_model_object('reset', reference, config['fields'],
+            config['exclude'], config['deep'], bulk=config['bulk'],
+            commit=config['commit'], related=config['related'],
+            exact=explain == 'exact')
 
-    # iterate over each field and fork it!. nested calls will not commit,
-    # until the recursion has finished
-    for accessor in fields:
-        _reset_field(reference, instance, accessor, **kwargs)
+    context = utils.Context(memo=kwargs.pop('memo', None), stats=stats, **kwargs)
+    _memoize_reset(context, reference, instance, config=config)
+    context.run()
 
-    # post-signal
-    signals.post_reset.send(sender=reference.__class__, reference=reference,
-        instance=instance, **kwargs)
+    batches = _batches(signals.pre_reset_batch, signals.post_reset_batch,
+        [instance])
+    _send_batches(signals.pre_reset_batch, batches, **kwargs)
 
-    if commit:
-        commit_model_object(instance)
+    if config['commit']:
+        commit_model_object(instance, bulk=config['bulk'], stats=stats)
 
+    _send_batches(signals.post_reset_batch, batches, **kwargs)
     return instance
-
-def reset_model_object(reference, instance, **kwargs):
-    "Resets the ``instance`` object relative to ``reference``'s state."
-    return _memoize_reset(reference, instance, **kwargs)
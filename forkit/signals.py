@@ -1,4 +1,5 @@
 from django.dispatch import Signal
+from django.dispatch.dispatcher import _make_id
 
 pre_reset = Signal(providing_args=('reference', 'instance', 'config'))
 post_reset = Signal(providing_args=('reference', 'instance'))
@@ -11,3 +12,28 @@ post_diff = Signal(providing_args=('reference', 'instance', 'diff'))
 
 pre_commit = Signal(providing_args=('reference', 'instance'))
 post_commit = Signal(providing_args=('reference', 'instance'))
+
+# sent once per model with the list of (reference, instance) ``pairs``. the
+# fork and reset signals are sent before and after the objects are committed
+pre_fork_batch = Signal(providing_args=('pairs',))
+post_fork_batch = Signal(providing_args=('pairs',))
+
+pre_reset_batch = Signal(providing_args=('pairs',))
+post_reset_batch = Signal(providing_args=('pairs',))
+
+pre_commit_batch = Signal(providing_args=('pairs',))
+post_commit_batch = Signal(providing_args=('pairs',))
+
+# sent once per model by the SQL engine, with the primary keys to be copied
+# and the (old, new) primary keys once they have been copied
+pre_fork_sql = Signal(providing_args=('pks',))
+post_fork_sql = Signal(providing_args=('pks',))
+
+
+def has_receivers(signal, sender):
+    "Returns true if ``signal`` has any live receivers for ``sender``."
+    if not signal.receivers:
+        return False
+    if hasattr(signal, 'has_listeners'):
+        return signal.has_listeners(sender)
+    return bool(signal._live_receivers(_make_id(sender)))
@@ -0,0 +1,242 @@
+"""Captures the tree a fork of a reference would create into a snapshot, so
+it can be forked later, any number of times, without reading the reference
+tree again.
+
+A snapshot is a stream of JSON documents, one per line. The first line is a
+header holding the format version and the root object. It is followed by one
+line per object, in the order of dependency, holding it's model, column values
+and the objects it's foreign keys point to, and finally the links of each
+many-to-many through table, ``chunk_size`` links per line. Related objects
+are either objects of the snapshot, ``["ref", id]``, or existing objects which
+are not part of the snapshot, ``["pk", pk]``.
+
+Snapshots are read one line at a time. Objects are inserted in chunks as they
+are read, only a map of the snapshot ids to the new primary keys is kept.
+"""
+import json
+from django.db import transaction
+from forkit import utils, plans
+from forkit.fork import fork_model_object
+from forkit.commit import _collect_commits, _commit_levels
+
+FORMAT = 'forkit.snapshot'
+VERSION = 1
+
+def _dumps(data):
+    "Returns ``data`` as a line of text."
+    return u'{0}\n'.format(json.dumps(data, separators=(',', ':')))
+
+def _encode(field, obj):
+    "Encodes the value of ``field`` for ``obj`` as a string."
+    if getattr(obj, field.attname) is None:
+        return None
+    return field.value_to_string(obj)
+
+def _ref(value, ids):
+    "Encodes a related object."
+    if value is None:
+        return None
+    if id(value) in ids:
+        return ['ref', ids[id(value)]]
+    return ['pk', value.pk]
+
+def _links(obj, ids, links):
+    """Adds the many-to-many links of the pending ``obj`` to ``links``, keyed
+    by through table.
+    """
+    for accessor, value in obj._commits.related.items():
+        plan_field = plans.get_plan(obj.__class__).field(accessor)
+        if plan_field.kind != plans.MANY2MANY:
+            continue
+
+        field = plan_field.field
+        if not field.rel.through._meta.auto_created:
+            raise ValueError('Many-to-many relationships with custom through '
+                'models cannot be captured: {0}'.format(accessor))
+
+        if isinstance(value, utils.DeferredCommit):
+            value = value.value
+
+        # keyed by the direct side, so links are stored once
+        if plan_field.direct:
+            rows = [(_ref(obj, ids), _ref(rel, ids)) for rel in value]
+        else:
+            rows = [(_ref(rel, ids), _ref(obj, ids)) for rel in value]
+
+        pairs = links.setdefault((field.model, field.name), set())
+        pairs.update([(tuple(source), tuple(target)) for source, target in rows])
+
+def snapshot_model_object(reference, fileobj, chunk_size=500, **kwargs):
+    """Writes a snapshot of the tree forking ``reference`` would create to
+    ``fileobj``. Takes the same parameters as ``fork``, the reference tree is
+    traversed as a fork but nothing is committed. The links of each through
+    table are written ``chunk_size`` per line.
+    """
+    kwargs['commit'] = False
+    root = fork_model_object(reference, **kwargs)
+
+    pending = _collect_commits([root], utils.Memo())
+    levels = _commit_levels(pending)
+    pending.sort(key=lambda obj: (levels[id(obj)],
+        plans._model_label(obj.__class__)))
+
+    ids = dict([(id(obj), i) for i, obj in enumerate(pending)])
+
+    fileobj.write(_dumps({'format': FORMAT, 'version': VERSION,
+        'root': ids[id(root)], 'objects': len(pending)}))
+
+    links = {}
+
+    for obj in pending:
+        data = {'id': ids[id(obj)], 'model': plans._model_label(obj.__class__),
+            'fields': {}, 'related': {}}
+
+        for field in obj._meta.fields:
+            if field.primary_key:
+                continue
+            if field.rel is None:
+                data['fields'][field.attname] = _encode(field, obj)
+                continue
+
+            value = obj._commits.direct.get(field.name)
+            if value is not None:
+                data['related'][field.attname] = _ref(value, ids)
+            # related objects which are not forked keep their value
+            elif getattr(obj, field.attname) is not None:
+                data['related'][field.attname] = ['pk', getattr(obj, field.attname)]
+            else:
+                data['related'][field.attname] = None
+
+        _links(obj, ids, links)
+        fileobj.write(_dumps(data))
+
+    while links:
+        (model, name), pairs = links.popitem()
+        label = plans._model_label(model)
+        for chunk in utils._chunks(sorted(pairs), chunk_size):
+            fileobj.write(_dumps({'links': label, 'field': name,
+                'rows': [list(pair) for pair in chunk]}))
+
+    # the pending forks are discarded
+    for obj in pending:
+        del obj._commits
+
+
+class _Replay(object):
+    "Inserts the objects of a snapshot as they are read."
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        # the snapshot ids of the inserted objects mapped to their primary key
+        self.pks = {}
+        # foreign keys pointing to objects further on in the snapshot
+        self.fixups = []
+        self.model = None
+        self.batch = []
+        self.batch_ids = set()
+
+    def resolve(self, ref):
+        if ref is None:
+            return None
+        kind, value = ref
+        if kind == 'pk':
+            return value
+        return self.pks.get(value)
+
+    def add(self, data):
+        model = plans._label_model(data['model'])
+        related = data['related']
+
+        # objects depending on an object of the current batch are inserted
+        # by the next one
+        depends = [ref[1] for ref in related.values()
+            if ref is not None and ref[0] == 'ref' and ref[1] in self.batch_ids]
+        if model is not self.model or depends or len(self.batch) >= self.chunk_size:
+            self.flush()
+        self.model = model
+
+        obj = model()
+        for field in model._meta.fields:
+            if field.primary_key:
+                continue
+            if field.rel is None:
+                if field.attname in data['fields']:
+                    value = data['fields'][field.attname]
+                    if value is not None:
+                        value = field.to_python(value)
+                    setattr(obj, field.attname, value)
+            elif field.attname in related:
+                ref = related[field.attname]
+                value = self.resolve(ref)
+                # the object is further on in the snapshot
+                if value is None and ref is not None:
+                    self.fixups.append((obj, field, ref[1]))
+                setattr(obj, field.attname, value)
+
+        self.batch.append((data['id'], obj))
+        self.batch_ids.add(data['id'])
+
+    def flush(self):
+        if not self.batch:
+            return
+        utils._bulk_insert(self.model, [obj for i, obj in self.batch])
+        for i, obj in self.batch:
+            self.pks[i] = obj.pk
+        self.batch = []
+        self.batch_ids = set()
+
+    def fix(self):
+        "Sets the foreign keys to objects which were inserted later."
+        for obj, field, ref in self.fixups:
+            obj.__class__._base_manager.filter(pk=obj.pk).update(
+                **{field.name: self.pks[ref]})
+        self.fixups = []
+
+    def link(self, data):
+        model = plans._label_model(data['links'])
+        field = model._meta.get_field(data['field'])
+        through = field.rel.through
+        source = through._meta.get_field(field.m2m_field_name()).attname
+        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+
+        # each line holds a chunk of the links, inserted as it's read
+        rows = [through(**{source: self.resolve(s), target: self.resolve(t)})
+            for s, t in data['rows']]
+        for chunk in utils._chunks(rows):
+            utils._bulk_insert(through, chunk, pks=False)
+
+@transaction.commit_on_success
+def fork_snapshot(fileobj, chunk_size=500):
+    """Forks the tree captured in the snapshot ``fileobj`` and returns the
+    root fork. The snapshot is read a line at a time and the objects are
+    inserted ``chunk_size`` at a time within a single transaction. No signals
+    are sent.
+    """
+    lines = iter(fileobj)
+    header = json.loads(next(lines))
+    if header.get('format') != FORMAT or header.get('version') != VERSION:
+        raise ValueError('Unsupported snapshot format: {0} {1}'.format(
+            header.get('format'), header.get('version')))
+
+    replay = _Replay(chunk_size)
+    root = header['root']
+    root_model = None
+
+    for line in lines:
+        if not line.strip():
+            continue
+        data = json.loads(line)
+
+        if 'links' in data:
+            replay.flush()
+            replay.fix()
+            replay.link(data)
+            continue
+
+        if data['id'] == root:
+            root_model = plans._label_model(data['model'])
+        replay.add(data)
+
+    replay.flush()
+    replay.fix()
+
+    return root_model._default_manager.get(pk=replay.pks[root])
@@ -0,0 +1,274 @@
+"""Forks objects inside the database. The objects reachable from the
+reference are found level by level, each is assigned a new primary key in the
+``forkit_pkmap`` table, and the rows of each model and many-to-many table are
+copied using a single ``INSERT ... SELECT`` which remaps the foreign keys by
+joining against the mapping. No model instances are created.
+"""
+from django.core.management.color import no_style
+from django.db import models, connections, router, transaction
+from forkit import utils, plans, signals
+
+def _check_model(model):
+    opts = model._meta
+    if opts.parents:
+        raise ValueError('The SQL engine does not support inherited models: '
+            '{0}'.format(opts.object_name))
+    if not isinstance(opts.pk, models.AutoField):
+        raise ValueError('The SQL engine requires an auto-incrementing primary '
+            'key: {0}'.format(opts.object_name))
+
+def _check_foreignkey(field):
+    if field.rel.get_related_field() is not field.rel.to._meta.pk:
+        raise ValueError('The SQL engine only supports foreign keys to the '
+            'primary key: {0}'.format(field.name))
+
+def _related_pks(model, plan_field, pks):
+    """Returns the related model and primary keys of the objects related to
+    ``pks`` through ``plan_field``.
+    """
+    accessor, field, direct, m2m, kind = plan_field[:5]
+    related = set()
+
+    if kind == plans.MANY2MANY:
+        if direct:
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            related_model = field.rel.to
+        else:
+            source, target = field.m2m_reverse_field_name(), field.m2m_field_name()
+            related_model = field.model
+        queryset = field.rel.through._default_manager.all()
+        lookup, values = source, target
+    elif direct:
+        _check_foreignkey(field)
+        related_model = field.rel.to
+        queryset = model._default_manager.all()
+        lookup, values = 'pk', field.attname
+    else:
+        _check_foreignkey(field)
+        related_model = field.model
+        queryset = field.model._default_manager.all()
+        lookup, values = field.name, 'pk'
+
+    for chunk in utils._chunks(pks):
+        related.update(queryset.filter(**{'{0}__in'.format(lookup): chunk})
+            .values_list(values, flat=True))
+
+    related.discard(None)
+    return related_model, related
+
+def _collect(reference, deep):
+    """Returns the primary keys of the objects a fork of ``reference`` copies,
+    keyed by model, and the many-to-many fields encountered. The tree is
+    read one level at a time.
+    """
+    model = reference.__class__
+    tree = {model: set([reference.pk])}
+    throughs = {}
+    frontier = {model: [reference.pk]}
+
+    while frontier:
+        next_frontier = {}
+
+        for model, pks in frontier.items():
+            _check_model(model)
+
+            for plan_field in utils._model_fields(model, deep=deep):
+                if plan_field.kind == plans.LOCAL:
+                    continue
+
+                if plan_field.kind == plans.MANY2MANY:
+                    through = plan_field.field.rel.through
+                    if not through._meta.auto_created:
+                        raise ValueError('The SQL engine does not support '
+                            'custom through models: {0}'.format(plan_field.accessor))
+                    throughs[through] = plan_field.field
+
+                # shallow forks only copy the reference itself
+                if not deep:
+                    continue
+
+                related_model, related = _related_pks(model, plan_field, pks)
+                new = related - tree.get(related_model, set())
+                if new:
+                    tree.setdefault(related_model, set()).update(new)
+                    next_frontier.setdefault(related_model, []).extend(new)
+
+        frontier = next_frontier
+
+    return tree, throughs
+
+def _dependency_order(models_list):
+    """Orders ``models_list`` so models come after the models their foreign
+    keys point to, where possible. Cycles are broken arbitrarily.
+    """
+    ordered = []
+    seen = set()
+
+    for model in models_list:
+        stack = [(model, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if expanded:
+                ordered.append(current)
+                continue
+            if current in seen:
+                continue
+            seen.add(current)
+            stack.append((current, True))
+            for field in current._meta.fields:
+                if field.rel and field.rel.to in models_list:
+                    stack.append((field.rel.to, False))
+
+    return ordered
+
+def _reserve_pks(cursor, connection, model, count):
+    """Reserves ``count`` new primary keys for ``model`` and returns them in
+    ascending order. Postgres takes them from the sequence of the table,
+    other backends lock the table for the rest of the transaction and use
+    the keys following the largest one.
+    """
+    opts = model._meta
+    qn = connection.ops.quote_name
+
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+            'FROM generate_series(1, %s)', [opts.db_table, opts.pk.column, count])
+        return sorted([row[0] for row in cursor.fetchall()])
+
+    # SQLite holds the database write lock once the transaction has written
+    # to it, see ``fork_model_object``
+    if connection.vendor == 'mysql':
+        sql = 'SELECT MAX({0}) FROM {1} FOR UPDATE'
+    elif connection.vendor == 'sqlite':
+        sql = 'SELECT MAX({0}) FROM {1}'
+    else:
+        cursor.execute('LOCK TABLE {0} IN EXCLUSIVE MODE'.format(
+            qn(opts.db_table)))
+        sql = 'SELECT MAX({0}) FROM {1}'
+
+    cursor.execute(sql.format(qn(opts.pk.column), qn(opts.db_table)))
+    start = (cursor.fetchone()[0] or 0) + 1
+    return list(range(start, start + count))
+
+def _write_pkmap(cursor, connection, pkmap, operation, ids, tree):
+    """Assigns each object a new primary key reserved by ``_reserve_pks``.
+    Returns the (old, new) primary keys per model.
+    """
+    pairs = {}
+    for model, pks in tree.items():
+        pks = sorted(pks)
+        pairs[model] = list(zip(pks, _reserve_pks(cursor, connection, model,
+            len(pks))))
+        for chunk in utils._chunks(pairs[model]):
+            cursor.executemany('INSERT INTO {0} (operation, model, old, new) '
+                'VALUES (%s, %s, %s, %s)'.format(pkmap),
+                [(operation, ids[model], old, new) for old, new in chunk])
+
+    return pairs
+
+def _copy_model(cursor, qn, pkmap, operation, ids, model, deep):
+    "Copies the rows of ``model`` with their new and remapped keys."
+    opts = model._meta
+    columns, select, params = [], [], []
+
+    for field in opts.fields:
+        columns.append(qn(field.column))
+        column = 't.{0}'.format(qn(field.column))
+
+        if field.primary_key:
+            select.append('m.new')
+        elif field.rel is None:
+            select.append(column)
+        # one-to-ones are only forked by deep forks due to the unique constraint
+        elif isinstance(field, models.OneToOneField) and not deep:
+            select.append('NULL')
+        elif field.rel.to in ids:
+            select.append('COALESCE((SELECT f.new FROM {0} f WHERE '
+                'f.operation = %s AND f.model = %s AND f.old = {1}), {1})'
+                .format(pkmap, column))
+            params.extend([operation, ids[field.rel.to]])
+        else:
+            select.append(column)
+
+    params.extend([operation, ids[model]])
+    cursor.execute('INSERT INTO {table} ({columns}) SELECT {select} FROM {table} t '
+        'INNER JOIN {pkmap} m ON m.operation = %s AND m.model = %s '
+        'AND m.old = t.{pk}'.format(table=qn(opts.db_table),
+            columns=', '.join(columns), select=', '.join(select), pkmap=pkmap,
+            pk=qn(opts.pk.column)),
+        params)
+
+def _copy_links(cursor, qn, pkmap, operation, ids, through, field):
+    """Copies the many-to-many links of the forked objects. Either side which
+    has not been forked keeps pointing to the original object.
+    """
+    source = qn(field.m2m_column_name())
+    target = qn(field.m2m_reverse_name())
+
+    cursor.execute('INSERT INTO {table} ({source}, {target}) '
+        'SELECT COALESCE(ms.new, t.{source}), COALESCE(mt.new, t.{target}) '
+        'FROM {table} t '
+        'LEFT OUTER JOIN {pkmap} ms ON ms.operation = %s AND ms.model = %s '
+            'AND ms.old = t.{source} '
+        'LEFT OUTER JOIN {pkmap} mt ON mt.operation = %s AND mt.model = %s '
+            'AND mt.old = t.{target} '
+        'WHERE ms.new IS NOT NULL OR mt.new IS NOT NULL'.format(
+            table=qn(through._meta.db_table), source=source, target=target,
+            pkmap=pkmap),
+        [operation, ids.get(field.model, -1), operation, ids.get(field.rel.to, -1)])
+
+@transaction.commit_on_success
+def fork_model_object(reference, deep=False, **kwargs):
+    """Forks ``reference`` using ``INSERT ... SELECT`` statements, one per
+    model and many-to-many table, and returns the fork. The primary keys of
+    the new objects are reserved before they are copied, so the tables may
+    be written to concurrently, see ``_reserve_pks``.
+
+    Instead of the per-object signals, ``pre_fork_sql`` is sent once per
+    model with the primary keys to be copied and ``post_fork_sql`` with the
+    (old, new) primary keys once all rows have been copied.
+    """
+    # imported here since ``forkit.models`` depends on the tools
+    from forkit.models import PkMap, PkMapOperation
+
+    model = reference.__class__
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    pkmap = qn(PkMap._meta.db_table)
+
+    tree, throughs = _collect(reference, deep)
+
+    for related_model, pks in tree.items():
+        signals.pre_fork_sql.send(sender=related_model, pks=sorted(pks), **kwargs)
+
+    ordered = _dependency_order(tree.keys())
+    ids = dict([(related_model, i) for i, related_model in enumerate(ordered)])
+    # identifies the mapping rows of this fork. the insert takes the write
+    # lock of SQLite databases before any keys are read
+    record = PkMapOperation.objects.using(connection.alias).create()
+    operation = record.pk
+
+    cursor = connection.cursor()
+    pairs = _write_pkmap(cursor, connection, pkmap, operation, ids, tree)
+
+    for related_model in ordered:
+        _copy_model(cursor, qn, pkmap, operation, ids, related_model, deep)
+
+    for through, field in throughs.items():
+        _copy_links(cursor, qn, pkmap, operation, ids, through, field)
+
+    cursor.execute('DELETE FROM {0} WHERE operation = %s'.format(pkmap), [operation])
+    record.delete()
+
+    # the sequences of backends such as oracle must follow the new keys, the
+    # keys of postgres were taken from it's sequences
+    if connection.vendor != 'postgresql':
+        for sql in connection.ops.sequence_reset_sql(no_style(), ordered):
+            cursor.execute(sql)
+
+    for related_model in ordered:
+        signals.post_fork_sql.send(sender=related_model,
+            pks=pairs[related_model], **kwargs)
+
+    root = dict(pairs[model])[reference.pk]
+    return model._default_manager.using(connection.alias).get(pk=root)
@@ -0,0 +1,221 @@
+from functools import wraps
+from timeit import default_timer
+from django.db import connections
+from forkit import plans
+
+PHASES = ('traversal', 'copy', 'signals', 'commit')
+
+
+class CountingCursor(object):
+    """Wraps a database cursor, counting the queries it executes towards the
+    ``ForkStats`` collector ``stats``.
+    """
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, *args, **kwargs):
+        self.stats._queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.stats._queries += 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        self.cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.cursor.__exit__(*args)
+
+
+class ModelStats(object):
+    "The numbers recorded for a single model."
+    __slots__ = ('visited', 'memo_hits', 'queries', 'inserted', 'updated', 'times')
+
+    def __init__(self):
+        self.visited = 0
+        self.memo_hits = 0
+        self.queries = 0
+        self.inserted = 0
+        self.updated = 0
+        # seconds spent in each phase, see ``PHASES``
+        self.times = dict.fromkeys(PHASES, 0.0)
+
+    def __repr__(self):
+        return '<ModelStats: {0}>'.format(self.as_dict())
+
+    def as_dict(self):
+        return {
+            'visited': self.visited,
+            'memo_hits': self.memo_hits,
+            'queries': self.queries,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'times': dict(self.times),
+        }
+
+
+class Timer(object):
+    """Measures the time and number of queries spent in a phase for a model.
+    Timers may be nested, the time and queries of nested timers are only
+    counted towards the innermost one.
+    """
+    __slots__ = ('stats', 'model', 'phase', 'start', 'queries', 'nested')
+
+    def __init__(self, stats, model, phase):
+        self.stats = stats
+        self.model = model
+        self.phase = phase
+
+    def __enter__(self):
+        self.stats._stack.append(self)
+        self.nested = [0.0, 0]
+        self.queries = self.stats._queries
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = default_timer() - self.start
+        queries = self.stats._queries - self.queries
+
+        stack = self.stats._stack
+        stack.pop()
+        if stack:
+            nested = stack[-1].nested
+            nested[0] += elapsed
+            nested[1] += queries
+
+        stats = self.stats[self.model]
+        stats.times[self.phase] += elapsed - self.nested[0]
+        stats.queries += queries - self.nested[1]
+
+
+class NullTimer(object):
+    "Used in place of a ``Timer`` when no stats are being collected."
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+null_timer = NullTimer()
+
+def timer(stats, model, phase):
+    "Returns a timer for ``phase`` of ``model``, if ``stats`` is supplied."
+    if stats is None:
+        return null_timer
+    return stats.timer(model, phase)
+
+
+class ForkStats(object):
+    """Collects per-model statistics for ``fork``, ``reset``, ``diff`` and
+    ``commit`` when passed as the ``stats`` keyword argument. The same
+    collector may be passed to several operations to accumulate the numbers.
+
+    ``export`` is called with the collector and the name of the operation
+    once each top-level operation has finished, e.g. to send the numbers to
+    a metrics system. Queries are counted by wrapping the cursors of the
+    connections for the duration of the operation, the query log is left
+    alone.
+    """
+    def __init__(self, export=None):
+        self.models = {}
+        self._export = export
+        self._stack = []
+        self._operations = 0
+        # the number of queries executed so far
+        self._queries = 0
+        # connection alias -> the ``cursor`` attribute replaced on the
+        # connection, if any
+        self._cursors = {}
+
+    def __getitem__(self, model):
+        label = plans._model_label(model)
+        stats = self.models.get(label)
+        if stats is None:
+            stats = self.models[label] = ModelStats()
+        return stats
+
+    def count(self, model, name, value=1):
+        "Increments the counter ``name`` of ``model``."
+        stats = self[model]
+        setattr(stats, name, getattr(stats, name) + value)
+
+    def timer(self, model, phase):
+        "Returns a context manager timing ``phase`` for ``model``."
+        return Timer(self, model, phase)
+
+    def begin(self):
+        "Marks the start of an operation. Operations may be nested."
+        if not self._operations:
+            for connection in connections.all():
+                self._count_queries(connection)
+        self._operations += 1
+
+    def _count_queries(self, connection):
+        "Wraps the cursors ``connection`` returns in a ``CountingCursor``."
+        self._cursors[connection.alias] = connection.__dict__.get('cursor')
+        cursor = connection.cursor
+
+        def counting_cursor(*args, **kwargs):
+            return CountingCursor(cursor(*args, **kwargs), self)
+        connection.cursor = counting_cursor
+
+    def _restore(self):
+        for connection in connections.all():
+            if connection.alias not in self._cursors:
+                continue
+            cursor = self._cursors.pop(connection.alias)
+            if cursor is None:
+                del connection.cursor
+            else:
+                connection.cursor = cursor
+
+    def end(self, operation):
+        """Marks the end of ``operation``. The numbers are exported once the
+        top-level operation has ended.
+        """
+        self._operations -= 1
+        if not self._operations:
+            self._restore()
+            self.export(operation)
+
+    def export(self, operation):
+        "Calls the ``export`` hook, if any."
+        if self._export is not None:
+            self._export(self, operation)
+
+    def as_dict(self):
+        "Returns the numbers keyed by model label."
+        return dict([(label, stats.as_dict())
+            for label, stats in self.models.items()])
+
+
+def collect_stats(operation):
+    """Decorates a tool function accepting a ``stats`` keyword argument, so
+    the collector is told when ``operation`` begins and ends.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = kwargs.get('stats')
+            if stats is None:
+                return func(*args, **kwargs)
+
+            stats.begin()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.end(operation)
+        return wrapper
+    return decorator
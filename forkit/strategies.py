@@ -0,0 +1,86 @@
+from copy import copy, deepcopy
+from django.db import models
+
+def identity(value):
+    "Immutable values (strings, numbers, dates) are shared rather than copied."
+    return value
+
+def shallow(value):
+    "Copies the container only, e.g. a flat ``dict`` or ``list``."
+    return copy(value)
+
+def copy_json(value):
+    """Copies JSON-like values. Nested ``dict``s and ``list``s are copied, all
+    other values are assumed to be immutable.
+    """
+    if type(value) is dict:
+        return dict([(key, copy_json(item)) for key, item in value.items()])
+    if type(value) is list:
+        return [copy_json(item) for item in value]
+    return value
+
+
+# strategies which apply to subclasses of the field class as well
+_strategies = {}
+# strategies which only apply to the field class itself. custom fields which
+# subclass e.g. ``TextField`` are free to have mutable values
+_exact = {}
+# the built-in strategies, which only apply to the field class itself and
+# give way to any registered strategy
+_defaults = {}
+
+def register(field_class, strategy, subclasses=True):
+    """Registers ``strategy`` for copying the values of ``field_class``
+    fields when forking and resetting. ``strategy`` takes a value and
+    returns the copy. Strategies are resolved once per field when a
+    model's plan is compiled, so compiled plans are discarded.
+    """
+    if subclasses:
+        _strategies[field_class] = strategy
+    else:
+        _exact[field_class] = strategy
+
+    from forkit import plans
+    plans.clear()
+
+def unregister(field_class):
+    """Removes the strategies registered for ``field_class``, restoring the
+    built-in strategy if there is one.
+    """
+    _strategies.pop(field_class, None)
+    _exact.pop(field_class, None)
+
+    from forkit import plans
+    plans.clear()
+
+def get_strategy(field):
+    """Returns the copy strategy for ``field``. Fields without a registered
+    strategy fall back to ``deepcopy``.
+    """
+    strategy = _exact.get(field.__class__)
+    if strategy is not None:
+        return strategy
+
+    for cls in field.__class__.__mro__:
+        strategy = _strategies.get(cls)
+        if strategy is not None:
+            return strategy
+
+    return _defaults.get(field.__class__, deepcopy)
+
+
+for field_class in (
+        models.AutoField, models.BigIntegerField, models.BooleanField,
+        models.CharField, models.DateField, models.DateTimeField,
+        models.DecimalField, models.EmailField, models.FilePathField,
+        models.FloatField, models.IntegerField, models.NullBooleanField,
+        models.PositiveIntegerField, models.PositiveSmallIntegerField,
+        models.SlugField, models.SmallIntegerField, models.TextField,
+        models.TimeField, models.URLField):
+    _defaults[field_class] = identity
+
+# not available in all versions of Django
+for name in ('CommaSeparatedIntegerField', 'IPAddressField',
+        'GenericIPAddressField', 'UUIDField'):
+    if hasattr(models, name):
+        _defaults[getattr(models, name)] = identity
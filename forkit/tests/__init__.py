@@ -4,3 +4,14 @@ from forkit.tests.diff import *
 from forkit.tests.fork import *
 from forkit.tests.reset import *
 from forkit.tests.signals import *
+from forkit.tests.commit import *
+from forkit.tests.prefetch import *
+from forkit.tests.strategies import *
+from forkit.tests.stats import *
+from forkit.tests.aio import *
+from forkit.tests.checkpoints import *
+from forkit.tests.explain import *
+from forkit.tests.snapshot import *
+from forkit.tests.cache import *
+from forkit.tests.pruning import *
+from forkit.tests.lazy import *
@@ -0,0 +1,99 @@
+import os
+from django.test import TestCase
+from django.utils import unittest
+from forkit.tests.models import Author, Post, Blog, Tag
+
+try:
+    import asyncio
+    from concurrent.futures import Executor, Future
+    from forkit import aio
+except ImportError:
+    asyncio = None
+
+__all__ = ('AsyncModuleTestCase', 'AsyncTestCase')
+
+if asyncio is not None:
+    class InlineExecutor(Executor):
+        """Runs the calls in the calling thread, since the in-memory test
+        database is not shared between threads.
+        """
+        def submit(self, func, *args, **kwargs):
+            future = Future()
+            future.set_result(func(*args, **kwargs))
+            return future
+
+
+class AsyncModuleTestCase(TestCase):
+    def test_compile(self):
+        "The module compiles on every Python version the package supports."
+        import forkit
+        path = os.path.join(os.path.dirname(forkit.__file__), 'aio.py')
+        with open(path) as source:
+            compile(source.read(), path, 'exec')
+
+
+@unittest.skipIf(asyncio is None, 'asyncio is not available')
+class AsyncTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+        self.executor = InlineExecutor()
+
+    def new_event_loop(self):
+        "Returns a new event loop, which is the current one until the test ends."
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(loop.close)
+        return loop
+
+    def run_until_complete(self, awaitable):
+        "Runs ``awaitable`` on a new event loop."
+        return self.new_event_loop().run_until_complete(awaitable)
+
+    def test_afork(self):
+        fork = self.run_until_complete(aio.afork(self.post, deep=True,
+            executor=self.executor))
+
+        self.assertNotEqual(fork.pk, self.post.pk)
+        self.assertEqual(fork.title, self.post.title)
+        self.assertEqual(fork.tags.count(), self.post.tags.count())
+
+    def test_afork_many(self):
+        count = Author.objects.count()
+        forks = self.run_until_complete(aio.afork_many(Author.objects.all(),
+            executor=self.executor))
+        self.assertEqual(len(forks), count)
+        self.assertEqual(Author.objects.count(), count * 2)
+
+    def test_areset_adiff(self):
+        fork = self.post.fork()
+        fork.title = 'Changed'
+
+        diff = self.run_until_complete(aio.adiff(self.post, fork,
+            executor=self.executor))
+        self.assertEqual(diff, {'title': 'Changed'})
+
+        self.run_until_complete(aio.areset(self.post, fork,
+            executor=self.executor))
+        self.assertEqual(fork.title, self.post.title)
+
+    def test_acommit(self):
+        fork = self.run_until_complete(aio.afork(self.author, commit=False,
+            executor=self.executor))
+        self.assertEqual(fork.pk, None)
+
+        self.run_until_complete(aio.acommit(fork, executor=self.executor))
+        self.assertNotEqual(fork.pk, None)
+
+    def test_concurrent(self):
+        "Calls created before the loop runs are scheduled on it once awaited."
+        loop = self.new_event_loop()
+        tasks = [loop.create_task(aio.afork(self.post, deep=True,
+            executor=self.executor)) for i in range(3)]
+        loop.run_until_complete(asyncio.wait(tasks))
+
+        forks = [task.result() for task in tasks]
+        self.assertEqual(len(set([fork.pk for fork in forks])), 3)
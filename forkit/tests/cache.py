@@ -0,0 +1,113 @@
+from django.db.models import Q
+from django.test import TestCase
+from forkit import cache
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('CacheTestCase',)
+
+class CacheTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        cache.clear()
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_cached_fork(self):
+        fork = self.author.fork(deep=True, cache=True)
+        self.assertEqual(len(cache.get_cache()), 1)
+        self.assertEqual(fork.posts.all()[0].tags.count(), 3)
+
+        # committing the fork leaves the cached tree intact, later forks do
+        # not read the reference tree
+        with self.assertNumQueries(0):
+            fork = self.author.fork(deep=True, cache=True, commit=False)
+
+        self.assertEqual(len(cache.get_cache()), 1)
+        fork.commit()
+        self.assertEqual(Author.objects.count(), 6)
+        self.assertEqual(Post.objects.count(), 3)
+        self.assertEqual(Tag.objects.count(), 9)
+        self.assertFalse(hasattr(self.author, '_prefetched'))
+
+    def test_configuration(self):
+        self.author.fork(deep=True, cache=True, commit=False)
+        self.author.fork(cache=True, commit=False)
+        self.assertEqual(len(cache.get_cache()), 2)
+
+    def test_invalidate_object(self):
+        self.author.fork(deep=True, cache=True, commit=False)
+
+        # unrelated objects leave the tree intact
+        Tag.objects.create(name='unrelated')
+        self.assertEqual(len(cache.get_cache()), 1)
+
+        self.post.title = 'Changed'
+        self.post.save()
+        self.assertEqual(len(cache.get_cache()), 0)
+
+        root = cache.load(self.author, deep=True)
+        self.assertEqual(root._prefetched['posts'][0].title, 'Changed')
+
+    def test_invalidate_related(self):
+        self.post.fork(deep=True, cache=True, commit=False)
+
+        # a new object pointing to an object of the tree
+        Post.objects.create(title='New', blog=Blog.objects.get(pk=1))
+        self.assertEqual(len(cache.get_cache()), 0)
+
+        self.post.fork(deep=True, cache=True, commit=False)
+        self.post.tags.add(Tag.objects.create(name='new'))
+        self.assertEqual(len(cache.get_cache()), 0)
+
+    def test_invalidate_delete(self):
+        self.post.fork(deep=True, cache=True, commit=False)
+        Tag.objects.get(pk=1).delete()
+        self.assertEqual(len(cache.get_cache()), 0)
+
+    def test_follow(self):
+        def follow(blog):
+            return True
+
+        cache.load(self.author, deep=True, follow={'Blog': {'post_set': follow}})
+        with self.assertNumQueries(0):
+            cache.load(self.author, deep=True,
+                follow={'Blog': {'post_set': follow}})
+
+        # predicates are keyed by identity and held by the key, so another
+        # function cannot be mistaken for it
+        key = list(cache.get_cache()._trees.keys())[0]
+        self.assertEqual(key[-1], (('Blog', (('post_set', follow),)),))
+        cache.load(self.author, deep=True,
+            follow={'Blog': {'post_set': lambda blog: False}})
+        self.assertEqual(len(cache.get_cache()), 2)
+
+        # filters are keyed by their lookups
+        cache.load(self.author, deep=True,
+            follow={'Author': {'posts': Q(title='Nothing')}})
+        with self.assertNumQueries(0):
+            cache.load(self.author, deep=True,
+                follow={'Author': {'posts': Q(title='Nothing')}})
+        cache.load(self.author, deep=True,
+            follow={'Author': {'posts': Q(title='Other')}})
+        self.assertEqual(len(cache.get_cache()), 4)
+
+    def test_budget(self):
+        graphs = cache.GraphCache(max_objects=3)
+        tags = list(Tag.objects.all())
+
+        graphs.set('a', tags[0], tags[:2])
+        graphs.set('b', tags[1], tags[1:2])
+        self.assertTrue(graphs.get('a') is tags[0])
+
+        # the least recently used tree is discarded
+        graphs.set('c', tags[2], tags[2:])
+        self.assertEqual(graphs.get('b'), None)
+        self.assertTrue(graphs.get('a') is tags[0])
+        self.assertTrue(graphs.get('c') is tags[2])
+
+        graphs.invalidate([('obj', Tag, tags[2].pk)])
+        self.assertEqual(len(graphs), 1)
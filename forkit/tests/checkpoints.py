@@ -0,0 +1,68 @@
+from django.test import TestCase
+from forkit import signals
+from forkit.models import ForkCheckpoint
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('CheckpointTestCase',)
+
+class Interrupted(Exception):
+    pass
+
+
+class CheckpointTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.post = Post.objects.get(pk=1)
+
+    def test_checkpoint_fork(self):
+        fork = self.post.fork(deep=True, checkpoint='post', chunk_size=1)
+
+        self.assertEqual(fork.pk, 2)
+        self.assertFalse(hasattr(fork, '_commits'))
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(fork.authors.count(), 2)
+
+        checkpoint = ForkCheckpoint.objects.get(key='post')
+        self.assertTrue(checkpoint.complete)
+        self.assertEqual(checkpoint.fork, '2')
+        self.assertEqual(checkpoint.entries.count(), 0)
+
+        # a complete checkpoint returns the existing fork
+        self.assertEqual(self.post.fork(deep=True, checkpoint='post'), fork)
+        self.assertEqual(Post.objects.count(), 2)
+
+        author = Author.objects.get(pk=1)
+        self.assertRaises(ValueError, author.fork, checkpoint='post')
+
+    def test_resume(self):
+        commits = []
+
+        def interrupt(sender, instance, **kwargs):
+            commits.append(instance)
+            if len(commits) == 3:
+                raise Interrupted
+
+        signals.post_commit.connect(interrupt, sender=Tag)
+        try:
+            self.assertRaises(Interrupted, self.post.fork, deep=True,
+                checkpoint='post', chunk_size=1)
+        finally:
+            signals.post_commit.disconnect(interrupt, sender=Tag)
+
+        checkpoint = ForkCheckpoint.objects.get(key='post')
+        self.assertFalse(checkpoint.complete)
+        committed = checkpoint.entries.count()
+        self.assertTrue(committed >= 3)
+
+        tags = Tag.objects.count()
+        fork = self.post.fork(deep=True, checkpoint='post', chunk_size=1)
+
+        # the tags committed by the first attempt are not inserted again
+        self.assertEqual(Tag.objects.count(), tags)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(fork.authors.count(), 2)
+        self.assertTrue(ForkCheckpoint.objects.get(key='post').complete)
@@ -0,0 +1,95 @@
+from django.test import TestCase
+from forkit import signals
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('BulkCommitTestCase', 'ManyToManyCommitTestCase')
+
+class BulkCommitTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def test_bulk_deep_fork(self):
+        fork = self.author.fork(deep=True, bulk=True)
+
+        self.assertEqual(fork.pk, 3)
+
+        # same counts as a non-bulk deep fork
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        self.assertEqual(self.author.posts.through.objects.count(), 4)
+        post = fork.posts.all()[0]
+        self.assertEqual(post.tags.count(), 3)
+        self.assertEqual(post.blog.author, fork)
+
+    def test_bulk_commit(self):
+        fork = self.post.fork(deep=True, commit=False)
+        fork.commit(bulk=True)
+
+        self.assertEqual(fork.pk, 2)
+        self.assertFalse(hasattr(fork, '_commits'))
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(fork.authors.count(), 2)
+
+    def test_bulk_signals(self):
+        committed = []
+
+        def receiver(sender, instance, **kwargs):
+            committed.append(instance)
+
+        signals.post_commit.connect(receiver, sender=Tag)
+        self.post.fork(deep=True, bulk=True)
+        signals.post_commit.disconnect(receiver, sender=Tag)
+
+        self.assertEqual(len(committed), 3)
+        self.assertTrue(all(tag.pk for tag in committed))
+
+    def test_bulk_query_count(self):
+        # the number of queries of a bulk commit does not depend on the
+        # number of objects of each model
+        fork = self.post.fork(deep=True, commit=False)
+        with self.assertNumQueries(8):
+            fork.commit(bulk=True)
+
+        for i in range(20):
+            self.post.tags.add(Tag.objects.create(name='tag {0}'.format(i)))
+
+        fork = self.post.fork(deep=True, commit=False)
+        with self.assertNumQueries(8):
+            fork.commit(bulk=True)
+
+
+class ManyToManyCommitTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.post = Post.objects.get(pk=1)
+
+    def test_shallow_links(self):
+        fork = self.post.fork()
+        self.assertEqual(list(fork.tags.all()), list(self.post.tags.all()))
+        self.assertEqual(list(fork.authors.all()), list(self.post.authors.all()))
+
+        # reverse many-to-many
+        tag = Tag.objects.get(pk=1)
+        fork = tag.fork()
+        self.assertEqual(list(fork.post_set.all()), list(tag.post_set.all()))
+
+    def test_link_query_count(self):
+        # the number of queries does not depend on the number of links.
+        # the blog is cached on the post after the first lookup
+        self.post.blog
+        with self.assertNumQueries(5):
+            self.post.fork()
+
+        for i in range(20):
+            self.post.tags.add(Tag.objects.create(name='tag {0}'.format(i)))
+
+        with self.assertNumQueries(5):
+            self.post.fork()
@@ -1,4 +1,5 @@
 from django.test import TestCase
+from forkit.diff import Delta, diff_queryset, _diff_queryset
 from forkit.tests.models import Author, Post, Blog, Tag, C
 
 __all__ = ('DiffModelObjectTestCase',)
@@ -17,7 +18,7 @@ class DiffModelObjectTestCase(TestCase):
         self.assertEqual(diff, {
             'first_name': '',
             'last_name': '',
-            'posts': [],
+            'posts': Delta(added=[], removed=[1]),
         })
 
         diff = self.blog.diff(Blog())
@@ -29,15 +30,15 @@ class DiffModelObjectTestCase(TestCase):
         diff = self.post.diff(Post())
         self.assertEqual(diff, {
             'blog': None,
-            'authors': [],
-            'tags': [],
+            'authors': Delta(added=[], removed=[1, 2]),
+            'tags': Delta(added=[], removed=[1, 2, 3]),
             'title': '',
         })
 
         diff = self.tag.diff(Tag())
         self.assertEqual(diff, {
             'name': '',
-            'post_set': [],
+            'post_set': Delta(added=[], removed=[1]),
         })
 
     def test_fork_shallow_diff(self):
@@ -84,3 +85,55 @@ class DiffModelObjectTestCase(TestCase):
                 'title': 'foobar',
             }
         })
+
+    def test_related_delta(self):
+        fork = self.post.fork()
+        fork.tags.remove(Tag.objects.get(pk=2))
+        fork.tags.add(Tag.objects.create(name='new'))
+        tag = fork.tags.order_by('-pk')[0]
+
+        # each side is read with a single query, no objects are loaded
+        with self.assertNumQueries(2):
+            delta = self.post.diff(fork, fields=['tags'])
+        self.assertEqual(delta, {'tags': Delta(added=[tag.pk], removed=[2])})
+
+    def test_diff_queryset(self):
+        fork1 = self.post.fork()
+        fork2 = self.post.fork()
+        fork3 = self.post.fork()
+
+        Post.objects.filter(pk=fork2.pk).update(title='foobar')
+        blog = self.blog.fork(commit=False)
+        blog.author = Author.objects.create()
+        blog.commit()
+        Post.objects.filter(pk=fork3.pk).update(blog=blog)
+
+        # objects and primary keys can both be used
+        pairs = [(self.post, fork1), (self.post, fork2), (self.post.pk, fork3.pk)]
+        self.assertEqual(diff_queryset(pairs), {
+            (self.post.pk, fork2.pk): {'title': 'foobar'},
+            (self.post.pk, fork3.pk): {'blog_id': blog.pk},
+        })
+
+        pairs = [(1, fork1.pk), (1, fork2.pk)]
+        self.assertEqual(diff_queryset(pairs, model=Post, fields=['blog']), {})
+
+        # pairs with a missing row are reported rather than dropped
+        pk = fork1.pk
+        fork1.delete()
+        pairs = [(self.post.pk, pk), (pk, fork2.pk), (self.post.pk, fork2.pk)]
+        self.assertEqual(diff_queryset(pairs, model=Post), {
+            (self.post.pk, pk): None,
+            (pk, fork2.pk): None,
+            (self.post.pk, fork2.pk): {'title': 'foobar'},
+        })
+
+    def test_unordered_delta(self):
+        tags = list(Tag.objects.order_by('-pk'))
+        self.assertEqual(_diff_queryset(self.post, tags,
+            Tag.objects.order_by('pk')), None)
+
+        # unsaved objects never match
+        self.assertEqual(_diff_queryset(self.post, tags,
+            tags + [Tag(name='new'), Tag()]),
+            Delta(added=[None, None], removed=[]))
@@ -0,0 +1,123 @@
+from django.test import TestCase
+from forkit.explain import Explanation
+from forkit.tests.models import Author, Post, Blog, Tag, Revision
+
+__all__ = ('ExplainTestCase',)
+
+class ExplainTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def test_explain_shallow_fork(self):
+        with self.assertNumQueries(0):
+            explanation = self.author.fork(explain=True)
+
+        self.assertTrue(isinstance(explanation, Explanation))
+        self.assertEqual(explanation.rows, {'tests.author': 1})
+        self.assertEqual(explanation.order, ['tests.author'])
+        self.assertEqual(explanation.root.children, [])
+
+    def test_explain_deep_fork(self):
+        # a single query per relation followed
+        with self.assertNumQueries(9):
+            explanation = self.author.fork(deep=True, explain='exact')
+
+        self.assertEqual(Author.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 1)
+
+        # each object is counted once
+        rows = explanation.rows
+        self.assertEqual(rows, {'tests.author': 2, 'tests.post': 1,
+            'tests.blog': 1, 'tests.tag': 3})
+
+        # models are committed after the models they depend on
+        order = explanation.order
+        self.assertTrue(order.index('tests.blog') < order.index('tests.post'))
+        self.assertTrue(order.index('tests.author') < order.index('tests.blog'))
+
+        posts = explanation.root.children[0]
+        self.assertEqual(posts.accessor, 'posts')
+        self.assertEqual(posts.kind, 'many2many')
+        self.assertFalse(posts.memoized)
+
+        data = explanation.as_dict()
+        self.assertEqual(data['root']['children'][0]['model'], 'tests.post')
+        self.assertTrue(explanation.queries > sum(rows.values()))
+
+    def test_explain_reset_diff(self):
+        fork = self.post.fork(deep=True)
+
+        explanation = self.post.reset(fork, deep=True, explain='exact')
+        self.assertEqual(explanation.rows, {'tests.post': 1, 'tests.blog': 1,
+            'tests.author': 1})
+        self.assertEqual(explanation.order, ['tests.author', 'tests.blog',
+            'tests.post'])
+
+        explanation = self.post.diff(fork, deep=True, explain='exact')
+        self.assertEqual(explanation.operation, 'diff')
+        self.assertEqual(explanation.order, [])
+
+    def test_explain_count(self):
+        # a count query per relation followed
+        with self.assertNumQueries(10):
+            explanation = self.post.fork(deep=True, explain=True)
+
+        # objects reached through several relations are counted for each
+        self.assertEqual(explanation.rows, {'tests.post': 1, 'tests.blog': 2,
+            'tests.author': 3, 'tests.tag': 3})
+        exact = self.post.fork(deep=True, explain='exact')
+        for label, rows in exact.rows.items():
+            self.assertTrue(explanation.rows[label] >= rows)
+
+        # relations back to the model the objects were reached through are
+        # counted without those objects, but not followed
+        explanation = self.author.fork(deep=True, explain=True)
+        children = dict([(child.accessor, child)
+            for child in explanation.root.children])
+        authors = dict([(child.accessor, child)
+            for child in children['posts'].children])['authors']
+        self.assertEqual(authors.rows, 1)
+        self.assertTrue(authors.memoized)
+        self.assertEqual(authors.children, [])
+
+    def test_explain_chain(self):
+        revisions = [None]
+        for i in range(50):
+            revisions.append(Revision.objects.create(
+                title='Revision {0}'.format(i), previous=revisions[-1]))
+        revision = revisions[-1]
+
+        # the chain is followed to it's end
+        explanation = revision.fork(deep=True, explain='exact')
+        self.assertEqual(explanation.rows, {'tests.revision': 50})
+
+        fork = revision.fork(deep=True)
+        self.assertEqual(Revision.objects.count(), 100)
+
+        # followed down the chain as well
+        explanation = revisions[1].fork(deep=True, explain='exact')
+        self.assertEqual(explanation.rows, {'tests.revision': 50})
+        node = explanation.root
+        while node.children:
+            self.assertEqual(len(node.children), 1)
+            node = node.children[0]
+        self.assertEqual(node.accessor, 'next')
+        self.assertEqual(node.rows, 1)
+
+    def test_explain_memoized(self):
+        explanation = self.post.fork(deep=True, explain='exact')
+        self.assertEqual(explanation.rows, {'tests.post': 1, 'tests.blog': 1,
+            'tests.author': 2, 'tests.tag': 3})
+
+        # the blog's author is one of the post's authors, it's counted but
+        # not followed
+        children = dict([(child.accessor, child)
+            for child in explanation.root.children])
+        author = children['blog'].children[0]
+        self.assertEqual(author.accessor, 'author')
+        self.assertEqual(author.rows, 1)
+        self.assertTrue(author.memoized)
+        self.assertEqual(author.children, [])
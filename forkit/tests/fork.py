@@ -1,6 +1,7 @@
 from django.db import IntegrityError
 from django.test import TestCase
-from forkit.tests.models import Author, Post, Blog, Tag
+from forkit.models import PkMap, PkMapOperation
+from forkit.tests.models import Author, Post, Blog, Tag, Revision
 
 __all__ = ('ForkModelObjectTestCase',)
 
@@ -29,7 +30,8 @@ class ForkModelObjectTestCase(TestCase):
         fork2.commit()
         self.assertEqual(fork2.pk, 4)
         self.assertEqual(self.author.posts.through.objects.count(), 4)
-        self.assertEqual(fork2._commits.related, {})
+        # detached once committed
+        self.assertFalse(hasattr(fork2, '_commits'))
 
         # Post
 
@@ -122,3 +124,113 @@ class ForkModelObjectTestCase(TestCase):
         # 3 posts X 4 tags
         self.assertEqual(fork.post_set.through.objects.count(), 15)
 
+    def test_deep_fork_long_chain(self):
+        # longer than the default recursion limit
+        previous = None
+        for i in range(1500):
+            previous = Revision(title=str(i), previous=previous)
+            previous.save()
+
+        fork = previous.fork(deep=True)
+
+        self.assertEqual(Revision.objects.count(), 3000)
+        self.assertEqual(fork.title, '1499')
+        self.assertEqual(fork.previous.title, '1498')
+        self.assertNotEqual(fork.previous.pk, previous.previous.pk)
+
+    def test_fork_many(self):
+        post2 = Post(title='Django Tip: Managers', blog=self.blog)
+        post2.save()
+        post2.tags = self.post.tags.all()
+
+        forks = Post.objects.order_by('-pk').fork_many(deep=True, chunk_size=1)
+
+        self.assertEqual([fork.title for fork in forks],
+            ['Django Tip: Managers', 'Django Tip: Descriptors'])
+
+        # the blog, tags and authors are shared by both posts and only
+        # get forked once
+        self.assertEqual(Post.objects.count(), 4)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(forks[0].blog, forks[1].blog)
+        self.assertEqual(list(forks[0].tags.all()), list(forks[1].tags.all()))
+
+    def test_fork_many_bulk(self):
+        forks = Tag.objects.fork_many(bulk=True, prefetch=True)
+
+        self.assertEqual(len(forks), 3)
+        self.assertEqual(Tag.objects.count(), 6)
+        # shallow forks, 1 post X 6 tags
+        self.assertEqual(self.post.tags.count(), 6)
+
+    def test_fork_copies(self):
+        forks = self.post.fork(deep=True, copies=3)
+
+        self.assertEqual(len(forks), 3)
+        self.assertEqual(len(set([fork.pk for fork in forks])), 3)
+
+        # 3 independent trees
+        self.assertEqual(Post.objects.count(), 4)
+        self.assertEqual(Blog.objects.count(), 4)
+        self.assertEqual(Tag.objects.count(), 12)
+        self.assertEqual(Author.objects.count(), 8)
+
+        for fork in forks:
+            self.assertEqual(fork.title, self.post.title)
+            self.assertEqual(fork.tags.count(), 3)
+            self.assertEqual(fork.blog.post_set.get(), fork)
+            self.assertEqual(fork.blog.author.blog, fork.blog)
+
+    def test_fork_copies_reads(self):
+        # the number of reads does not depend on the number of copies
+        with self.assertNumQueries(13):
+            Post.objects.get(pk=1).fork(deep=True, copies=1, commit=False)
+        with self.assertNumQueries(13):
+            Post.objects.get(pk=1).fork(deep=True, copies=10, commit=False)
+
+    def test_sql_fork(self):
+        fork = self.post.fork(deep=True, engine='sql')
+
+        self.assertNotEqual(fork.pk, self.post.pk)
+        self.assertEqual(fork.title, self.post.title)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        # every relationship points to the forks
+        self.assertNotEqual(fork.blog.pk, self.blog.pk)
+        self.assertEqual(fork.blog.author.blog, fork.blog)
+        self.assertEqual(set([a.pk for a in fork.authors.all()]) &
+            set([a.pk for a in self.post.authors.all()]), set())
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(self.post.tags.count(), 3)
+        self.assertEqual(self.post.diff(fork, fields=['title']), {})
+
+    def test_sql_keys(self):
+        # the new keys follow the largest one without the gaps of the source
+        self.post.tags.add(Tag.objects.create(pk=10, name='sparse'))
+        self.post.fork(deep=True, engine='sql')
+
+        self.assertEqual(sorted(Tag.objects.values_list('pk', flat=True)),
+            [1, 2, 3, 10, 11, 12, 13, 14])
+        self.assertEqual(Tag.objects.create(name='next').pk, 15)
+
+    def test_sql_operation(self):
+        # the mapping rows of another fork in progress are left alone
+        other = PkMapOperation.objects.create()
+        PkMap.objects.create(operation=other.pk, model=0, old=1, new=2)
+
+        self.post.fork(deep=True, engine='sql')
+        self.assertEqual(list(PkMapOperation.objects.all()), [other])
+        self.assertEqual(PkMap.objects.get().operation, other.pk)
+
+    def test_sql_shallow_fork(self):
+        fork = self.post.fork(engine='sql')
+
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(fork.blog, self.blog)
+        self.assertEqual(list(fork.tags.all()), list(self.post.tags.all()))
+        self.assertEqual(self.post.diff(fork), {})
@@ -0,0 +1,201 @@
+import gc
+from django.db.models import Q
+from django.test import TestCase
+from forkit import lazy
+from forkit.lazy import materialize, materialize_all
+from forkit.models import ForkLazyTree, ForkLazyEntry, ForkLazyPending
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('LazyTestCase',)
+
+class LazyTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def tearDown(self):
+        # the forks are rolled back along with the test
+        lazy._registry.clear()
+        lazy._trees.clear()
+        lazy.uninstall()
+
+    def test_direct_only(self):
+        fork = self.post.fork(deep=True, lazy=True)
+
+        # the post, it's blog and the blog's author are forked, the tags and
+        # authors of the post are not
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(Tag.objects.count(), 3)
+        self.assertEqual(fork.title, self.post.title)
+        self.assertNotEqual(fork.blog_id, self.post.blog_id)
+        self.assertFalse(hasattr(self.post, '_lazy'))
+
+        # the reference's tree is untouched
+        self.assertEqual(list(self.post.blog.post_set.all()), [self.post])
+
+    def test_access(self):
+        fork = self.post.fork(deep=True, lazy=True)
+
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(set(fork.tags.all()) & set(self.post.tags.all()), set())
+
+        # accessed again, nothing is forked
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        # the blog's posts lead back to the fork
+        self.assertEqual(list(fork.blog.post_set.all()), [fork])
+        self.assertEqual(Post.objects.count(), 2)
+
+    def test_shared(self):
+        fork = self.post.fork(deep=True, lazy=True)
+        authors = Author.objects.count()
+
+        # the blog's author is linked to the post rather than forked again
+        # and the links are not written twice
+        blog_author = fork.blog.author
+        self.assertTrue(blog_author in fork.authors.all())
+        self.assertEqual(Author.objects.count(), authors + 1)
+        self.assertEqual(list(blog_author.posts.all()), [fork])
+        self.assertEqual(Post.objects.count(), 2)
+
+    def test_reverse_many2many(self):
+        fork = self.author.fork(deep=True, lazy=True)
+
+        # the post's authors are still pending, the link is written from the
+        # author's side
+        self.assertEqual(fork.posts.count(), 1)
+        post = fork.posts.get()
+        self.assertNotEqual(post.pk, self.post.pk)
+        self.assertEqual(list(self.author.posts.all()), [self.post])
+
+        # the post's other author is forked, the link to the fork is kept
+        self.assertEqual(post.authors.count(), 2)
+        self.assertTrue(fork in post.authors.all())
+        self.assertEqual(fork.posts.count(), 1)
+
+    def test_reload(self):
+        fork = self.post.fork(deep=True, lazy=True)
+
+        # a copy loaded from the database is intercepted as well
+        copy = Post.objects.get(pk=fork.pk)
+        self.assertEqual(copy.tags.count(), 3)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        # the relationship is no longer pending for the fork itself
+        self.assertEqual(fork.tags.count(), 3)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        materialize_all(copy)
+        self.assertEqual(fork._lazy, None)
+        self.assertEqual(Post.objects.get(pk=fork.pk).authors.count(), 2)
+        self.assertFalse(ForkLazyPending.objects.exists())
+
+    def test_rolled_back(self):
+        fork = self.post.fork(deep=True, lazy=True)
+        self.assertEqual(ForkLazyPending.objects.get(model='tests.post',
+            fork=fork.pk).accessors, 'authors,tags')
+
+        # the primary key of a fork which has been rolled back is reused
+        ForkLazyPending.objects.all().delete()
+        copy = Post.objects.get(pk=fork.pk)
+        self.assertEqual(copy.tags.count(), 0)
+        self.assertEqual(Tag.objects.count(), 3)
+        self.assertFalse(('tests.post', fork.pk) in lazy._registry)
+
+    def test_other_process(self):
+        fork = self.post.fork(deep=True, lazy=True, follow={'Post':
+            {'tags': Q(name__startswith='')}})
+        authors = Author.objects.count()
+        pk = fork.pk
+
+        # nothing is held by the process once the fork is no longer used
+        del fork
+        gc.collect()
+        self.assertEqual(len(lazy._registry), 0)
+        self.assertEqual(len(lazy._trees), 0)
+
+        # the state is rebuilt from the database, the blog's author is
+        # linked to the post rather than forked again
+        copy = Post.objects.get(pk=pk)
+        blog_author = copy.blog.author
+        self.assertTrue(blog_author in copy.authors.all())
+        self.assertEqual(Author.objects.count(), authors + 1)
+        self.assertEqual(list(copy._lazy.config['follow']), ['Post'])
+
+        # processes which have not forked the models lazily install them
+        lazy.uninstall()
+        lazy._registry.clear()
+        lazy._trees.clear()
+        lazy.install(Post, Author, Blog, Tag)
+
+        copy = Post.objects.get(pk=pk)
+        self.assertEqual(copy.tags.count(), 3)
+        materialize_all(copy)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(Author.objects.count(), authors + 1)
+        self.assertFalse(ForkLazyPending.objects.exists())
+        # the records are removed once the tree is complete
+        self.assertFalse(ForkLazyTree.objects.exists())
+        self.assertFalse(ForkLazyEntry.objects.exists())
+
+    def test_unpicklable(self):
+        self.assertRaises(ValueError, self.post.fork, deep=True, lazy=True,
+            follow={'Post': {'tags': lambda post: True}})
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_assign(self):
+        fork = self.post.fork(deep=True, lazy=True)
+        tag = Tag.objects.create(name='new')
+        fork.tags = [tag]
+
+        self.assertEqual(list(fork.tags.all()), [tag])
+        self.assertEqual(Tag.objects.count(), 4)
+
+    def test_materialize(self):
+        fork = self.author.fork(deep=True, lazy=True)
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(Blog.objects.count(), 1)
+
+        materialize(fork)
+        self.assertEqual(fork._lazy, None)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 2)
+        # the posts are lazy forks as well
+        self.assertEqual(Tag.objects.count(), 3)
+
+        with self.assertNumQueries(0):
+            materialize(fork)
+
+    def test_materialize_all(self):
+        fork = self.author.fork(deep=True, lazy=True)
+        materialize_all(fork)
+
+        # the same as a deep fork
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        post = fork.posts.get()
+        self.assertEqual(post.tags.count(), 3)
+        self.assertEqual(post.authors.count(), 2)
+        self.assertEqual(post.blog, fork.blog)
+
+    def test_bulk(self):
+        fork = self.author.fork(deep=True, lazy=True, bulk=True)
+        materialize_all(fork)
+
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(fork.posts.get().authors.count(), 2)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.post.fork, lazy=True)
+        self.assertRaises(ValueError, self.post.fork, deep=True, lazy=True,
+            commit=False)
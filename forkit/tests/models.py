@@ -65,3 +65,10 @@ class D(ForkableModel):
     def __unicode__(self):
         return u'{0}'.format(self.title)
 
+
+class Revision(ForkableModel):
+    title = models.CharField(max_length=50)
+    previous = models.ForeignKey('self', null=True, related_name='next')
+
+    def __unicode__(self):
+        return u'{0}'.format(self.title)
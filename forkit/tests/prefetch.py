@@ -0,0 +1,132 @@
+import os
+import tempfile
+from django.core.management import call_command
+from django.db import connections, transaction
+from django.test import TestCase, TransactionTestCase
+from forkit.prefetch import prefetch_model_object, clear_prefetched, \
+    get_loader, Loader, InlineLoader
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('PrefetchTestCase', 'SharedDatabaseTestCase')
+
+class PrefetchTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.blog = Blog.objects.get(pk=1)
+
+    def test_prefetch(self):
+        objs = prefetch_model_object(self.author, deep=True)
+
+        # 2 authors, 1 post, 1 blog and 3 tags
+        self.assertEqual(len(objs), 7)
+        self.assertEqual(self.author._prefetched['blog'], self.blog)
+
+        post = self.author._prefetched['posts'][0]
+        self.assertEqual(len(post._prefetched['tags']), 3)
+        # the same instance is used for each row
+        self.assertTrue(post._prefetched['blog'] is self.author._prefetched['blog'])
+
+        clear_prefetched(objs)
+        self.assertFalse(hasattr(self.author, '_prefetched'))
+
+    def test_query_count(self):
+        # the number of queries depends on the model graph, not the number
+        # of rows. many-to-many relations take two queries
+        with self.assertNumQueries(15):
+            prefetch_model_object(self.blog, deep=True)
+
+        for i in range(5):
+            post = Post(title='Post {0}'.format(i), blog=self.blog)
+            post.save()
+            post.tags.add(Tag.objects.create(name='tag {0}'.format(i)))
+
+        with self.assertNumQueries(15):
+            prefetch_model_object(self.blog, deep=True)
+
+    def test_prefetch_fork(self):
+        fork = self.author.fork(deep=True, prefetch=True)
+
+        self.assertEqual(fork.pk, 3)
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(fork.posts.all()[0].tags.count(), 3)
+        self.assertFalse(hasattr(self.author, '_prefetched'))
+
+    def test_loader(self):
+        loader = Loader(3)
+        try:
+            self.assertEqual(loader.map([(pow, (i, 2)) for i in range(10)]),
+                [i ** 2 for i in range(10)])
+            self.assertRaises(ZeroDivisionError, loader.map,
+                [(pow, (2, 2)), (divmod, (1, 0))])
+        finally:
+            loader.close()
+
+        # the in-memory test database is not visible to other threads, nor
+        # is the transaction of the test
+        self.assertTrue(isinstance(get_loader(4), InlineLoader))
+        self.assertTrue(isinstance(get_loader(), InlineLoader))
+
+    def test_prefetch_workers_fork(self):
+        fork = self.author.fork(deep=True, prefetch=True, prefetch_workers=4)
+
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(fork.posts.all()[0].tags.count(), 3)
+
+
+class SharedDatabaseTestCase(TransactionTestCase):
+    """Runs the loader threads against a database file, which unlike the
+    in-memory test database is shared between threads.
+    """
+    def setUp(self):
+        self.databases = connections.databases['default']
+        self.connection = connections['default']
+
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        # connections are per thread, the loader threads connect using the
+        # settings of the alias
+        connections.databases['default'] = dict(self.databases, NAME=self.path)
+        connections['default'] = self.connection.__class__(
+            connections.databases['default'], 'default')
+
+        call_command('syncdb', verbosity=0, interactive=False)
+        call_command('loaddata', 'test_data.json', verbosity=0)
+        self.author = Author.objects.get(pk=1)
+
+    def tearDown(self):
+        connections['default'].close()
+        connections.databases['default'] = self.databases
+        connections['default'] = self.connection
+        os.remove(self.path)
+
+    def test_workers(self):
+        loader = get_loader(4)
+        try:
+            self.assertTrue(isinstance(loader, Loader))
+        finally:
+            loader.close()
+
+        fork = self.author.fork(deep=True, prefetch=True, prefetch_workers=4)
+
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Tag.objects.count(), 6)
+        self.assertEqual(fork.posts.all()[0].tags.count(), 3)
+
+    def test_transaction(self):
+        with transaction.commit_on_success():
+            # uncommitted changes are not visible to other threads
+            self.assertTrue(isinstance(get_loader(4), InlineLoader))
+
+            post = self.author.posts.get()
+            post.tags.add(Tag.objects.create(name='uncommitted'))
+            fork = self.author.fork(deep=True, prefetch=True,
+                prefetch_workers=4)
+
+        self.assertEqual(fork.posts.all()[0].tags.count(), 4)
@@ -0,0 +1,132 @@
+from django.db.models import Q
+from django.test import TestCase
+from forkit.prefetch import prefetch_model_object, clear_prefetched
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('PruningTestCase',)
+
+# excludes every path from an author to it's posts
+NO_POSTS = {'Author': ['posts'], 'tests.blog': ['post_set']}
+
+class PruningTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def test_max_depth(self):
+        fork = self.author.fork(deep=True, max_depth=1)
+
+        # the blog and post are forked, but not the objects below them
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 3)
+
+        # objects at the maximum depth are related to the forks of objects
+        # above them, and to the reference's objects otherwise
+        post = fork.posts.all()[0]
+        self.assertNotEqual(post.pk, self.post.pk)
+        self.assertEqual(post.blog_id, fork.blog.pk)
+        self.assertEqual(post.tags.count(), 3)
+        self.assertEqual(list(post.tags.all()), list(self.post.tags.all()))
+
+    def test_max_depth_zero(self):
+        fork = self.post.fork(deep=True, max_depth=0)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 1)
+        self.assertEqual(fork.blog_id, self.post.blog_id)
+
+    def test_model_exclude(self):
+        self.author.fork(deep=True, model_exclude=NO_POSTS)
+
+        self.assertEqual(Author.objects.count(), 3)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_follow_predicate(self):
+        calls = []
+        def follow(blog):
+            calls.append(blog)
+            return False
+
+        self.author.fork(deep=True, follow={'Author': {'posts': lambda a: False},
+            'Blog': {'post_set': follow}})
+
+        self.assertEqual(calls, [Blog.objects.get(pk=1)])
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Post.objects.count(), 1)
+
+    def test_follow_filter(self):
+        follow = {'Blog': {'post_set': {'title': 'Nothing'}},
+            'Author': {'posts': Q(title='Nothing')}}
+        self.author.fork(deep=True, follow=follow)
+        self.assertEqual(Post.objects.count(), 1)
+
+        follow = {'Blog': {'post_set': {'title': self.post.title}}}
+        fork = self.author.fork(deep=True, follow=follow)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(fork.blog.post_set.count(), 1)
+
+    def test_prefetch(self):
+        with self.assertNumQueries(2):
+            objs = prefetch_model_object(self.author, deep=True,
+                model_exclude=NO_POSTS)
+
+        # only the author and blog are loaded
+        self.assertEqual(len(objs), 2)
+        clear_prefetched(objs)
+
+        objs = prefetch_model_object(self.author, deep=True, max_depth=1)
+        # 2 authors, 1 post, 1 blog and 3 tags
+        self.assertEqual(len(objs), 7)
+        clear_prefetched(objs)
+
+        objs = prefetch_model_object(self.author, deep=True,
+            follow={'Author': {'posts': {'title': 'Nothing'}},
+                'Blog': {'post_set': lambda blog: False}})
+        self.assertEqual(len(objs), 2)
+        clear_prefetched(objs)
+
+    def test_prefetch_fork(self):
+        fork = self.author.fork(deep=True, prefetch=True, max_depth=1)
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 3)
+        self.assertEqual(fork.posts.all()[0].tags.count(), 3)
+
+        self.author.fork(deep=True, prefetch=True, follow={
+            'Author': {'posts': {'title': 'Nothing'}},
+            'Blog': {'post_set': lambda blog: False}})
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(Blog.objects.count(), 3)
+
+    def test_explain(self):
+        explanation = self.author.fork(deep=True, explain=True, max_depth=0)
+        self.assertEqual(explanation.rows, {'tests.author': 1})
+
+        explanation = self.author.fork(deep=True, explain=True, max_depth=1)
+        self.assertEqual(explanation.rows, {'tests.author': 1, 'tests.post': 1,
+            'tests.blog': 1})
+
+        explanation = self.author.fork(deep=True, explain=True,
+            model_exclude=NO_POSTS)
+        self.assertEqual(explanation.rows, {'tests.author': 1, 'tests.blog': 1})
+
+        calls = []
+        def follow(blog):
+            calls.append(blog)
+            return False
+
+        explanation = self.author.fork(deep=True, explain=True,
+            follow={'Author': {'posts': {'title': 'Nothing'}},
+                'Blog': {'post_set': follow}})
+        self.assertEqual(explanation.rows, {'tests.author': 1, 'tests.blog': 1})
+        self.assertEqual(calls, [Blog.objects.get(pk=1)])
+
+        # nothing is forked
+        self.assertEqual(Author.objects.count(), 2)
+
+    def test_sql_engine(self):
+        self.assertRaises(ValueError, self.author.fork, deep=True,
+            max_depth=1, engine='sql')
@@ -1,7 +1,9 @@
 from django.test import TestCase
-from forkit.tests.models import A, B, C, D
+from django.db import models
+from forkit import commit
+from forkit.tests.models import A, B, C, D, Author, Post, Blog, Tag
 
-__all__ = ('ResetModelObjectTestCase',)
+__all__ = ('ResetModelObjectTestCase', 'RelatedResetTestCase')
 
 class ResetModelObjectTestCase(TestCase):
     def test_shallow_reset(self):
@@ -77,3 +79,112 @@ class ResetModelObjectTestCase(TestCase):
         # a2 gets reset relative to a1
         self.assertEqual(a2.title, a1.title)
         self.assertEqual(a2.d, d1)
+
+    def test_unchanged_reset(self):
+        b1 = B(title='b1')
+        b1.save()
+        c1 = C(title='c1', b=b1)
+        c1.save()
+        c2 = c1.fork()
+
+        saved = []
+        def record(sender, instance, **kwargs):
+            saved.append(kwargs.get('update_fields'))
+
+        models.signals.pre_save.connect(record, sender=C)
+        try:
+            # nothing has changed, so nothing is written
+            c1.reset(c2)
+            self.assertEqual(saved, [])
+
+            c2.title = 'c2'
+            c1.reset(c2)
+            self.assertEqual(len(saved), 1)
+            if commit._update_fields:
+                self.assertEqual(list(saved[0]), ['title'])
+
+            # missing foreign keys are set from the reference and saved
+            c2.b = None
+            c2.save()
+            del saved[:]
+
+            c1.reset(c2, bulk=True)
+            self.assertEqual(len(saved), 1)
+            if commit._update_fields:
+                self.assertEqual(list(saved[0]), ['b'])
+            self.assertEqual(C.objects.get(pk=c2.pk).b, b1)
+        finally:
+            models.signals.pre_save.disconnect(record, sender=C)
+
+
+class RelatedResetTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.post = Post.objects.get(pk=1)
+        self.blog = Blog.objects.get(pk=1)
+
+    def test_many2many_reset(self):
+        fork = self.post.fork()
+        fork.tags.remove(Tag.objects.get(pk=1))
+        fork.tags.add(Tag.objects.create(name='extra'))
+
+        # not reset by default
+        self.post.reset(fork)
+        self.assertEqual(sorted(fork.tags.values_list('name', flat=True)),
+            ['descriptor', 'extra', 'tip'])
+
+        self.post.reset(fork, related=True)
+        self.assertEqual(sorted(fork.tags.values_list('pk', flat=True)), [1, 2, 3])
+        self.assertEqual(fork.authors.count(), 2)
+
+        # nothing to reconcile, only the related objects are read
+        with self.assertNumQueries(4):
+            self.post.reset(fork, related=True)
+
+    def test_reverse_reset(self):
+        fork = self.blog.fork(deep=True)
+        post = fork.post_set.get()
+        post.tags.remove(post.tags.get(name='tip'))
+        post.tags.add(Tag.objects.create(name='extra'))
+        Post(title='Extra', blog=fork).save()
+
+        self.blog.reset(fork, deep=True, related=True,
+            match={'post_set': 'title', 'tags': 'name',
+                'authors': lambda author: author.last_name})
+
+        # the matching post is reset rather than forked again, the post the
+        # reference does not have is deleted
+        self.assertEqual(list(fork.post_set.values_list('pk', flat=True)),
+            [post.pk])
+        self.assertFalse(Post.objects.filter(title='Extra').exists())
+
+        # the missing tag is linked, the extra one unlinked
+        self.assertEqual(sorted(post.tags.values_list('name', flat=True)),
+            ['descriptor', 'python', 'tip'])
+        self.assertEqual(post.authors.count(), 2)
+
+    def test_reverse_reset_match(self):
+        fork = self.blog.fork(deep=True)
+        posts = list(fork.post_set.values_list('pk', flat=True))
+
+        # the forked posts would be deleted and forked again
+        self.assertRaises(ValueError, self.blog.reset, fork, deep=True,
+            related=True)
+        self.assertEqual(list(fork.post_set.values_list('pk', flat=True)),
+            posts)
+
+    def test_reverse_reset_fork(self):
+        fork = self.blog.fork(deep=True)
+        fork.post_set.all().delete()
+        posts = Post.objects.count()
+
+        self.blog.reset(fork, deep=True, related=True, bulk=True,
+            match={'post_set': 'pk'})
+
+        # the missing post is forked
+        self.assertEqual(Post.objects.count(), posts + 1)
+        post = fork.post_set.get()
+        self.assertNotEqual(post.pk, self.post.pk)
+        self.assertEqual(post.title, self.post.title)
+        self.assertEqual(post.tags.count(), 3)
@@ -28,7 +28,7 @@ class SignalsTestCase(TestCase):
             'last_name': ''
         });
 
-        signals.pre_fork.disconnect(author_config)
+        signals.pre_fork.disconnect(author_config, sender=Author)
 
     def test_deep_signal(self):
         # before signal is connected.. complete deep fork
@@ -52,5 +52,35 @@ class SignalsTestCase(TestCase):
         # odd usage of _get_field_value, but it works..
         self.assertEqual(blog0, None)
 
-        signals.pre_fork.disconnect(post_config)
+        signals.pre_fork.disconnect(post_config, sender=Post)
 
+
+    def test_batch_signals(self):
+        batches = []
+
+        def record(sender, signal, pairs, **kwargs):
+            batches.append((signal, sender, [(r.pk, i.pk) for r, i in pairs]))
+
+        signals.pre_fork_batch.connect(record, sender=Post)
+        signals.post_fork_batch.connect(record, sender=Post)
+
+        self.post.fork(deep=True)
+        post = Post.objects.order_by('-pk')[0]
+
+        # sent once before and once after the forks are committed
+        self.assertEqual(batches, [
+            (signals.pre_fork_batch, Post, [(1, None)]),
+            (signals.post_fork_batch, Post, [(1, post.pk)]),
+        ])
+
+        signals.pre_fork_batch.disconnect(record, sender=Post)
+        signals.post_fork_batch.disconnect(record, sender=Post)
+
+    def test_has_receivers(self):
+        self.assertFalse(signals.has_receivers(signals.pre_fork, Author))
+
+        signals.pre_fork.connect(author_config, sender=Author)
+        self.assertTrue(signals.has_receivers(signals.pre_fork, Author))
+        self.assertFalse(signals.has_receivers(signals.pre_fork, Post))
+
+        signals.pre_fork.disconnect(author_config, sender=Author)
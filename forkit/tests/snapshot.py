@@ -0,0 +1,94 @@
+import json
+from io import StringIO
+from django.test import TestCase
+from forkit import tools
+from forkit.snapshot import VERSION
+from forkit.tests.models import Author, Post, Blog, Tag, Revision
+
+__all__ = ('SnapshotTestCase',)
+
+class SnapshotTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.author = Author.objects.get(pk=1)
+        self.post = Post.objects.get(pk=1)
+
+    def capture(self, reference, **kwargs):
+        snapshot = StringIO()
+        tools.snapshot(reference, snapshot, **kwargs)
+        snapshot.seek(0)
+        return snapshot
+
+    def test_snapshot(self):
+        snapshot = self.capture(self.author, deep=True)
+
+        # nothing is committed
+        self.assertEqual(Author.objects.count(), 2)
+
+        lines = [json.loads(line) for line in snapshot]
+        self.assertEqual(lines[0]['version'], VERSION)
+        # 2 authors, 1 blog, 1 post and 3 tags, followed by the links of
+        # the post's authors and tags
+        self.assertEqual(lines[0]['objects'], 7)
+        self.assertEqual(len(lines), 10)
+
+    def test_fork_snapshot(self):
+        snapshot = self.capture(self.author, deep=True)
+
+        # the reference tree is not read
+        with self.assertNumQueries(9):
+            fork = tools.fork_snapshot(snapshot)
+
+        self.assertTrue(isinstance(fork, Author))
+        self.assertEqual(fork.first_name, 'Byron')
+        self.assertEqual(Author.objects.count(), 4)
+        self.assertEqual(Blog.objects.count(), 2)
+        self.assertEqual(Tag.objects.count(), 6)
+
+        post = fork.posts.get()
+        self.assertNotEqual(post.pk, self.post.pk)
+        self.assertEqual(post.blog.author, fork)
+        self.assertEqual(post.tags.count(), 3)
+        self.assertEqual(post.authors.count(), 2)
+
+        # snapshots can be forked repeatedly
+        snapshot.seek(0)
+        tools.fork_snapshot(snapshot)
+        self.assertEqual(Author.objects.count(), 6)
+
+    def test_shallow_snapshot(self):
+        fork = tools.fork_snapshot(self.capture(self.post))
+
+        self.assertEqual(Post.objects.count(), 2)
+        self.assertEqual(fork.blog, self.post.blog)
+        self.assertEqual(list(fork.tags.values_list('pk', flat=True)), [1, 2, 3])
+
+    def test_cycle(self):
+        first = Revision(title='first')
+        first.save()
+        second = Revision(title='second', previous=first)
+        second.save()
+        first.previous = second
+        first.save()
+
+        fork = tools.fork_snapshot(self.capture(first, deep=True))
+        self.assertEqual(Revision.objects.count(), 4)
+        self.assertEqual(fork.previous.previous, fork)
+
+    def test_version(self):
+        snapshot = StringIO(u'{"format":"forkit.snapshot","version":0}\n')
+        self.assertRaises(ValueError, tools.fork_snapshot, snapshot)
+
+    def test_link_chunks(self):
+        snapshot = self.capture(self.author, deep=True, chunk_size=2)
+
+        # the post's 3 tags take 2 lines, it's 2 authors 1
+        lines = [json.loads(line) for line in snapshot]
+        links = [len(line['rows']) for line in lines if 'links' in line]
+        self.assertEqual(sorted(links), [1, 2, 2])
+
+        snapshot.seek(0)
+        post = tools.fork_snapshot(snapshot).posts.get()
+        self.assertEqual(post.tags.count(), 3)
+        self.assertEqual(post.authors.count(), 2)
@@ -0,0 +1,64 @@
+from django.db import connection
+from django.test import TestCase
+from forkit.stats import ForkStats
+from forkit.tests.models import Author, Post, Blog, Tag
+
+__all__ = ('ForkStatsTestCase',)
+
+class ForkStatsTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    def setUp(self):
+        self.post = Post.objects.get(pk=1)
+
+    def test_fork_stats(self):
+        exported = []
+        stats = ForkStats(export=lambda stats, operation: exported.append(operation))
+
+        self.post.fork(deep=True, stats=stats)
+
+        # the commit is part of the fork, so it's only exported once
+        self.assertEqual(exported, ['fork'])
+
+        post = stats.models['tests.post']
+        self.assertEqual(post.visited, 1)
+        self.assertEqual(post.inserted, 1)
+        self.assertTrue(post.queries > 0)
+        self.assertTrue(post.times['traversal'] > 0)
+        self.assertTrue(post.times['commit'] > 0)
+
+        self.assertEqual(stats.models['tests.tag'].visited, 3)
+        self.assertEqual(stats.models['tests.tag'].inserted, 3)
+        # the fork of the author is reached from both the post and the blog
+        self.assertTrue(stats.models['tests.author'].memo_hits > 0)
+
+    def test_accumulate(self):
+        stats = ForkStats()
+        fork = self.post.fork(stats=stats)
+        self.post.diff(fork, stats=stats)
+        # resets only save objects which have changed
+        fork.title = 'Changed'
+        self.post.reset(fork, stats=stats)
+
+        post = stats.models['tests.post']
+        # fork, diff and reset
+        self.assertEqual(post.visited, 3)
+        self.assertEqual(post.inserted, 1)
+        self.assertEqual(post.updated, 1)
+        self.assertEqual(stats.as_dict()['tests.post']['visited'], 3)
+
+    def test_queries(self):
+        "Queries are counted without the query log."
+        # the post caches it's blog and the blog it's author once read
+        self.post.fork(deep=True)
+
+        logged = len(connection.queries)
+        stats = ForkStats()
+        self.post.fork(deep=True, stats=stats)
+
+        self.assertEqual(len(connection.queries), logged)
+        self.assertFalse('cursor' in connection.__dict__)
+
+        queries = sum([model.queries for model in stats.models.values()])
+        with self.assertNumQueries(queries):
+            self.post.fork(deep=True)
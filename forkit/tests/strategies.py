@@ -0,0 +1,47 @@
+from django.db import models
+from django.test import TestCase
+from forkit import strategies, plans
+from forkit.tests.models import Post
+
+__all__ = ('StrategiesTestCase',)
+
+class ListField(models.TextField):
+    "A subclass of an immutable field type which has mutable values."
+
+
+class StrategiesTestCase(TestCase):
+    def tearDown(self):
+        strategies.unregister(ListField)
+        strategies.unregister(models.TextField)
+
+    def test_builtin_strategies(self):
+        self.assertTrue(strategies.get_strategy(models.CharField()) is strategies.identity)
+        self.assertTrue(strategies.get_strategy(models.DateTimeField()) is strategies.identity)
+        # the plan resolves the strategy once per field
+        self.assertTrue(plans.get_plan(Post).field('title').copy is strategies.identity)
+        self.assertTrue(plans.get_plan(Post).field('blog').copy is None)
+
+    def test_register(self):
+        # subclasses of built-in fields fall back to deepcopy
+        field = ListField()
+        self.assertTrue(strategies.get_strategy(field) is strategies.deepcopy)
+
+        strategies.register(ListField, strategies.copy_json)
+        self.assertTrue(strategies.get_strategy(field) is strategies.copy_json)
+
+    def test_register_builtin(self):
+        # registered strategies take precedence over the built-in ones
+        strategies.register(models.TextField, strategies.shallow)
+        self.assertTrue(strategies.get_strategy(models.TextField()) is strategies.shallow)
+        self.assertTrue(strategies.get_strategy(ListField()) is strategies.shallow)
+
+        strategies.unregister(models.TextField)
+        self.assertTrue(strategies.get_strategy(models.TextField()) is strategies.identity)
+        self.assertTrue(strategies.get_strategy(ListField()) is strategies.deepcopy)
+
+    def test_copy_json(self):
+        value = {'a': [1, {'b': 2}], 'c': 'd'}
+        copy = strategies.copy_json(value)
+        self.assertEqual(copy, value)
+        self.assertFalse(copy['a'] is value['a'])
+        self.assertFalse(copy['a'][1] is value['a'][1])
@@ -1,6 +1,6 @@
 from django.test import TestCase
-from forkit import utils, diff
-from forkit.tests.models import Author, Post, Blog, Tag
+from forkit import utils, diff, plans, signals
+from forkit.tests.models import Author, Post, Blog, Tag, Revision
 
 __all__ = ('UtilsTestCase',)
 
@@ -24,13 +24,31 @@ class UtilsTestCase(TestCase):
         utils._get_field_by_accessor(self.blog, 'author')
         # intentionally left off a related_name
         utils._get_field_by_accessor(self.blog, 'post_set')
-        # the memo was created for the ``post_set`` accessor
-        self.assertEqual(self.blog._meta.related_objects_by_accessor.keys(), ['post_set'])
+        # the plan is compiled once per model
+        plan = plans.get_plan(Blog)
+        self.assertTrue(plans.get_plan(Blog) is plan)
+        self.assertEqual(plan.field('post_set').kind, plans.FOREIGNKEY)
+        self.assertEqual(plan.field('post_set').direct, False)
 
         # reverse many-to-many without a related_name can also be looked up by
         # their model name
         utils._get_field_by_accessor(self.tag, 'post')
 
+    def test_plan_fields(self):
+        plan = plans.get_plan(Post)
+
+        fields = plan.fields()
+        self.assertTrue(plan.fields() is fields)
+        self.assertEqual([f.accessor for f in fields],
+            ['title', 'blog', 'authors', 'tags'])
+        self.assertEqual([f.kind for f in fields],
+            [plans.LOCAL, plans.FOREIGNKEY, plans.MANY2MANY, plans.MANY2MANY])
+
+        self.assertEqual([f.accessor for f in plan.fields(fields=['tags', 'title'])],
+            ['tags', 'title'])
+        self.assertEqual([f.accessor for f in plans.get_plan(Blog).fields(deep=True)],
+            ['name', 'author', 'post_set'])
+
     def test_field_value(self):
         self.assertEqual(utils._get_field_value(self.author, 'first_name')[0], 'Byron')
         # returns a queryset, compare the querysets
@@ -91,3 +109,48 @@ class UtilsTestCase(TestCase):
         self.assertEqual(utils._default_model_fields(tag, deep=True),
             set(['name', 'post_set']))
 
+
+    def test_memo_release(self):
+        memo = utils.Memo()
+        fork = self.author.fork(commit=False)
+        memo.add(self.author, fork)
+
+        # pending forks are not released
+        memo.release()
+        self.assertTrue(memo.get(self.author) is fork)
+
+        fork.commit()
+        memo.release()
+        self.assertTrue(memo.has(self.author))
+        self.assertTrue(memo.released(self.author))
+
+        placeholder = memo.get(self.author)
+        self.assertFalse(placeholder is fork)
+        self.assertEqual(placeholder.pk, fork.pk)
+
+    def test_memo_frontier(self):
+        revisions = [None]
+        for i in range(20):
+            revisions.append(Revision.objects.create(
+                title='Revision {0}'.format(i), previous=revisions[-1]))
+
+        # each revision is committed after the one before it
+        fork = revisions[1].fork(deep=True, commit=False)
+        memo = utils.Memo()
+        retained = []
+
+        def receiver(sender, instance, **kwargs):
+            retained.append(memo.retained())
+
+        signals.post_commit.connect(receiver, sender=Revision)
+        try:
+            fork.commit(memo=memo)
+        finally:
+            signals.post_commit.disconnect(receiver, sender=Revision)
+
+        # committed revisions are released as the commit goes along
+        self.assertEqual(len(retained), 20)
+        self.assertTrue(max(retained) <= 2)
+        self.assertEqual(memo.retained(), 0)
+        self.assertEqual(Revision.objects.count(), 40)
+        self.assertEqual(memo.get(revisions[20]).pk, 40)
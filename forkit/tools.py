@@ -1,4 +1,11 @@
 from forkit.diff import diff_model_object as diff
+from forkit.diff import diff_queryset
 from forkit.fork import fork_model_object as fork
+from forkit.fork import fork_model_objects as fork_many
 from forkit.reset import reset_model_object as reset
 from forkit.commit import commit_model_object as commit
+from forkit.commit import commit_model_objects as commit_many
+from forkit.stats import ForkStats
+from forkit.snapshot import snapshot_model_object as snapshot
+from forkit.snapshot import fork_snapshot
+from forkit.lazy import materialize, materialize_all
@@ -1,10 +1,13 @@
-from django.db import models
-from django.db.models import related
+from itertools import islice
+from django.db import models, connections, router
+from forkit import plans, signals, stats
 
 class DeferredCommit(object):
     """Differentiates a non-direct related object that should be deferred
     during the commit phase.
     """
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -12,12 +15,38 @@ class DeferredCommit(object):
         return '<DeferredCommit: "{0}">'.format(repr(self.value))
 
 
+class Reconcile(object):
+    """The related objects to add to and remove from a many-to-many or
+    reverse foreign key relationship of a reset object, rather than replacing
+    the whole set. ``matched`` are the related objects being reset.
+    """
+    __slots__ = ('added', 'removed', 'matched')
+
+    def __init__(self, added, removed, matched):
+        self.added = added
+        self.removed = removed
+        self.matched = matched
+
+    def __repr__(self):
+        return '<Reconcile: +{0} -{1} ~{2}>'.format(len(self.added),
+            len(self.removed), len(self.matched))
+
+
 class Commits(object):
-    "Stores pending direct and related commits relative to the reference."
+    """Stores pending direct and related commits relative to the reference.
+    It is detached from the instance once the instance has been committed.
+    """
+    __slots__ = ('reference', 'direct', 'related', 'fields', 'changed')
+
     def __init__(self, reference):
         self.reference = reference
         self.direct = {}
         self.related = {}
+        # the compiled fields the object was forked with
+        self.fields = ()
+        # the names of the fields changed by a reset, or ``None`` if changes
+        # are not tracked and the whole object is saved
+        self.changed = None
 
     def defer(self, accessor, obj, direct=False):
         "Add object in the deferred queue for the given accessor."
@@ -33,86 +62,269 @@ class Commits(object):
         return self.related.get(accessor, None)
 
 
+class Links(object):
+    """Stores pending many-to-many links, grouped by through table, so they
+    can be written using a single insert per table.
+    """
+    def __init__(self):
+        self._links = {}
+        self._removed = {}
+
+    def __len__(self):
+        return len(self._links) + len(self._removed)
+
+    def _key(self, plan_field):
+        field = plan_field.field
+        if plan_field.direct:
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        else:
+            source, target = field.m2m_reverse_field_name(), field.m2m_field_name()
+        return field.rel.through, source, target
+
+    def defer(self, instance, plan_field, value, created=True):
+        """Add the links between ``instance`` and the objects in ``value`` for
+        the many-to-many ``plan_field``. Unless ``instance`` has just been
+        ``created``, existing links are replaced.
+        """
+        key = self._key(plan_field)
+        pending, cleared = self._links.setdefault(key, ([], []))
+        pending.append((instance, value))
+        if not created:
+            cleared.append(instance)
+
+    def reconcile(self, instance, plan_field, added, removed):
+        """Adds the links between ``instance`` and the objects in ``added``
+        and removes the links to the objects in ``removed``. Other existing
+        links are kept.
+        """
+        self.defer(instance, plan_field, added)
+        if removed:
+            self._removed.setdefault(self._key(plan_field), []).append(
+                (instance, removed))
+
+    def write(self, memo=None):
+        """Writes all pending links. Related objects that are references of
+        objects which have been committed are substituted by the committed
+        object using ``memo``.
+        """
+        for (through, source, target), removed in self._removed.items():
+            manager = through._base_manager
+            pairs = [(instance.pk, obj.pk) for instance, objs in removed
+                for obj in objs]
+
+            for chunk in _chunks(pairs, 100):
+                condition = models.Q()
+                for source_pk, target_pk in chunk:
+                    condition |= models.Q(**{source: source_pk, target: target_pk})
+                manager.filter(condition).delete()
+
+        written = {}
+        for (through, source, target), (pending, cleared) in self._links.items():
+            manager = through._base_manager
+            source_attname = through._meta.get_field(source).attname
+            target_attname = through._meta.get_field(target).attname
+
+            for chunk in _chunks([instance.pk for instance in cleared]):
+                manager.filter(**{'{0}__in'.format(source): chunk}).delete()
+
+            # the same link may be pending from both sides of the relationship
+            seen = written.setdefault(through, set())
+            rows = []
+            for instance, value in pending:
+                for obj in value:
+                    if memo is not None and not hasattr(obj, '_commits') \
+                            and memo.has(obj):
+                        obj = memo.get(obj)
+
+                    key = tuple(sorted([(source_attname, instance.pk),
+                        (target_attname, obj.pk)]))
+                    if key not in seen:
+                        seen.add(key)
+                        rows.append(through(**{source_attname: instance.pk,
+                            target_attname: obj.pk}))
+
+            _bulk_insert(through, rows, pks=False)
+
+        self._links = {}
+        self._removed = {}
+
+
 class Memo(object):
-    "Memoizes reference objects and their instance equivalents."
+    """Memoizes reference objects and their instance equivalents. Saved
+    references are keyed by their model label and primary key, so the memo
+    does not hold on to the references themselves.
+    """
+    __slots__ = ('_memo', '_recent')
+
     def __init__(self):
         self._memo = {}
+        # keys added since the last ``release``
+        self._recent = []
 
     def _key(self, reference):
         if reference.pk:
-            return id(reference.__class__), reference.pk
+            return plans._model_label(reference.__class__), reference.pk
         return id(reference)
 
     def has(self, reference):
         key = self._key(reference)
-        return self._memo.has_key(key)
+        return key in self._memo
 
     def add(self, reference, instance):
         key = self._key(reference)
         self._memo[key] = instance
+        self._recent.append(key)
 
     def get(self, reference):
         key = self._key(reference)
-        return self._memo.get(key)
+        instance = self._memo.get(key)
+        # released instances are represented by their primary key only
+        if type(instance) is tuple:
+            model, pk = instance
+            instance = model(pk=pk)
+            instance._state.adding = False
+        return instance
+
+    def released(self, reference):
+        "Returns true if the instance of ``reference`` has been released."
+        return type(self._memo.get(self._key(reference))) is tuple
+
+    def recent(self):
+        "Returns the keys and instances added since the last release."
+        return [(key, self._memo[key]) for key in self._recent]
+
+    def retained(self):
+        "Returns the number of instances which have not been released."
+        return len([instance for instance in self._memo.values()
+            if type(instance) is not tuple])
+
+    def _release(self, key):
+        """Releases the instance of ``key`` if it has been committed. Returns
+        false if it's still pending.
+        """
+        instance = self._memo[key]
+        if type(instance) is tuple:
+            return True
+        if hasattr(instance, '_commits') or instance.pk is None:
+            return False
+        self._memo[key] = (instance.__class__, instance.pk)
+        return True
+
+    def release(self, references=None):
+        """Replaces each committed instance added since the last release by
+        it's model and primary key. Later lookups return an unsaved-looking
+        copy with only the primary key set, which is all that is needed to
+        relate other objects to it. If ``references`` are supplied, only
+        their instances are released.
+        """
+        if references is not None:
+            for reference in references:
+                key = self._key(reference)
+                if key in self._memo:
+                    self._release(key)
+            return
+
+        self._recent = [key for key in self._recent if not self._release(key)]
+
+
+class Context(object):
+    """State shared by every object visited during a single fork, reset or
+    commit. Work is pushed onto an explicit stack rather than being done
+    recursively, so there is no limit on the depth of the object tree.
+    """
+    def __init__(self, memo=None, stats=None, **kwargs):
+        if memo is None:
+            memo = Memo()
+        self.memo = memo
+        # an optional ``ForkStats`` collector
+        self.stats = stats
+        # the object the operation was started with
+        self.root = None
+        # additional keyword arguments passed along to signal receivers
+        self.kwargs = kwargs
+        self.stack = []
+        # work postponed until everything on the stack has been done
+        self.deferred = []
+        # objects loaded ahead of time by the prefetch planner
+        self.prefetched = []
+        # many-to-many links written once all objects are committed
+        self.links = Links()
+        # related objects removed by a reset, deleted once all objects are
+        # committed
+        self.deletes = []
+        self._receivers = {}
+
+    def listening(self, signal, sender):
+        """Returns true if ``signal`` has receivers for ``sender``. This is
+        checked once per operation, so signals without receivers cost
+        nothing to skip.
+        """
+        key = (signal, sender)
+        listening = self._receivers.get(key)
+        if listening is None:
+            listening = self._receivers[key] = signals.has_receivers(signal, sender)
+        return listening
+
+    def timer(self, model, phase):
+        "Returns a context manager timing ``phase`` if stats are collected."
+        return stats.timer(self.stats, model, phase)
+
+    def count(self, model, name, value=1):
+        "Increments the counter ``name`` of ``model`` if stats are collected."
+        if self.stats is not None:
+            self.stats.count(model, name, value)
+
+    def push(self, func, *args):
+        "Queues ``func(context, *args)`` to be called."
+        self.stack.append((func, args))
+
+    def mark(self):
+        return len(self.stack)
+
+    def reorder(self, mark):
+        """Reverses the work pushed since ``mark``, so it is done in the order
+        it was pushed rather than the reverse.
+        """
+        self.stack[mark:] = reversed(self.stack[mark:])
+
+    def run(self):
+        "Does all queued work, including work queued along the way."
+        stack = self.stack
+        while stack:
+            func, args = stack.pop()
+            func(self, *args)
+
 
 def _get_field_by_accessor(instance, accessor):
     """Extends the model ``Options.get_field_by_name`` to look up reverse
-    relationships by their accessor name. This gets memod on the first
-    lookup.
-
-    The memo will only be needed when the ``related_name`` attribute has
-    not been set for reverse relationships.
+    relationships by their accessor name. The lookups are compiled once per
+    model, see ``forkit.plans``.
     """
-    try:
-        field, model, direct, m2m = instance._meta.get_field_by_name(accessor)
-
-        if isinstance(field, related.RelatedObject):
-            field = field.field
-    # if this occurs, try related object accessor
-    except models.FieldDoesNotExist, e:
-        # check to see if this memo has been set
-        if not hasattr(instance._meta, 'related_objects_by_accessor'):
-            memo = {}
-
-            # reverse foreign key and many-to-many rels
-            related_objects = (
-                instance._meta.get_all_related_objects() +
-                instance._meta.get_all_related_many_to_many_objects()
-            )
-
-            for rel in iter(related_objects):
-                memo[rel.get_accessor_name()] = rel
+    field = plans.get_plan(instance.__class__).field(accessor)
+    return field.field, field.direct, field.m2m
 
-            instance._meta.related_objects_by_accessor = memo
-
-        rel = instance._meta.related_objects_by_accessor.get(accessor, None)
-
-        # if the related object still doesn't exist, raise the exception
-        # that is present
-        if rel is None:
-            raise e
-
-        field, model, direct, m2m = (
-            rel.field,
-            rel.model,
-            False,
-            isinstance(rel.field, models.ManyToManyField)
-        )
-
-    # ignoring ``model`` for now.. no use for it
-    return field, direct, m2m
-
-def _get_field_value(instance, accessor):
-    """Simple helper that returns the model's data value and catches
+def _get_attribute(instance, accessor):
+    "Returns the attribute value, catching non-existent related objects."
+    try:
+        return getattr(instance, accessor)
+    # catch foreign keys and one-to-one lookups
+    except models.ObjectDoesNotExist:
+        return None
+    # catch many-to-many or related foreign keys
+    except ValueError:
+        return []
+
+def _get_plan_value(instance, plan_field):
+    """Returns the model's data value for a compiled ``PlanField`` and catches
     non-existent related object lookups.
     """
-    field, direct, m2m = _get_field_by_accessor(instance, accessor)
+    accessor, field, direct, m2m = plan_field[:4]
 
     value = None
     # attempt to retrieve deferred values first, since they will be
     # the value once comitted. these will never contain non-relational
     # fields
-    if hasattr(instance, '_commits'):
+    if plan_field.kind != plans.LOCAL and hasattr(instance, '_commits'):
         if m2m:
             value = instance._commits.get(accessor, direct=False)
         else:
@@ -120,16 +332,14 @@ def _get_field_value(instance, accessor):
         if value and isinstance(value, DeferredCommit):
             value = value.value
 
-    # deferred relations can never be a NoneType
+    # deferred relations can never be a NoneType. values loaded ahead of
+    # time by the prefetch planner are used before hitting the database
     if value is None:
-        try:
-            value = getattr(instance, accessor)
-        # catch foreign keys and one-to-one lookups
-        except models.ObjectDoesNotExist:
-            value = None
-        # catch many-to-many or related foreign keys
-        except ValueError:
-            value = []
+        prefetched = getattr(instance, '_prefetched', None)
+        if prefetched is not None and accessor in prefetched:
+            value = prefetched[accessor]
+        else:
+            value = _get_attribute(instance, accessor)
 
     # get the queryset associated with the m2m or reverse foreign key.
     # logic broken up for readability
@@ -137,27 +347,149 @@ def _get_field_value(instance, accessor):
         if type(value) is not list:
             value = value.all()
 
+    return value
+
+def _get_field_value(instance, accessor):
+    """Simple helper that returns the model's data value and catches
+    non-existent related object lookups.
+    """
+    plan_field = plans.get_plan(instance.__class__).field(accessor)
+    value = _get_plan_value(instance, plan_field)
+
     # ignoring ``model`` for now.. no use for it
-    return value, field, direct, m2m
+    return value, plan_field.field, plan_field.direct, plan_field.m2m
 
 def _default_model_fields(instance, exclude=('pk',), deep=False):
     "Aggregates the default set of fields for creating an object fork."
-    if not exclude:
-        exclude = []
-    # handle this special case..
-    else:
-        exclude = list(exclude)
-        if 'pk' in exclude:
-            exclude.remove('pk')
-            exclude.append(instance._meta.pk.name)
+    fields = plans.get_plan(instance.__class__).fields(exclude=exclude, deep=deep)
+    return set([field.accessor for field in fields])
 
-    fields = (
-        [f.name for f in instance._meta.fields + instance._meta.many_to_many] +
-        [r.get_accessor_name() for r in instance._meta.get_all_related_many_to_many_objects()]
-    )
-
-    if deep:
-        fields += [r.get_accessor_name() for r in instance._meta.get_all_related_objects()]
-
-    return set(fields) - set(exclude)
+def _model_fields(instance, fields=None, exclude=('pk',), deep=False):
+    """Returns the compiled ``PlanField``s for ``fields``, or the default set
+    of fields if none are defined. ``instance`` may also be a model class.
+    """
+    model = isinstance(instance, models.Model) and instance.__class__ or instance
+    return plans.get_plan(model).fields(fields, exclude, deep)
 
+def _model_rule(rules, model):
+    """Returns the value ``rules`` holds for ``model``, which may be keyed by
+    the model class, it's ``app_label.modelname`` label or it's name.
+    """
+    if not rules:
+        return None
+    for key in (model, plans._model_label(model), model._meta.object_name):
+        if key in rules:
+            return rules[key]
+    return None
+
+def _tree_fields(instance, fields=None, exclude=('pk',), deep=False,
+        model_exclude=None):
+    """Returns ``_model_fields`` without the accessors ``model_exclude``
+    excludes for the model, which apply to every object of the tree.
+    """
+    model = isinstance(instance, models.Model) and instance.__class__ or instance
+    excluded = _model_rule(model_exclude, model)
+    if not excluded:
+        return _model_fields(model, fields, exclude, deep)
+    if not fields:
+        return _model_fields(model, None, tuple(exclude or ()) + tuple(excluded), deep)
+    return tuple([plan_field for plan_field in _model_fields(model, fields,
+        exclude, deep) if plan_field.accessor not in excluded])
+
+def _follow_rule(follow, model, plan_field):
+    """Returns the rule ``follow`` holds for the many-to-many or reverse
+    relation ``plan_field`` of ``model``, either a predicate called with the
+    object the relation would be followed from, or a ``Q`` object or
+    ``dict`` of lookups filtering the related objects.
+    """
+    if not follow or plan_field.direct and not plan_field.m2m:
+        return None
+    rules = _model_rule(follow, model)
+    return rules and rules.get(plan_field.accessor)
+
+def _filter_related(queryset, rule):
+    "Filters ``queryset`` by the ``Q`` object or ``dict`` of lookups ``rule``."
+    if isinstance(rule, dict):
+        return queryset.filter(**rule)
+    return queryset.filter(rule)
+
+def _can_recover_pks(model, connection):
+    """Returns ``True`` if the primary keys of objects inserted with a single
+    multi-row insert can be determined afterwards.
+    """
+    features = connection.features
+    if getattr(features, 'can_return_ids_from_bulk_insert', False) or \
+            getattr(features, 'can_return_rows_from_bulk_insert', False):
+        return True
+    # sqlite holds the database write lock for the rest of the transaction
+    # once the insert executes, so the new rows are the last ones by pk
+    return connection.vendor == 'sqlite' and \
+        isinstance(model._meta.pk, models.AutoField)
+
+def _chunks(values, size=500):
+    "Splits ``values`` into lists of at most ``size`` values."
+    # avoid filling the result cache of querysets
+    if hasattr(values, 'iterator'):
+        values = values.iterator()
+    iterator = iter(values)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+def _bulk_delete(objs):
+    "Deletes ``objs`` using a single query per model and chunk of objects."
+    grouped = {}
+    for obj in objs:
+        grouped.setdefault(obj.__class__, []).append(obj.pk)
+
+    for model, pks in grouped.items():
+        for chunk in _chunks(pks):
+            model._base_manager.filter(pk__in=chunk).delete()
+
+def _bulk_insert(model, objs, pks=True):
+    """Inserts ``objs`` of type ``model`` using as few statements as possible.
+    Each object has it's primary key set afterwards, unless ``pks`` is false.
+    If the database cannot tell which primary keys were assigned, each object
+    is saved individually.
+    """
+    if not objs:
+        return
+
+    db = router.db_for_write(model)
+    connection = connections[db]
+    queryset = model._base_manager.db_manager(db).all()
+
+    if len(objs) == 1 or model._meta.parents or not hasattr(queryset, 'bulk_create'):
+        for obj in objs:
+            obj.save()
+        return
+
+    with_pk = [obj for obj in objs if obj.pk is not None]
+    without_pk = [obj for obj in objs if obj.pk is None]
+
+    if with_pk:
+        queryset.bulk_create(with_pk)
+
+    if without_pk:
+        if not pks:
+            queryset.bulk_create(without_pk)
+        elif not _can_recover_pks(model, connection):
+            for obj in without_pk:
+                obj.save()
+        else:
+            queryset.bulk_create(without_pk)
+
+            # newer versions of django set the primary keys in place
+            missing = [obj for obj in without_pk if obj.pk is None]
+            if missing:
+                assigned = list(queryset.order_by('-pk')
+                    .values_list('pk', flat=True)[:len(missing)])
+                assigned.reverse()
+                for obj, pk in zip(missing, assigned):
+                    obj.pk = pk
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = db